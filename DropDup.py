@@ -1,87 +1,19 @@
-from ImageHash import (
-    hex_to_multihash,
-    hex_to_hash,
-
-    crop_resistant_hash,
-    ahash,
-    dhash,
-    phash,
-    rhash,
-)
 from PySide6 import (
     QtWidgets,
     QtCore,
     QtGui,
 )
-from concurrent.futures import (
-    ProcessPoolExecutor,
-    as_completed
-)
 from application_path import application_path
+from app_settings import settings
 from multiprocessing import freeze_support
-from PIL import Image
 import subprocess
 import shutil
-import peewee
 import math
 import sys
 import os
 
-database = peewee.SqliteDatabase(os.path.join(application_path(), 'processing.sqlite3'))
-
-algorithms = {
-    'rhash': rhash,
-    'phash': phash,
-    'ahash': ahash,
-    'dhash': dhash,
-}
-
 title_font = QtGui.QFont('OpenSans', 18)
 text_font = QtGui.QFont('OpenSans', 14)
-settings = QtCore.QSettings('DropDup', 'settings')
-
-
-def get_dublicates(group):
-    images = ProcessedImage.select().where(ProcessedImage.id.in_(group))
-    original_image = max(images, key=lambda img: (img.image_width * img.image_height, img.image_dpi))
-
-    return [image.image_path for image in images if image.id != original_image.id]
-
-
-def remove_groups(groups):
-    for group in groups:
-        dublicates = get_dublicates(group)
-        for image_path in dublicates:
-            os.remove(image_path)
-
-
-def move_groups(groups, path_to_duplicates):
-    for group in groups:
-        dublicates = get_dublicates(group)
-        for image_path in dublicates:
-            shutil.move(image_path, os.path.join(path_to_duplicates, os.path.split(image_path)[1]))
-
-
-def remove_files(ids):
-    images = ProcessedImage.select().where(ProcessedImage.id.in_(ids))
-    for image in images:
-        os.remove(image.image_path)
-
-
-def move_files(ids, path_to_duplicates):
-    images = ProcessedImage.select().where(ProcessedImage.id.in_(ids))
-    for image in images:
-        image_path = image.image_path
-        shutil.move(image_path, os.path.join(path_to_duplicates, os.path.split(image_path)[1]))
-
-
-def update_groups(groups, processed_images):
-    new_groups = []
-
-    for group in groups:
-        new_groups.append([image_id for image_id in group if image_id not in processed_images])
-
-    return new_groups
 
 
 def open_file_explorer(path):
@@ -98,102 +30,6 @@ def open_file_explorer(path):
         subprocess.run(['xdg-open', directory])
 
 
-def _is_image(filename):
-    _, ext = os.path.splitext(filename)
-    if ext.lower() in ('.png', '.jpg', '.jpeg', '.bmp', '.gif', '.svg'):
-        return True
-    return False
-
-
-def count_files(path, check_subdirectories=False):
-    if check_subdirectories:
-        return sum(1 for root, dirs, files in os.walk(path) for name in files if _is_image(os.path.join(root, name)))
-    else:
-        return sum(1 for name in os.listdir(path) if _is_image(os.path.join(path, name)))
-
-
-def file_generator(path, check_subdirectories=False):
-    if check_subdirectories:
-        for root, dirs, files in os.walk(path):
-            for name in files:
-                if _is_image(os.path.join(root, name)):
-                    yield os.path.join(root, name)
-    else:
-        for name in os.listdir(path):
-            if _is_image(os.path.join(path, name)):
-                yield os.path.join(path, name)
-
-
-def ID_generator(processed_images: int):
-    for id1 in range(processed_images):
-        for id2 in range(id1 + 1, processed_images):
-            yield (id1 + 1, id2 + 1)
-
-
-def _create_hash(filepath, algorithm, algorithm_str, hash_size, use_crop_resistant_hash):
-    image = Image.open(filepath)
-    image_hash = ''
-
-    kwargs = {
-        'hash_size': hash_size
-    }
-    if algorithm_str == 'rhash':
-        kwargs['block_size'] = hash_size * 2
-    elif algorithm_str == 'phash':
-        kwargs['highfreq_factor'] = hash_size * 2
-
-    if use_crop_resistant_hash:
-        image_hash = crop_resistant_hash(image, algorithm, **kwargs)
-    else:
-        image_hash = algorithm(image, **kwargs)
-
-    image_width, image_height = image.size
-    image_dpi = 72
-    if 'dpi' in image.info:
-        image_dpi = int(max(image.info['dpi']))
-    image_size = os.path.getsize(filepath) / 1048576
-
-    processed_image_data = {
-        'image_hash': str(image_hash),
-        'image_path': filepath,
-        'image_width': image_width,
-        'image_height': image_height,
-        'image_dpi': image_dpi,
-        'image_size': image_size,
-    }
-
-    processed_image = ProcessedImage.create(**processed_image_data)
-    processed_image.save()
-
-
-def _get_hash(hex_hash):
-    return hex_to_hash(hex_hash) if ',' not in hex_hash else hex_to_multihash(hex_hash)
-
-
-def _compare_images(id1, id2, threshold):
-    img1_hash = ProcessedImage.select().where(ProcessedImage.id == id1).dicts().get()['image_hash']
-    img2_hash = ProcessedImage.select().where(ProcessedImage.id == id2).dicts().get()['image_hash']
-
-    difference = _get_hash(img1_hash) - _get_hash(img2_hash)
-
-    if (1 - difference) >= round(threshold / 100, 2):
-        return [id1, id2]
-    return None
-
-
-class ProcessedImage(peewee.Model):
-    class Meta:
-        database = database
-
-    id = peewee.IntegerField(primary_key=True)
-    image_path = peewee.TextField()
-    image_hash = peewee.TextField()
-    image_width = peewee.IntegerField()
-    image_height = peewee.IntegerField()
-    image_dpi = peewee.IntegerField()
-    image_size = peewee.FloatField()
-
-
 class FolderNameValidator(QtGui.QValidator):
     def __init__(self):
         QtGui.QValidator.__init__(self)
@@ -206,210 +42,12 @@ class FolderNameValidator(QtGui.QValidator):
         return (QtGui.QValidator.Acceptable, input, pos)
 
 
-class FindDuplicatesThread(QtCore.QThread):
-    process_signal = QtCore.Signal(float)
-
-    def __init__(self, path):
-        QtCore.QThread.__init__(self)
-        self._path = path
-        self._processed_images = 0
-        self._progress = 0
-
-        self.duplicates = []
-        self.full_duplicates = []
-
-        self.executor = None
-        self.results = []
-        self.allow_work = True
-
-    def create_executor(self):
-        self.executor = ProcessPoolExecutor(max_workers=settings.value('max_cores', os.cpu_count() or 1, int))
-        self.results = []
-
-    def run(self):
-        self.process_signal.emit(self._progress)
-
-        with database:
-            database.create_tables([ProcessedImage])
-        ProcessedImage.delete().execute()
-
-        self.__create_images_hash()
-        self.duplicates = self.__find_duplicates()
-        self.full_duplicates = self.__find_full_duplicates()
-
-        sorting_mode = settings.value('sorting_mode', 'h-l', str)
-
-        if sorting_mode == 'h-l':
-            self.duplicates = sorted(self.duplicates, key=self.__calculate_average_difference)
-        elif sorting_mode == 'l-h':
-            self.duplicates = sorted(self.duplicates, key=self.__calculate_average_difference, reverse=True)
-
-        self.process_signal.emit(100)
-
-    def __calculate_average_difference(self, group):
-        differences = []
-        for i in range(len(group)):
-            for j in range(i + 1, len(group)):
-                img1_hash = ProcessedImage.select().where(ProcessedImage.id == group[i]).dicts().get()['image_hash']
-                img2_hash = ProcessedImage.select().where(ProcessedImage.id == group[j]).dicts().get()['image_hash']
-
-                differences.append(_get_hash(img1_hash) - _get_hash(img2_hash))
-
-        return sum(differences) / len(differences)
-
-    def __create_images_hash(self, max_progress: int = 60):
-        self.create_executor()
-
-        algorithm_str = settings.value('algorithm', 'rhash', str)
-        algorithm = algorithms[algorithm_str]
-        use_crop_resistant_hash = settings.value('use_crop_resistant_hash', False, bool)
-        hash_size = settings.value('hash_size', 8, int)
-
-        iterations = count_files(self._path, settings.value('check_subdirectories', False, bool))
-        files = file_generator(self._path, settings.value('check_subdirectories', False, bool))
-        if iterations > 1 and self.allow_work:
-            step = max_progress / iterations
-            self.results = [self.executor.submit(_create_hash, filepath, algorithm, algorithm_str, hash_size, use_crop_resistant_hash) for filepath in files]
-            for _ in as_completed(self.results):
-                self._processed_images += 1
-                self._progress += step
-                self.process_signal.emit(self._progress)
-        else:
-            self._progress += max_progress
-            self.process_signal.emit(self._progress)
-
-        self.executor.shutdown()
-
-    def __find_duplicates_old(self, max_progress: int = 20):
-        if self._processed_images and self.allow_work:
-            step = max_progress / ((self._processed_images - 1) * self._processed_images // 2)
-            threshold = settings.value('duplicate_threshold', 97.0, float)
-            duplicates = {}
-
-            for current_image_idx in range(self._processed_images):
-                current_image = ProcessedImage.select().where(ProcessedImage.id == current_image_idx + 1).dicts().get()
-                current_hash = _get_hash(current_image['image_hash'])
-
-                for other_image_idx in range(current_image_idx + 1, self._processed_images):
-                    other_image = ProcessedImage.select().where(ProcessedImage.id == other_image_idx + 1).dicts().get()
-                    other_hash = _get_hash(other_image['image_hash'])
-                    difference = current_hash - other_hash
-
-                    if (1 - difference) >= round(threshold / 100, 2):
-                        duplicates[current_image_idx] = duplicates.get(current_image_idx, []) + [current_image, other_image]
-
-                    self._progress += step
-                    self.process_signal.emit(self._progress)
-
-            return self.__group_duplicates(list(duplicates.values()))
-
-        self._progress += max_progress
-        self.process_signal.emit(self._progress)
-
-        return self.__group_duplicates([])
-
-    def __find_duplicates(self, max_progress: int = 20):
-        if self._processed_images and self.allow_work:
-            self.create_executor()
-
-            step = max_progress / ((self._processed_images - 1) * self._processed_images // 2)
-            threshold = settings.value('duplicate_threshold', 97.0, float)
-            duplicates = []
-
-            ids = ID_generator(self._processed_images)
-            self.results = [self.executor.submit(_compare_images, id1, id2, threshold) for id1, id2, in ids]
-            for future in as_completed(self.results):
-                result = future.result()
-                if result is not None:
-                    duplicates.append(result)
-                self._progress += step
-                self.process_signal.emit(self._progress)
-
-            self.executor.shutdown()
-            return self.__group_duplicates(duplicates)
-
-        self._progress += max_progress
-        self.process_signal.emit(self._progress)
-
-        return self.__group_duplicates([])
-
-    def __find_full_duplicates(self, max_progress: int = 10):
-        if self.allow_work:
-            full_duplicates = {}
-            subquery_hash = (ProcessedImage
-                             .select(ProcessedImage.image_hash)
-                             .group_by(ProcessedImage.image_hash)
-                             .having(peewee.fn.COUNT(ProcessedImage.image_hash) > 1))
-
-            duplicates = list(ProcessedImage.select().where(ProcessedImage.image_hash.in_(subquery_hash)).dicts())
-            if len(duplicates):
-                step = max_progress / len(duplicates)
-
-                for image in duplicates:
-                    full_duplicates[image['image_hash']] = full_duplicates.get(image['image_hash'], []) + [image['id']]
-
-                    self._progress += step
-                    self.process_signal.emit(self._progress)
-
-                return self.__group_duplicates(list(full_duplicates.values()))
-
-        self._progress += max_progress
-        self.process_signal.emit(self._progress)
-
-        return self.__group_duplicates([])
-
-    def __group_duplicates(self, duplicates, max_progress: int = 5):
-        if len(duplicates):
-            step = max_progress / len(duplicates)
-            groups = {}
-
-            for duplicate_group in duplicates:
-                duplicate_group_key = set([image_id for image_id in duplicate_group])
-                to_union = []
-                for key in groups.keys():
-                    if not duplicate_group_key.isdisjoint(set(key)):
-                        to_union.append(key)
-
-                if len(to_union):
-                    new_key = duplicate_group_key
-                    group = duplicate_group
-
-                    for key in to_union:
-                        new_key = new_key.union(key)
-                        old_group = groups.pop(key)
-                        for duplicate in old_group:
-                            if duplicate not in group:
-                                group.append(duplicate)
-
-                    groups[tuple(new_key)] = group
-
-                else:
-                    groups[tuple(duplicate_group_key)] = duplicate_group
-
-                self._progress += step
-                self.process_signal.emit(self._progress)
-
-            return list(groups.values())
-
-        self._progress += max_progress
-        self.process_signal.emit(self._progress)
-
-        return []
-
-    def stop(self):
-        for future in self.results:
-            future.cancel()
-
-        self.executor.shutdown(wait=False)
-        self.allow_work = False
-
-
 class PreviewProcessedImage(QtWidgets.QPushButton):
-    def __init__(self, duplicates_list, processed_image_id):
+    def __init__(self, duplicates_list, processed_image):
         QtWidgets.QPushButton.__init__(self)
         self.duplicates_list = duplicates_list
 
-        self.processed_image = ProcessedImage.select().where(ProcessedImage.id == processed_image_id).dicts().get()
+        self.processed_image = processed_image
         self.setSizePolicy(QtWidgets.QSizePolicy.Policy.Expanding,
                            QtWidgets.QSizePolicy.Policy.Minimum)
 
@@ -429,7 +67,7 @@ class PreviewProcessedImage(QtWidgets.QPushButton):
         self.resolution = QtWidgets.QLabel(font=text_font)
         self.dpi = QtWidgets.QLabel(font=text_font)
         self.image_size = QtWidgets.QLabel(font=text_font)
-        self.selected = QtWidgets.QCheckBox()
+        self.selected = QtWidgets.QCheckBox(checked=self.processed_image['id'] in self.duplicates_list)
 
         copy_path_button = QtWidgets.QPushButton()
         copy_path_button_icon = self.style().standardIcon(QtWidgets.QStyle.SP_DialogSaveButton)
@@ -444,6 +82,10 @@ class PreviewProcessedImage(QtWidgets.QPushButton):
         if settings.value('show_filename', True, bool):
             self.filname.setText(os.path.split(self.processed_image['image_path'])[1])
 
+        if self.processed_image['image_role'] == 'reference':
+            self.filname.setText(f'{self.filname.text()} (reference)')
+            self.selected.setDisabled(True)
+
         if settings.value('show_file_size', False, bool):
             self.image_size.setText(f'Size {round(self.processed_image["image_size"], 2)} MB')
 
@@ -466,6 +108,8 @@ class PreviewProcessedImage(QtWidgets.QPushButton):
         self.pressed.connect(self._select)
 
     def _select(self):
+        if self.processed_image['image_role'] == 'reference':
+            return
         if self.processed_image['id'] in self.duplicates_list:
             self.duplicates_list.remove(self.processed_image['id'])
             self.selected.setChecked(False)
@@ -476,6 +120,7 @@ class PreviewProcessedImage(QtWidgets.QPushButton):
 
 class ProcessPage(QtWidgets.QWidget):
     signal = QtCore.Signal(dict)
+    groups_signal = QtCore.Signal(list, object)
 
     def __init__(self) -> None:
         QtWidgets.QWidget.__init__(self)
@@ -493,13 +138,23 @@ class ProcessPage(QtWidgets.QWidget):
         folder_path_layout.addWidget(self.folder_path, 1, 0)
         folder_path_layout.addWidget(folder_path_change_button, 1, 1)
         self.progress = QtWidgets.QProgressBar(value=0.0, font=text_font)
+        self.skipped = QtWidgets.QLabel(font=text_font)
+        self.groups = QtWidgets.QLabel(font=text_font)
 
         self.button_start = QtWidgets.QPushButton('Process', font=text_font)
         self.button_start.clicked.connect(self.start_processing)
+        self.button_watch = QtWidgets.QPushButton('Watch', font=text_font)
+        self.button_watch.clicked.connect(self.toggle_watching)
+
+        buttons_layout = QtWidgets.QHBoxLayout()
+        buttons_layout.addWidget(self.button_start)
+        buttons_layout.addWidget(self.button_watch)
 
         layout.addLayout(folder_path_layout, 0, 0, 2, 2)
         layout.addWidget(self.progress, 2, 0, 1, 2)
-        layout.addWidget(self.button_start, 3, 0, 1, 2, alignment=QtCore.Qt.AlignmentFlag.AlignCenter)
+        layout.addLayout(buttons_layout, 3, 0, 1, 2, alignment=QtCore.Qt.AlignmentFlag.AlignCenter)
+        layout.addWidget(self.skipped, 4, 0, 1, 2, alignment=QtCore.Qt.AlignmentFlag.AlignCenter)
+        layout.addWidget(self.groups, 5, 0, 1, 2, alignment=QtCore.Qt.AlignmentFlag.AlignCenter)
 
         layout.setAlignment(QtCore.Qt.AlignmentFlag.AlignTop)
         layout.setSpacing(20)
@@ -508,41 +163,83 @@ class ProcessPage(QtWidgets.QWidget):
 
         self.duplicates = []
         self.find_duplicates_thread = None
+        self.watch_duplicates_thread = None
 
     def select_path(self):
         self.folder_path.setText(QtWidgets.QFileDialog.getExistingDirectory(self, 'Select directory with images'))
 
     def start_processing(self):
         if os.path.exists(self.folder_path.text()):
+            import scanner
             self.button_start.setDisabled(True)
-            self.find_duplicates_thread = FindDuplicatesThread(self.folder_path.text())
+            self.button_watch.setDisabled(True)
+            self.find_duplicates_thread = scanner.FindDuplicatesThread(self.folder_path.text())
             self.find_duplicates_thread.process_signal.connect(self.change_progress)
+            self.find_duplicates_thread.group_signal.connect(self.groups_signal.emit)
             self.find_duplicates_thread.start()
 
     def change_progress(self, value):
         self.progress.setValue(value)
         self.progress.setFormat(f'{value:.2f} %')
         if value == 100:
+            import scanner
             duplicates, full_duplicates = self.find_duplicates_thread.duplicates, self.find_duplicates_thread.full_duplicates
+            skipped = self.find_duplicates_thread.skipped
+            self.skipped.setText(f'Skipped {sum(skipped.values())} files: ' + ', '.join(f'{count} {reason}' for reason, count in skipped.items()) if skipped else '')
+            distribution = scanner.group_size_distribution(duplicates)
+            self.groups.setText(f'{len(duplicates)} groups by size: ' + ', '.join(f'{count} of {size}' for size, count in distribution.items()) if duplicates else '')
+            catalog = self.find_duplicates_thread.catalog
             self.find_duplicates_thread = None
-            self.parent()._pre_process_duplicates(self.folder_path.text(), duplicates, full_duplicates)
+            # the main window may show the live results instead of this page by now
+            self.signal.emit({'folder_path': self.folder_path.text(), 'duplicates': duplicates, 'full_duplicates': full_duplicates, 'catalog': catalog})
 
             self.button_start.setDisabled(False)
+            self.button_watch.setDisabled(False)
+
+    def toggle_watching(self):
+        if self.watch_duplicates_thread is None:
+            if os.path.exists(self.folder_path.text()):
+                import scanner
+                self.button_start.setDisabled(True)
+                self.button_watch.setText('Stop watching')
+                self.progress.setFormat('Watching, 0 groups queued')
+                self.watch_duplicates_thread = scanner.WatchDuplicatesThread(self.folder_path.text())
+                self.watch_duplicates_thread.group_signal.connect(self.change_queued)
+                self.watch_duplicates_thread.start()
+        else:
+            self.watch_duplicates_thread.stop()
+            self.watch_duplicates_thread.wait()
+            queued = self.watch_duplicates_thread.queued
+            self.watch_duplicates_thread = None
+
+            self.button_start.setDisabled(False)
+            self.button_watch.setText('Watch')
+            self.progress.setFormat(f'{self.progress.value():.2f} %')
+            if queued:
+                self.parent().set_page('result_page', folder_path=self.folder_path.text(), duplicates=queued)
+
+    def change_queued(self, _):
+        if self.watch_duplicates_thread is not None:
+            self.progress.setFormat(f'Watching, {len(self.watch_duplicates_thread.queued)} groups queued')
 
 
 class ResultPage(QtWidgets.QWidget):
     signal = QtCore.Signal(dict)
 
-    def __init__(self, folder_path, duplicates) -> None:
+    def __init__(self, folder_path, duplicates, catalog=None, scan=None) -> None:
         QtWidgets.QWidget.__init__(self)
+        import scanner
         self.folder_path = folder_path
         self.duplicates = duplicates
+        self.catalog = catalog if catalog is not None else scanner.ImageCatalog.load(scanner.ProcessedImage, [image_id for group in duplicates for image_id in group])
         self.duplicates_list = []
         self.previews = []
+        self.rows = 0
+        self.scan = scan
 
         self._page = 0
         pagination = settings.value('pagination', 'all', str)
-        self._pagination = int(pagination) if pagination != 'all' else len(duplicates)
+        self._pagination = int(pagination) if pagination != 'all' else None
 
         self.preview_layout = QtWidgets.QGridLayout()
         self.preview_layout.setAlignment(QtCore.Qt.AlignmentFlag.AlignTop)
@@ -563,10 +260,16 @@ class ResultPage(QtWidgets.QWidget):
         buttons_layout = QtWidgets.QHBoxLayout()
         button_cancel = QtWidgets.QPushButton('Cancel', font=text_font)
         button_cancel.clicked.connect(lambda _: self.signal.emit(True))
-        button_continue = QtWidgets.QPushButton('Continue', font=text_font)
-        button_continue.clicked.connect(self._process)
+        self.button_continue = QtWidgets.QPushButton('Continue', font=text_font)
+        self.button_continue.clicked.connect(self._process)
         buttons_layout.addWidget(button_cancel)
-        buttons_layout.addWidget(button_continue)
+        buttons_layout.addWidget(self.button_continue)
+
+        # groups found so far are shown while the scan goes on, files are processed once it is done
+        self.progress = QtWidgets.QProgressBar(value=0.0, font=text_font, visible=scan is not None)
+        self.button_continue.setDisabled(scan is not None)
+        if scan is not None:
+            scan.process_signal.connect(self._change_progress)
 
         pagination_buttons_layout = QtWidgets.QHBoxLayout()
         self.button_previous = QtWidgets.QPushButton('Previous', font=text_font)
@@ -582,16 +285,48 @@ class ResultPage(QtWidgets.QWidget):
         layout.addWidget(self.scroll, 1, 0, 9, 4)
         layout.addLayout(buttons_layout, 10, 3)
         layout.addLayout(pagination_buttons_layout, 10, 0)
+        layout.addWidget(self.progress, 11, 0, 1, 4)
         self.setLayout(layout)
 
         self.update_page()
 
+    @property
+    def pagination(self):
+        return self._pagination or max(len(self.duplicates), 1)
+
     @property
     def max_page(self):
         if len(self.duplicates):
-            return math.ceil(len(self.duplicates) / self._pagination) - 1
+            return math.ceil(len(self.duplicates) / self.pagination) - 1
         return 0
 
+    def _change_progress(self, value):
+        self.progress.setValue(value)
+        self.progress.setFormat(f'{value:.2f} %')
+
+    def append_groups(self, groups, catalog):
+        # a group replaces the groups it grew out of, the page is only rebuilt when its groups changed
+        self.catalog = self.catalog.merge(catalog)
+        start = self._page * self.pagination
+        shown = self.duplicates[start: start + self.rows]
+        for group in groups:
+            members = set(group)
+            self.duplicates = [duplicate_group for duplicate_group in self.duplicates if members.isdisjoint(duplicate_group)] + [group]
+
+        if self.duplicates[start: start + self.rows] == shown:
+            self.add_previews()
+        else:
+            self.update_page()
+
+    def finish(self, duplicates, catalog):
+        self.scan = None
+        self.catalog = self.catalog.merge(catalog)
+        self.duplicates = duplicates
+        self.progress.setVisible(False)
+        self.button_continue.setDisabled(False)
+        self._page = min(self._page, self.max_page)
+        self.update_page()
+
     def _previous_page(self):
         self._page -= 1
         self.update_page()
@@ -608,10 +343,13 @@ class ResultPage(QtWidgets.QWidget):
         for preview in self.previews:
             preview.deleteLater()
         self.previews.clear()
+        self.rows = 0
 
     def update_page(self):
         self.clear_previews()
+        self.add_previews()
 
+    def add_previews(self):
         self.button_previous.setDisabled(False)
         self.button_next.setDisabled(False)
         if self._page == 0:
@@ -619,11 +357,13 @@ class ResultPage(QtWidgets.QWidget):
         if self._page == self.max_page:
             self.button_next.setDisabled(True)
 
-        for i, duplicate_group in enumerate(self.duplicates[self._page * self._pagination: (self._page + 1) * self._pagination]):
+        start = self._page * self.pagination
+        for i, duplicate_group in enumerate(self.duplicates[start + self.rows: start + self.pagination], self.rows):
             for j, duplicate_id in enumerate(duplicate_group):
-                preview = PreviewProcessedImage(self.duplicates_list, duplicate_id)
+                preview = PreviewProcessedImage(self.duplicates_list, self.catalog.get(duplicate_id))
                 self.previews.append(preview)
                 self.preview_layout.addWidget(preview, i, j)
+            self.rows += 1
 
 
 class SettingsPage(QtWidgets.QWidget):
@@ -670,7 +410,7 @@ class SettingsPage(QtWidgets.QWidget):
         self.check_subdirectories = QtWidgets.QRadioButton(font=text_font, text="Check subdirectories", checked=settings.value('check_subdirectories', False, bool))
 
         self.algorithm = QtWidgets.QComboBox(font=text_font)
-        self.algorithm.addItems(['rhash', 'phash', 'ahash', 'dhash'])
+        self.algorithm.addItems(['rhash', 'phash', 'ahash', 'dhash', 'colorhash'])
         self.algorithm.setCurrentText(settings.value('algorithm', 'rhash', str))
 
         self.use_crop_resistant_hash = QtWidgets.QRadioButton(font=text_font, text="Use crop resistant hash", checked=settings.value('use_crop_resistant_hash', False, bool))
@@ -748,6 +488,86 @@ class SettingsPage(QtWidgets.QWidget):
         pagination_layout.addWidget(pagination_label)
         pagination_layout.addWidget(self.pagination)
 
+        performance_group_layout = QtWidgets.QGridLayout()
+        performance_group = QtWidgets.QGroupBox(font=title_font, title='Performance')
+        performance_group.setLayout(performance_group_layout)
+        comparison_mode_label = QtWidgets.QLabel('Comparison mode', font=text_font)
+        self.comparison_mode = QtWidgets.QComboBox(font=text_font)
+        self.comparison_mode.addItems(['pairwise', 'shared-memory', 'out-of-core'])
+        self.comparison_mode.setCurrentText(settings.value('comparison_mode', 'pairwise', str))
+        memory_budget_label = QtWidgets.QLabel('Memory budget, MB', font=text_font)
+        self.memory_budget = QtWidgets.QSpinBox(minimum=64, maximum=1048576, value=settings.value('memory_budget', 1024, int), font=text_font)
+        self.memory_budget.setSingleStep(64)
+        preprocessing_mode_label = QtWidgets.QLabel('Preprocessing', font=text_font)
+        self.preprocessing_mode = QtWidgets.QComboBox(font=text_font)
+        self.preprocessing_mode.addItems(['filter-resize', 'resize-filter'])
+        self.preprocessing_mode.setCurrentText(settings.value('preprocessing_mode', 'filter-resize', str))
+        hashing_engine_label = QtWidgets.QLabel('Hashing engine', font=text_font)
+        self.hashing_engine = QtWidgets.QComboBox(font=text_font)
+        self.hashing_engine.addItems(['process', 'thread'])
+        self.hashing_engine.setCurrentText(settings.value('hashing_engine', 'process', str))
+        performance_group_layout.addWidget(comparison_mode_label, 0, 0)
+        performance_group_layout.addWidget(self.comparison_mode, 0, 1)
+        performance_group_layout.addWidget(memory_budget_label, 1, 0)
+        performance_group_layout.addWidget(self.memory_budget, 1, 1)
+        self.use_thumbnail_hashing = QtWidgets.QCheckBox(font=text_font, text='Hash EXIF thumbnails', checked=settings.value('use_thumbnail_hashing', False, bool))
+        performance_group_layout.addWidget(preprocessing_mode_label, 2, 0)
+        performance_group_layout.addWidget(self.preprocessing_mode, 2, 1)
+        performance_group_layout.addWidget(self.use_thumbnail_hashing, 3, 0, 1, 2)
+        read_ahead_depth_label = QtWidgets.QLabel('Read ahead (files)', font=text_font)
+        self.read_ahead_depth = QtWidgets.QSpinBox(minimum=0, maximum=256, value=settings.value('read_ahead_depth', 0, int), font=text_font)
+        performance_group_layout.addWidget(read_ahead_depth_label, 4, 0)
+        performance_group_layout.addWidget(self.read_ahead_depth, 4, 1)
+        self.use_hash_cascade = QtWidgets.QCheckBox(font=text_font, text='Use hash cascade', checked=settings.value('use_hash_cascade', False, bool))
+        self.cascade_hash_size = QtWidgets.QComboBox(font=text_font)
+        self.cascade_hash_size.addItems([str(2 ** i) for i in (2, 3, 4, 5, 6)])
+        self.cascade_hash_size.setCurrentText(str(settings.value('cascade_hash_size', 8, int)))
+        cascade_threshold_label = QtWidgets.QLabel('Cascade threshold', font=text_font)
+        self.cascade_threshold = QtWidgets.QDoubleSpinBox(minimum=10, maximum=100, value=settings.value('cascade_threshold', 85.0, float), font=text_font)
+        cascade_hash_label = QtWidgets.QLabel('Cascade hash', font=text_font)
+        self.cascade_hash = QtWidgets.QComboBox(font=text_font)
+        self.cascade_hash.addItems(['structure', 'color'])
+        self.cascade_hash.setCurrentText(settings.value('cascade_hash', 'structure', str))
+        performance_group_layout.addWidget(hashing_engine_label, 0, 2)
+        performance_group_layout.addWidget(self.hashing_engine, 0, 3)
+        performance_group_layout.addWidget(self.use_hash_cascade, 1, 2)
+        performance_group_layout.addWidget(self.cascade_hash_size, 1, 3)
+        performance_group_layout.addWidget(cascade_threshold_label, 2, 2)
+        performance_group_layout.addWidget(self.cascade_threshold, 2, 3)
+        performance_group_layout.addWidget(cascade_hash_label, 3, 2)
+        performance_group_layout.addWidget(self.cascade_hash, 3, 3)
+        grouping_mode_label = QtWidgets.QLabel('Grouping', font=text_font)
+        self.grouping_mode = QtWidgets.QComboBox(font=text_font)
+        self.grouping_mode.addItems(['connected', 'leader'])
+        self.grouping_mode.setCurrentText(settings.value('grouping_mode', 'connected', str))
+        max_group_size_label = QtWidgets.QLabel('Max group size', font=text_font)
+        self.max_group_size = QtWidgets.QSpinBox(minimum=2, maximum=100000, value=settings.value('max_group_size', 50, int), font=text_font)
+        performance_group_layout.addWidget(grouping_mode_label, 4, 2)
+        performance_group_layout.addWidget(self.grouping_mode, 4, 3)
+        performance_group_layout.addWidget(max_group_size_label, 5, 2)
+        performance_group_layout.addWidget(self.max_group_size, 5, 3)
+        # calibrated on a sample of the scanned folder, replaces the hand set cores, engine and read ahead
+        self.auto_tune = QtWidgets.QCheckBox(font=text_font, text='Auto-tune workers', checked=settings.value('auto_tune', False, bool))
+        self.auto_tune.toggled.connect(self._toggle_auto_tune)
+        self._toggle_auto_tune(self.auto_tune.isChecked())
+        performance_group_layout.addWidget(self.auto_tune, 5, 0, 1, 2)
+
+        library_roots_group_layout = QtWidgets.QGridLayout()
+        library_roots_group = QtWidgets.QGroupBox(font=title_font, title='Libraries')
+        library_roots_group.setLayout(library_roots_group_layout)
+        self.library_roots = QtWidgets.QListWidget(font=text_font)
+        self.library_roots.addItems(settings.value('library_roots', [], list))
+        add_reference_button = QtWidgets.QPushButton('Add reference', font=text_font)
+        add_reference_button.clicked.connect(lambda _: self._add_library_root('reference'))
+        add_incoming_button = QtWidgets.QPushButton('Add incoming', font=text_font)
+        add_incoming_button.clicked.connect(lambda _: self._add_library_root('incoming'))
+        remove_library_root_button = QtWidgets.QPushButton('Remove', font=text_font)
+        remove_library_root_button.clicked.connect(lambda _: self.library_roots.takeItem(self.library_roots.currentRow()))
+        library_roots_group_layout.addWidget(self.library_roots, 0, 0, 1, 3)
+        library_roots_group_layout.addWidget(add_reference_button, 1, 0)
+        library_roots_group_layout.addWidget(add_incoming_button, 1, 1)
+        library_roots_group_layout.addWidget(remove_library_root_button, 1, 2)
+
         buttons_layout = QtWidgets.QHBoxLayout()
         button_cancel = QtWidgets.QPushButton('Cancel', font=text_font)
         button_cancel.clicked.connect(lambda _: self.signal.emit(True))
@@ -769,13 +589,24 @@ class SettingsPage(QtWidgets.QWidget):
         layout.addWidget(view_settings_group, 7, 0, 3, 3)
         layout.addLayout(image_preview_size_layout, 7, 3, 2, 3)
         layout.addLayout(pagination_layout, 9, 3, 1, 3)
-        layout.addLayout(buttons_layout, 10, 4, 1, 2)
+        layout.addWidget(performance_group, 10, 0, 2, 6)
+        layout.addWidget(library_roots_group, 12, 0, 2, 6)
+        layout.addLayout(buttons_layout, 14, 4, 1, 2)
 
         layout.setAlignment(QtCore.Qt.AlignmentFlag.AlignTop)
         layout.setSpacing(20)
 
         self.setLayout(layout)
 
+    def _toggle_auto_tune(self, checked):
+        for widget in (self.max_cores, self.hashing_engine, self.read_ahead_depth):
+            widget.setEnabled(not checked)
+
+    def _add_library_root(self, role):
+        path = QtWidgets.QFileDialog.getExistingDirectory(self, f'Select {role} library')
+        if path:
+            self.library_roots.addItem(f'{role}:{path}')
+
     def _save(self):
         action_mode_value = 'manual'
         duplicates_action_value = 'move'
@@ -813,6 +644,20 @@ class SettingsPage(QtWidgets.QWidget):
         settings.setValue('show_additional_info', self.view_settings_show_additional_info.isChecked())
         settings.setValue('image_preview_size', self.image_preview_size.value())
         settings.setValue('pagination', self.pagination.currentText())
+        settings.setValue('comparison_mode', self.comparison_mode.currentText())
+        settings.setValue('memory_budget', self.memory_budget.value())
+        settings.setValue('read_ahead_depth', self.read_ahead_depth.value())
+        settings.setValue('hashing_engine', self.hashing_engine.currentText())
+        settings.setValue('auto_tune', self.auto_tune.isChecked())
+        settings.setValue('preprocessing_mode', self.preprocessing_mode.currentText())
+        settings.setValue('use_thumbnail_hashing', self.use_thumbnail_hashing.isChecked())
+        settings.setValue('use_hash_cascade', self.use_hash_cascade.isChecked())
+        settings.setValue('cascade_hash_size', int(self.cascade_hash_size.currentText()))
+        settings.setValue('cascade_threshold', self.cascade_threshold.value())
+        settings.setValue('cascade_hash', self.cascade_hash.currentText())
+        settings.setValue('grouping_mode', self.grouping_mode.currentText())
+        settings.setValue('max_group_size', self.max_group_size.value())
+        settings.setValue('library_roots', [self.library_roots.item(i).text() for i in range(self.library_roots.count())])
 
         self.signal.emit(True)
 
@@ -826,20 +671,28 @@ class MainWindow(QtWidgets.QMainWindow):
         self._create_menu()
 
         self._process_page = ProcessPage()
+        self._process_page.signal.connect(lambda kwargs: self._pre_process_duplicates(**kwargs))
+        self._process_page.groups_signal.connect(self._stream_duplicates)
+        self._streamed_scan = None
+        self._estimate_scan_thread = None
         self.set_page('process_page')
 
     def _create_menu(self):
         self.action_open_folder = QtGui.QAction('Open folder')
         self.action_open_settings = QtGui.QAction('App settings')
+        self.action_export_hashes = QtGui.QAction('Export hashes')
+        self.action_estimate_scan = QtGui.QAction('Estimate scan')
         self.action_exit = QtGui.QAction('Exit')
 
         self.action_open_folder.triggered.connect(lambda _: self._process_page.select_path())
         self.action_open_settings.triggered.connect(lambda _: self.set_page('settings_page'))
+        self.action_export_hashes.triggered.connect(lambda _: self._export_hashes())
+        self.action_estimate_scan.triggered.connect(lambda _: self._estimate_scan())
         self.action_exit.triggered.connect(lambda _: self.close())
 
         self.file_menu = QtWidgets.QMenu()
         self.file_menu.setTitle('File')
-        self.file_menu.addActions([self.action_open_folder, self.action_open_settings])
+        self.file_menu.addActions([self.action_open_folder, self.action_open_settings, self.action_export_hashes, self.action_estimate_scan])
         self.file_menu.addSeparator()
         self.file_menu.addAction(self.action_exit)
 
@@ -861,7 +714,7 @@ class MainWindow(QtWidgets.QMainWindow):
                 settings_page = SettingsPage()
                 settings_page.signal.connect(lambda _: self.set_page('process_page'))
                 self.setCentralWidget(settings_page)
-                self.setFixedSize(740, 660)
+                self.setFixedSize(740, 1000)
 
             case 'result_page':
                 result_page = ResultPage(**kwargs)
@@ -873,7 +726,20 @@ class MainWindow(QtWidgets.QMainWindow):
                 self.resize(600, 400)
                 self.showNormal()
 
-    def _pre_process_duplicates(self, folder_path, duplicates, full_duplicates):
+    def _stream_duplicates(self, groups, catalog):
+        # only manual mode shows every group, the other modes act on the final groups
+        if settings.value('action_mode', 'manual', str) != 'manual':
+            return
+        scan = self._process_page.find_duplicates_thread
+        if isinstance(self.centralWidget(), ResultPage) and self.centralWidget().scan is scan:
+            self.centralWidget().append_groups(groups, catalog)
+        elif isinstance(self.centralWidget(), ProcessPage) and self._streamed_scan is not scan:
+            # a live page that was left is not opened again for the same scan
+            self._streamed_scan = scan
+            self.set_page('result_page', folder_path=self._process_page.folder_path.text(), duplicates=groups, catalog=catalog, scan=scan)
+
+    def _pre_process_duplicates(self, folder_path, duplicates, full_duplicates, catalog=None):
+        import scanner
         duplicates_action = settings.value('duplicates_action', 'move', str)
         action_mode = settings.value('action_mode', 'manual', str)
         if action_mode in ('semi-auto', 'auto'):
@@ -882,48 +748,94 @@ class MainWindow(QtWidgets.QMainWindow):
                 os.makedirs(path_to_duplicates, exist_ok=True)
 
                 if action_mode == 'semi-auto':
-                    move_groups(full_duplicates, path_to_duplicates)
-                    duplicates = update_groups(duplicates, set([image_id for group in full_duplicates for image_id in group]))
+                    scanner.move_groups(full_duplicates, path_to_duplicates, catalog)
+                    duplicates = scanner.update_groups(duplicates, set([image_id for group in full_duplicates for image_id in group]))
                 elif action_mode == 'auto':
-                    move_groups(duplicates, path_to_duplicates)
+                    scanner.move_groups(duplicates, path_to_duplicates, catalog)
 
             elif duplicates_action == 'delete':
                 if action_mode == 'semi-auto':
-                    remove_groups(full_duplicates)
-                    duplicates = update_groups(duplicates, set([image_id for group in full_duplicates for image_id in group]))
+                    scanner.remove_groups(full_duplicates, catalog)
+                    duplicates = scanner.update_groups(duplicates, set([image_id for group in full_duplicates for image_id in group]))
 
                 elif action_mode == 'auto':
-                    remove_groups(duplicates)
+                    scanner.remove_groups(duplicates, catalog)
 
-        if action_mode in ('manual', 'semi-auto'):
-            self.set_page('result_page', folder_path=folder_path, duplicates=duplicates)
+        if action_mode == 'manual' and isinstance(self.centralWidget(), ResultPage) and self.centralWidget().scan is not None:
+            self.centralWidget().finish(duplicates, catalog)
+        elif action_mode in ('manual', 'semi-auto'):
+            self.set_page('result_page', folder_path=folder_path, duplicates=duplicates, catalog=catalog)
 
     def _process_duplicates(self, folder_path, duplicates):
+        import scanner
         duplicates_action = settings.value('duplicates_action', 'move', str)
         if duplicates_action == 'move':
             path_to_duplicates = os.path.join(folder_path, settings.value('duplicate_folder_name', 'Duplicates', str))
             os.makedirs(path_to_duplicates, exist_ok=True)
-            move_files(duplicates, path_to_duplicates)
+            scanner.move_files(duplicates, path_to_duplicates)
 
         elif duplicates_action == 'delete':
-            remove_files(duplicates)
+            scanner.remove_files(duplicates)
+
+    def _export_hashes(self):
+        # the hashes of the last scan, while its processing database is still there
+        import scanner
+        if self._process_page.find_duplicates_thread is not None or not scanner.database.table_exists(scanner.ProcessedImage._meta.table_name):
+            return
+        path, _ = QtWidgets.QFileDialog.getSaveFileName(self, 'Export hashes', '', 'NPY directory (*);;Arrow (*.arrow);;Parquet (*.parquet)')
+        if path:
+            scanner.export_catalog(scanner.ImageCatalog.load(scanner.ProcessedImage), path, scanner.current_hash_parameters())
+
+    def _estimate_scan(self):
+        # the current algorithm and hash size, with and without crop resistant hashing
+        import scanner
+        folder_path = self._process_page.folder_path.text()
+        if self._estimate_scan_thread is not None or not os.path.exists(folder_path):
+            return
+        algorithm, hash_size = settings.value('algorithm', 'rhash', str), settings.value('hash_size', 8, int)
+        self._estimate_scan_thread = scanner.EstimateScanThread([folder_path], [(algorithm, hash_size, False), (algorithm, hash_size, True)])
+        self._estimate_scan_thread.finished.connect(self._show_estimates)
+        self._estimate_scan_thread.start()
+
+    def _show_estimates(self):
+        import scanner
+        estimates = self._estimate_scan_thread.estimates
+        self._estimate_scan_thread = None
+        QtWidgets.QMessageBox.information(self, 'Scan estimate', scanner.format_estimates(estimates))
 
     def closeEvent(self, event: QtGui.QCloseEvent) -> None:
+        if self._estimate_scan_thread is not None:
+            self._estimate_scan_thread.wait()
         if self._process_page.find_duplicates_thread is not None:
             self._process_page.find_duplicates_thread.stop()
+            self._process_page.find_duplicates_thread.wait()
+        if self._process_page.watch_duplicates_thread is not None:
+            self._process_page.watch_duplicates_thread.stop()
+            self._process_page.watch_duplicates_thread.wait()
         event.accept()
 
 
 if __name__ == '__main__':
     freeze_support()
+    # anything else on the command line, like a folder opened with the app or -psn_ on macOS, starts the window
+    if len(sys.argv) > 1 and sys.argv[1] in ('shard', 'merge', 'export', 'estimate'):
+        from scanner import command_line
+        sys.exit(command_line(sys.argv[1:]))
+
     app = QtWidgets.QApplication()
     main_window = MainWindow()
     main_window.show()
     app.setStyle('Fusion')
     app.exec()
 
-    if os.path.exists(os.path.join(application_path(), 'processing.sqlite3')):
-        try:
-            os.remove(os.path.join(application_path(), 'processing.sqlite3'))
-        except Exception:
-            pass
+    # the engine is only loaded once something was scanned or watched,
+    # and an unfinished scan is resumed from the processing database on the next start
+    scanner = sys.modules.get('scanner')
+    if scanner is not None and not scanner.unfinished_scan():
+        scanner.database.close()
+        if os.path.exists(os.path.join(application_path(), 'processing.sqlite3')):
+            try:
+                os.remove(os.path.join(application_path(), 'processing.sqlite3'))
+            except Exception:
+                pass
+        shutil.rmtree(scanner.scratch_path, ignore_errors=True)
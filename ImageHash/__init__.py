@@ -3,6 +3,9 @@ from .image_hash import (  # noqa
     ImageHash,
 
     hex_to_multihash,
+    packed_distances,
+    paired_distances,
+    hex_to_packed,
     hex_to_hash,
 )
 
@@ -10,6 +13,7 @@ from .hash_functions import (  # noqa
     crop_resistant_hash,
     dhash_horizontal,
     dhash_vertical,
+    preprocess,
     colorhash,
     ahash,
     dhash,
@@ -2,6 +2,7 @@ from .image_hash import (
     ImageMultiHash,
     ImageHash
 )
+from .kernels import compiled
 from PIL import (
     ImageFilter,
     Image,
@@ -18,13 +19,28 @@ def __is_power_of_two(n) -> bool:
     return n > 0 and (n & (n - 1)) == 0
 
 
-def ahash(image: Image, hash_size: int = 8) -> ImageHash:
+def preprocess(image: Image, size: int = None, preprocessing: str = 'filter-resize', factor: int = 4, min_size: int = 256) -> Image:
+    if preprocessing == 'resize-filter' and size:
+        reduce_factor = min(image.size) // max(size * factor, min_size)
+        if reduce_factor > 1:
+            if image.mode not in ('L', 'RGB', 'RGBA'):
+                image = image.convert('RGB')
+            image = image.reduce(reduce_factor)
+
+    return image.convert('YCbCr').split()[0].filter(ImageFilter.MedianFilter())
+
+
+def _prepare(image: Image, preprocessed: bool, preprocessing: str, size: int) -> Image:
+    return image if preprocessed else preprocess(image, size, preprocessing)
+
+
+def ahash(image: Image, hash_size: int = 8, preprocessed: bool = False, preprocessing: str = 'filter-resize') -> ImageHash:
 
     if not __is_power_of_two(hash_size):
         raise ValueError('Hash size is not power of 2')
 
     # image = image.convert('L').resize((hash_size, hash_size), ANTIALIAS)
-    image = image.convert('YCbCr').split()[0].filter(ImageFilter.MedianFilter()).resize((hash_size, hash_size), ANTIALIAS)
+    image = _prepare(image, preprocessed, preprocessing, hash_size).resize((hash_size, hash_size), ANTIALIAS)
 
     pixels = np.asarray(image)
     mean = np.mean(pixels)
@@ -33,7 +49,7 @@ def ahash(image: Image, hash_size: int = 8) -> ImageHash:
     return ImageHash(diff.astype(dtype=np.int8).flatten())
 
 
-def rhash(image: Image, hash_size: int = 8, block_size: int = 4) -> ImageHash:
+def rhash(image: Image, hash_size: int = 8, block_size: int = 4, preprocessed: bool = False, preprocessing: str = 'filter-resize') -> ImageHash:
     if not __is_power_of_two(hash_size):
         raise ValueError('Hash size is not power of 2')
 
@@ -42,20 +58,13 @@ def rhash(image: Image, hash_size: int = 8, block_size: int = 4) -> ImageHash:
 
     image_size = hash_size * block_size
     # image = image.convert('L').filter(ImageFilter.GaussianBlur()).resize((image_size, image_size), ANTIALIAS)
-    image = image.convert('YCbCr').split()[0].filter(ImageFilter.MedianFilter()).resize((image_size, image_size), ANTIALIAS)
+    image = _prepare(image, preprocessed, preprocessing, image_size).resize((image_size, image_size), ANTIALIAS)
     pixels = np.asarray(image)
 
-    binary_array = []
-    for i in range(hash_size):
-        for j in range(hash_size):
-            istart, iend = i * block_size, (i + 1) * block_size
-            jstart, jend = j * block_size, (j + 1) * block_size
-
-            block = pixels[istart: iend, jstart: jend]
-            binary_array.append(np.mean(block))
+    # block sums of 8 bit pixels are exact, so the means are the same as block by block
+    binary_array = pixels.reshape(hash_size, block_size, hash_size, block_size).mean(axis=(1, 3)).flatten()
 
     mean_block_size = len(binary_array) // 4
-    binary_array = np.array(binary_array)
     means = []
     for i in range(4):
         mean = np.mean(binary_array[i * mean_block_size: (i + 1) * mean_block_size])
@@ -76,7 +85,7 @@ def rhash(image: Image, hash_size: int = 8, block_size: int = 4) -> ImageHash:
     return ImageHash(binary_array.astype(dtype=np.int8).flatten())
 
 
-def phash(image: Image, hash_size: int = 8, highfreq_factor: int = 4) -> ImageHash:
+def phash(image: Image, hash_size: int = 8, highfreq_factor: int = 4, preprocessed: bool = False, preprocessing: str = 'filter-resize') -> ImageHash:
     if not __is_power_of_two(hash_size):
         raise ValueError('Hash size is not power of 2')
 
@@ -86,7 +95,7 @@ def phash(image: Image, hash_size: int = 8, highfreq_factor: int = 4) -> ImageHa
     from scipy.fftpack import dct
 
     image_size = hash_size * highfreq_factor
-    image = image.convert('YCbCr').split()[0].filter(ImageFilter.MedianFilter()).resize((image_size, image_size), ANTIALIAS)
+    image = _prepare(image, preprocessed, preprocessing, image_size).resize((image_size, image_size), ANTIALIAS)
     # image = image.convert('L').filter(ImageFilter.MedianFilter()).resize((image_size, image_size), ANTIALIAS)
     pixels = np.asarray(image)
     dct = dct(dct(pixels, axis=0), axis=1)
@@ -97,33 +106,33 @@ def phash(image: Image, hash_size: int = 8, highfreq_factor: int = 4) -> ImageHa
     return ImageHash(diff.astype(dtype=np.int8).flatten())
 
 
-def dhash_horizontal(image: Image, hash_size: int = 8) -> ImageHash:
+def dhash_horizontal(image: Image, hash_size: int = 8, preprocessed: bool = False, preprocessing: str = 'filter-resize') -> ImageHash:
     if not __is_power_of_two(hash_size):
         raise ValueError('Hash size is not power of 2')
 
     # image = image.convert('L').resize((hash_size + 1, hash_size), ANTIALIAS)
-    image = image.convert('YCbCr').split()[0].filter(ImageFilter.MedianFilter()).resize((hash_size + 1, hash_size), ANTIALIAS)
+    image = _prepare(image, preprocessed, preprocessing, hash_size + 1).resize((hash_size + 1, hash_size), ANTIALIAS)
     pixels = np.asarray(image)
     diff = pixels[:, 1:] >= pixels[:, :-1]
 
     return ImageHash(diff.astype(dtype=np.int8).flatten())
 
 
-def dhash_vertical(image: Image, hash_size: int = 8) -> ImageHash:
+def dhash_vertical(image: Image, hash_size: int = 8, preprocessed: bool = False, preprocessing: str = 'filter-resize') -> ImageHash:
     if not __is_power_of_two(hash_size):
         raise ValueError('Hash size is not power of 2')
 
     # image = image.convert('L').resize((hash_size, hash_size + 1), ANTIALIAS)
-    image = image.convert('YCbCr').split()[0].filter(ImageFilter.MedianFilter()).resize((hash_size, hash_size + 1), ANTIALIAS)
+    image = _prepare(image, preprocessed, preprocessing, hash_size + 1).resize((hash_size, hash_size + 1), ANTIALIAS)
     pixels = np.asarray(image)
     diff = pixels[1:, :] >= pixels[:-1, :]
 
     return ImageHash(diff.astype(dtype=np.int8).flatten())
 
 
-def dhash(image: Image, hash_size: int = 16) -> ImageHash:
+def dhash(image: Image, hash_size: int = 16, preprocessed: bool = False, preprocessing: str = 'filter-resize') -> ImageHash:
     # image = image.convert('L').resize((hash_size + 1, hash_size + 1), ANTIALIAS)
-    image = image.convert('YCbCr').split()[0].filter(ImageFilter.MedianFilter()).resize((hash_size + 1, hash_size + 1), ANTIALIAS)
+    image = _prepare(image, preprocessed, preprocessing, hash_size + 1).resize((hash_size + 1, hash_size + 1), ANTIALIAS)
     pixels = np.asarray(image)
 
     diff_h = pixels[:, 1:] >= pixels[:, :-1]
@@ -133,43 +142,42 @@ def dhash(image: Image, hash_size: int = 16) -> ImageHash:
     return ImageHash(diff.astype(dtype=np.int8).flatten())
 
 
-def colorhash(image, binbits: int = 4) -> ImageHash:
+def colorhash(image: Image, binbits: int = 4, image_size: int = 128, preprocessing: str = 'filter-resize') -> ImageHash:
+    # preprocessing is only accepted so crop_resistant_hash can pass it like to the structural hashes
 
-    intensity = np.asarray(image.convert('L')).flatten()
-    h, s, v = [np.asarray(v).flatten() for v in image.convert('HSV').split()]
+    # the hash is made of pixel fractions, a box reduced copy keeps them while converting far fewer pixels
+    if image.mode not in ('L', 'RGB', 'RGBA'):
+        image = image.convert('RGB')
+    reduce_factor = min(image.size) // image_size
+    if reduce_factor > 1:
+        image = image.reduce(reduce_factor)
+    image = image.convert('RGB')
 
-    mask_black = intensity < 256 // 8
-    frac_black = mask_black.mean()
+    intensity = np.asarray(image.convert('L')).reshape(-1)
+    hsv = np.asarray(image.convert('HSV')).reshape(-1, 3)
+    h, s = hsv[:, 0], hsv[:, 1]
 
+    mask_black = intensity < 256 // 8
     mask_gray = s < 256 // 3
-    frac_gray = np.logical_and(~mask_black, mask_gray).mean()
-
-    mask_colors = np.logical_and(~mask_black, ~mask_gray)
-    mask_faint_colors = np.logical_and(mask_colors, s < 256 * 2 // 3)
-    mask_bright_colors = np.logical_and(mask_colors, s > 256 * 2 // 3)
-
-    c = max(1, mask_colors.sum())
+    mask_colors = ~mask_black & ~mask_gray
+    mask_faint_colors = mask_colors & (s < 256 * 2 // 3)
+    mask_bright_colors = mask_colors & (s > 256 * 2 // 3)
 
-    hue_bins = np.linspace(0, 255, 6 + 1)
-    if mask_faint_colors.any():
-        h_faint_counts, _ = np.histogram(h[mask_faint_colors], bins=hue_bins)
-    else:
-        h_faint_counts = np.zeros(len(hue_bins) - 1)
-    if mask_bright_colors.any():
-        h_bright_counts, _ = np.histogram(h[mask_bright_colors], bins=hue_bins)
-    else:
-        h_bright_counts = np.zeros(len(hue_bins) - 1)
+    # same bins as np.histogram over linspace(0, 255, 7), the last one includes 255
+    hue_bins = np.minimum(np.searchsorted(np.linspace(0, 255, 6 + 1), h, side='right') - 1, 5)
+    counts = np.concatenate((np.bincount(hue_bins[mask_faint_colors], minlength=6),
+                             np.bincount(hue_bins[mask_bright_colors], minlength=6)))
 
     maxvalue = 2 ** binbits
-    values = [min(maxvalue - 1, int(frac_black * maxvalue)), min(maxvalue - 1, int(frac_gray * maxvalue))]
-    for counts in list(h_faint_counts) + list(h_bright_counts):
-        values.append(min(maxvalue - 1, int(counts * maxvalue * 1. / c)))
+    fractions = np.array([mask_black.mean(), (~mask_black & mask_gray).mean()])
+    values = np.concatenate(((fractions * maxvalue).astype(np.int64),
+                             (counts * maxvalue * 1. / max(1, mask_colors.sum())).astype(np.int64)))
+    values = np.minimum(maxvalue - 1, values)
 
-    bitarray = []
-    for v in values:
-        bitarray += [v // (2 ** (binbits - i - 1)) % 2 ** (binbits - i) > 0 for i in range(binbits)]
+    positions = np.arange(binbits)
+    bits = (values[:, None] // 2 ** (binbits - positions - 1)) % 2 ** (binbits - positions) > 0
 
-    return ImageHash(np.asarray(bitarray, dtype=np.int8).reshape((-1, binbits)).flatten())
+    return ImageHash(bits.astype(np.int8).flatten())
 
 
 def _find_region(remaining_pixels, segmented_pixels):
@@ -203,7 +211,37 @@ def _find_region(remaining_pixels, segmented_pixels):
     return in_region
 
 
+def _labelled_segments(pixels, segment_threshold, min_segment_size):
+    img_width, img_height = pixels.shape
+    threshold_pixels = pixels > segment_threshold
+
+    segments = []
+    # mirrors the flood fill below, which counts the image border and every region larger than one pixel as segmented
+    # and stops looking for dark regions once that count reaches the image size or no pixel is left
+    segmented = 2 * (img_width + img_height)
+    for bright, mask in ((True, threshold_pixels), (False, np.invert(threshold_pixels))):
+        labels, count = compiled().label_regions(mask)
+        labels = labels.ravel()
+        # pixels outside the mask are labelled -1 and sort first
+        order = np.argsort(labels, kind='stable')
+        sizes = np.bincount(labels[labels >= 0], minlength=count)
+        offsets = len(labels) - sizes.sum() + np.concatenate(([0], np.cumsum(sizes)))
+        for label in range(count):
+            if not bright and segmented >= img_width * img_height:
+                break
+            if sizes[label] > min_segment_size:
+                rows, cols = np.divmod(order[offsets[label]: offsets[label + 1]], img_height)
+                segments.append(set(zip(rows.tolist(), cols.tolist())))
+            if sizes[label] > 1:
+                segmented += int(sizes[label])
+
+    return segments
+
+
 def _find_all_segments(pixels, segment_threshold, min_segment_size):
+    if compiled() is not None:
+        return _labelled_segments(pixels, segment_threshold, min_segment_size)
+
     img_width, img_height = pixels.shape
 
     threshold_pixels = pixels > segment_threshold
@@ -228,6 +266,9 @@ def _find_all_segments(pixels, segment_threshold, min_segment_size):
     threshold_pixels_i = np.invert(threshold_pixels)
     while len(already_segmented) < img_width * img_height:
         remaining_pixels = np.bitwise_and(threshold_pixels_i, unassigned_pixels)
+        # single pixel regions are not counted as segmented, so the count can stay short after the last region
+        if not remaining_pixels.any():
+            break
         segment = _find_region(remaining_pixels, already_segmented)
         if len(segment) > min_segment_size:
             segments.append(segment)
@@ -244,12 +285,17 @@ def crop_resistant_hash(
         segment_threshold: int = 128,
         min_segment_size: int = 300,
         segmentation_image_size: int = 600,
+        preprocessing: str = 'filter-resize',
         **kwargs):
 
     if hash_func is None:
         hash_func = dhash
 
     orig_image = image.copy()
+    if preprocessing == 'resize-filter':
+        reduce_factor = min(image.size) // segmentation_image_size
+        if reduce_factor > 1:
+            image = (image if image.mode in ('L', 'RGB', 'RGBA') else image.convert('RGB')).reduce(reduce_factor)
     # image = image.convert('L').resize((segmentation_image_size, segmentation_image_size), ANTIALIAS)
     image = image.convert('YCbCr').split()[0].resize((segmentation_image_size, segmentation_image_size), ANTIALIAS)
     image = image.filter(ImageFilter.GaussianBlur()).filter(ImageFilter.MedianFilter())
@@ -274,6 +320,6 @@ def crop_resistant_hash(
         max_y = (max(coord[0] for coord in segment) + 1) * scale_h
         max_x = (max(coord[1] for coord in segment) + 1) * scale_w
         bounding_box = orig_image.crop((min_x, min_y, max_x, max_y))
-        hashes.append(hash_func(bounding_box, **kwargs))
+        hashes.append(hash_func(bounding_box, preprocessing=preprocessing, **kwargs))
 
     return ImageMultiHash(hashes)
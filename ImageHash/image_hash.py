@@ -98,3 +98,47 @@ def hex_to_hash(hex_string) -> ImageHash:
 def hex_to_multihash(hex_string):
     hashes = [hex_to_hash(x) for x in hex_string.split(',')]
     return ImageMultiHash(hashes)
+
+
+_POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+
+def hex_to_packed(hex_string) -> np.ndarray:
+    if len(hex_string) % 2:
+        hex_string += '0'
+    return np.frombuffer(bytes.fromhex(hex_string), dtype=np.uint8)
+
+
+def _as_words(hashes) -> np.ndarray:
+    hashes = np.ascontiguousarray(hashes)
+    if hasattr(np, 'bitwise_count') and hashes.shape[-1] % 8 == 0:
+        return hashes.view(np.uint64)
+    return hashes
+
+
+def _popcount(xor) -> np.ndarray:
+    return np.bitwise_count(xor) if hasattr(np, 'bitwise_count') else _POPCOUNT[xor]
+
+
+def packed_distances(hashes1, hashes2, chunk_size: int = 8) -> np.ndarray:
+    hashes1, hashes2 = _as_words(hashes1), _as_words(hashes2)
+    distances = np.zeros((len(hashes1), len(hashes2)), dtype=np.uint32)
+    if hashes1.dtype == np.uint64:
+        # one word at a time keeps the xor buffer at 8 bytes per pair and avoids a reduction
+        for column in range(hashes1.shape[1]):
+            distances += _popcount(hashes1[:, None, column] ^ hashes2[None, :, column])
+        return distances
+
+    for start in range(0, hashes1.shape[1], chunk_size):
+        xor = hashes1[:, None, start: start + chunk_size] ^ hashes2[None, :, start: start + chunk_size]
+        distances += _popcount(xor).sum(axis=2, dtype=np.uint32)
+    return distances
+
+
+def paired_distances(hashes1, hashes2, chunk_size: int = 65536) -> np.ndarray:
+    hashes1, hashes2 = _as_words(hashes1), _as_words(hashes2)
+    distances = np.empty(len(hashes1), dtype=np.uint32)
+    for start in range(0, len(hashes1), chunk_size):
+        xor = hashes1[start: start + chunk_size] ^ hashes2[start: start + chunk_size]
+        distances[start: start + chunk_size] = _popcount(xor).sum(axis=1, dtype=np.uint32)
+    return distances
@@ -0,0 +1,67 @@
+from .image_hash import (
+    packed_distances,
+)
+import numpy as np
+
+# the compiled backend is imported on first use, so processes that never compare or segment do not pay for numba
+_compiled = None
+
+
+def compiled():
+    global _compiled
+    if _compiled is None:
+        try:
+            from . import numba_kernels
+            _compiled = numba_kernels
+        except ImportError:
+            _compiled = False
+    return _compiled or None
+
+
+def _pad_words(hashes) -> np.ndarray:
+    # zero bytes do not change a hamming distance, so every hash can be compared as whole 64 bit words
+    hashes = np.ascontiguousarray(hashes, dtype=np.uint8)
+    if hashes.shape[1] % 8:
+        hashes = np.pad(hashes, ((0, 0), (0, 8 - hashes.shape[1] % 8)))
+    return hashes.view(np.uint64)
+
+
+def numpy_tile_matches(hashes1, hashes2, max_bits, upper=False):
+    distances = packed_distances(hashes1, hashes2)
+    matches = distances <= max_bits
+    if upper:
+        matches = np.triu(matches, 1)
+
+    row_idx, col_idx = np.nonzero(matches)
+    return row_idx, col_idx, distances[row_idx, col_idx]
+
+
+def numpy_component_labels(count, edges):
+    labels = np.arange(count)
+
+    changed = True
+    while changed:
+        previous = labels.copy()
+        for idx1, idx2 in edges():
+            label = np.minimum(labels[idx1], labels[idx2])
+            np.minimum.at(labels, idx1, label)
+            np.minimum.at(labels, idx2, label)
+        while not np.array_equal(labels, labels[labels]):
+            labels = labels[labels]
+        changed = not np.array_equal(labels, previous)
+
+    return labels
+
+
+def tile_matches(hashes1, hashes2, max_bits, upper=False):
+    backend = compiled()
+    if backend is None or max_bits < 0:
+        return numpy_tile_matches(hashes1, hashes2, max_bits, upper)
+    return backend.word_matches(_pad_words(hashes1), _pad_words(hashes2), max_bits, upper)
+
+
+def component_labels(count, edges):
+    backend = compiled()
+    if backend is None:
+        return numpy_component_labels(count, edges)
+    return backend.component_labels(count, edges)
@@ -0,0 +1,110 @@
+from numba.extending import intrinsic
+import numpy as np
+import numba
+
+
+@intrinsic
+def _popcount(typingctx, word):
+    # llvm ctpop, a single popcnt instruction on the cpu numba compiles for
+    def codegen(context, builder, signature, args):
+        return builder.ctpop(args[0])
+    return word(word), codegen
+
+
+@numba.njit(cache=True, nogil=True)
+def _row_matches(words1, words2, row, start, max_bits, cols, distances):
+    found = 0
+    for col in range(start, len(words2)):
+        distance = np.uint64(0)
+        for word in range(words1.shape[1]):
+            distance += _popcount(words1[row, word] ^ words2[col, word])
+        if distance <= max_bits:
+            cols[found] = col
+            distances[found] = distance
+            found += 1
+    return found
+
+
+@numba.njit(cache=True, nogil=True)
+def _word_matches(words1, words2, max_bits, upper):
+    # matches of a row are collected apart from the growing output, which keeps the inner loop tight
+    row_cols = np.empty(len(words2), dtype=np.int64)
+    row_distances = np.empty(len(words2), dtype=np.uint32)
+    row_idx = np.empty(1024, dtype=np.int64)
+    col_idx = np.empty(1024, dtype=np.int64)
+    distances = np.empty(1024, dtype=np.uint32)
+    size = 0
+    for row in range(len(words1)):
+        found = _row_matches(words1, words2, row, row + 1 if upper else 0, np.uint64(max_bits), row_cols, row_distances)
+        if size + found > len(row_idx):
+            capacity = max(2 * len(row_idx), size + found)
+            row_idx, col_idx, distances = np.resize(row_idx, capacity), np.resize(col_idx, capacity), np.resize(distances, capacity)
+        row_idx[size: size + found] = row
+        col_idx[size: size + found] = row_cols[:found]
+        distances[size: size + found] = row_distances[:found]
+        size += found
+    return row_idx[:size].copy(), col_idx[:size].copy(), distances[:size].copy()
+
+
+def word_matches(words1, words2, max_bits, upper=False):
+    return _word_matches(words1, words2, max_bits, upper)
+
+
+@numba.njit(cache=True, nogil=True)
+def _find_root(parents, node):
+    while parents[node] != node:
+        parents[node] = parents[parents[node]]
+        node = parents[node]
+    return node
+
+
+@numba.njit(cache=True, nogil=True)
+def _union_edges(parents, idx1, idx2):
+    # the smaller index becomes the root, so labels come out the same as with label propagation
+    for edge in range(len(idx1)):
+        root1, root2 = _find_root(parents, idx1[edge]), _find_root(parents, idx2[edge])
+        if root1 < root2:
+            parents[root2] = root1
+        elif root2 < root1:
+            parents[root1] = root2
+
+
+def component_labels(count, edges):
+    parents = np.arange(count)
+    for idx1, idx2 in edges():
+        _union_edges(parents, np.asarray(idx1, dtype=np.int64), np.asarray(idx2, dtype=np.int64))
+    while not np.array_equal(parents, parents[parents]):
+        parents = parents[parents]
+    return parents
+
+
+@numba.njit(cache=True, nogil=True)
+def _label_regions(mask, height, width, labels):
+    # 4-connected regions, numbered in the order of their first pixel
+    stack = np.empty(height * width, dtype=np.int64)
+    label = 0
+    for start in range(height * width):
+        if not mask[start] or labels[start] >= 0:
+            continue
+        labels[start] = label
+        stack[0] = start
+        size = 1
+        while size:
+            size -= 1
+            row, col = divmod(stack[size], width)
+            for neighbour_row, neighbour_col in ((row - 1, col), (row + 1, col), (row, col - 1), (row, col + 1)):
+                if 0 <= neighbour_row < height and 0 <= neighbour_col < width:
+                    neighbour = neighbour_row * width + neighbour_col
+                    if mask[neighbour] and labels[neighbour] < 0:
+                        labels[neighbour] = label
+                        stack[size] = neighbour
+                        size += 1
+        label += 1
+    return label
+
+
+def label_regions(mask):
+    height, width = mask.shape
+    labels = np.full(height * width, -1, dtype=np.int64)
+    count = _label_regions(np.ascontiguousarray(mask).ravel(), height, width, labels)
+    return labels.reshape(height, width), count
@@ -0,0 +1,3 @@
+from PySide6 import QtCore
+
+settings = QtCore.QSettings('DropDup', 'settings')
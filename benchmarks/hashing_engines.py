@@ -0,0 +1,75 @@
+# hashing throughput and memory of the process and thread engines, each configuration run in a fresh interpreter
+#   python benchmarks/hashing_engines.py FOLDER [--workers 1 2 4 8] [--files 200] [--runs 3]
+import subprocess
+import statistics
+import argparse
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from image_decoder import IMAGE_EXTENSIONS
+
+CHILD = '''
+import resource
+import json
+import time
+import sys
+import scanner
+engine, workers = sys.argv[1], int(sys.argv[2])
+filepaths = json.loads(sys.stdin.read())
+algorithm_str = scanner.settings.value('algorithm', 'rhash', str)
+tuning = dict(scanner.hashing_tuning(), engine=engine, workers=workers)
+started = time.perf_counter()
+executor = scanner.create_hashing_executor(tuning)
+scheduler = scanner.create_hashing_scheduler(executor, tuning)
+hashed = 0
+for _, results in scheduler.map(scanner._hash_image, filepaths, scanner.algorithms[algorithm_str], algorithm_str, scanner.settings.value('hash_size', 8, int), False):
+    hashed += sum(1 for result in results if result is not None)
+executor.shutdown()
+seconds = time.perf_counter() - started
+# peak memory of this interpreter, and of the largest worker process, a process pool holds one of those per worker
+print(json.dumps({'seconds': seconds, 'hashed': hashed,
+                  'rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                  'worker_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024}))
+'''
+
+
+def measure(engine, workers, filepaths):
+    # pool start and shutdown are part of a scan, so they are part of the time
+    output = subprocess.run([sys.executable, '-c', CHILD, engine, str(workers)], cwd=ROOT, input=json.dumps(filepaths),
+                            capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('path')
+    parser.add_argument('--workers', type=int, nargs='+', default=sorted({1, 2, 4, os.cpu_count() or 1}))
+    parser.add_argument('--files', type=int, default=200, help='number of files hashed in every run')
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+
+    filepaths = sorted(os.path.join(root, name) for root, _, names in os.walk(args.path)
+                       for name in names if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS)[:args.files]
+    print(json.dumps({'cpus': os.cpu_count(), 'files': len(filepaths)}))
+
+    # the first run warms the file cache
+    measure('thread', 1, filepaths)
+    for workers in args.workers:
+        for engine in ('process', 'thread'):
+            started = time.perf_counter()
+            runs = [measure(engine, workers, filepaths) for _ in range(args.runs)]
+            seconds = statistics.median(run['seconds'] for run in runs)
+            print(json.dumps({'engine': engine, 'workers': workers, 'seconds': round(seconds, 3),
+                              'files_per_second': round(runs[0]['hashed'] / seconds, 1),
+                              'rss_mb': round(max(run['rss_mb'] for run in runs), 1),
+                              'worker_rss_mb': round(max(run['worker_rss_mb'] for run in runs), 1),
+                              'wall': round(time.perf_counter() - started, 1)}))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+# latency of HashIndex.query on a large index with pending inserts and deletes
+#   python benchmarks/similarity_index.py [--count 1000000] [--bits 64 256] [--queries 300]
+import statistics
+import argparse
+import json
+import time
+import sys
+import os
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from similarity_index import HashIndex
+import numpy as np
+
+# top-k and radius of every measured query
+QUERIES = [(10, 0.03), (10, 0.10), (10, 1.0)]
+
+
+def clustered_hashes(rng, count, bits, noise, cluster_size: int = 10):
+    # near duplicates of a smaller set of images, each bit flipped with the given probability
+    centers = rng.integers(0, 256, (max(1, count // cluster_size), bits // 8), dtype=np.uint8)
+    hashes = centers[rng.integers(0, len(centers), count)]
+    hashes ^= np.packbits(rng.random((count, bits)) < noise, axis=1)
+    return [image_hash.tobytes().hex() for image_hash in hashes]
+
+
+def percentile(seconds, fraction):
+    return sorted(seconds)[min(len(seconds) - 1, int(fraction * len(seconds)))] * 1000
+
+
+def measure(count, bits, pending, queries, noise, seed):
+    rng = np.random.default_rng(seed)
+    hashes = clustered_hashes(rng, count + pending, bits, noise)
+
+    index = HashIndex(capacity=count)
+    started = time.perf_counter()
+    index.add_many(range(count), hashes[:count])
+    load = time.perf_counter() - started
+
+    started = time.perf_counter()
+    index._build_tables()
+    build = time.perf_counter() - started
+
+    # inserts and deletes after the build wait in the unindexed tail and as tombstones
+    started = time.perf_counter()
+    for image_id in range(count, count + pending):
+        index.add(image_id, hashes[image_id])
+    insert = (time.perf_counter() - started) / max(pending, 1)
+    started = time.perf_counter()
+    for image_id in rng.choice(count, pending, replace=False).tolist():
+        index.remove(image_id)
+    remove = (time.perf_counter() - started) / max(pending, 1)
+
+    results = {'bits': bits, 'count': count, 'load_seconds': round(load, 2), 'build_seconds': round(build, 2),
+               'insert_us': round(insert * 1e6, 1), 'remove_us': round(remove * 1e6, 1)}
+    samples = clustered_hashes(rng, queries, bits, noise)
+    for k, max_distance in QUERIES:
+        seconds = []
+        for sample in samples:
+            started = time.perf_counter()
+            index.query(sample, k, max_distance)
+            seconds.append(time.perf_counter() - started)
+        results[f'k={k} max={max_distance}'] = {'p50_ms': round(statistics.median(seconds) * 1000, 2), 'p99_ms': round(percentile(seconds, 0.99), 2)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--count', type=int, default=1000000)
+    parser.add_argument('--bits', type=int, nargs='+', default=[64, 256])
+    parser.add_argument('--pending', type=int, default=20000, help='inserts and deletes made after the tables are built')
+    parser.add_argument('--queries', type=int, default=300)
+    parser.add_argument('--noise', type=float, default=0.01, help='probability of a flipped bit within a cluster')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    for bits in args.bits:
+        print(json.dumps(measure(args.count, bits, args.pending, args.queries, args.noise, args.seed)))
+
+
+if __name__ == '__main__':
+    main()
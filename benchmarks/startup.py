@@ -0,0 +1,54 @@
+# import time and time to first window of the GUI, each run in a fresh interpreter
+#   python benchmarks/startup.py [--runs 5] [--offscreen]
+import subprocess
+import statistics
+import argparse
+import json
+import time
+import sys
+import os
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = '''
+import json
+import time
+started = time.perf_counter()
+import DropDup
+imported = time.perf_counter()
+app = DropDup.QtWidgets.QApplication([])
+main_window = DropDup.MainWindow()
+main_window.show()
+app.processEvents()
+shown = time.perf_counter()
+import scanner
+loaded = time.perf_counter()
+print(json.dumps({'import': imported - started, 'window': shown - started, 'engine': loaded - shown}))
+'''
+
+
+def measure(offscreen):
+    environment = dict(os.environ, QT_QPA_PLATFORM='offscreen') if offscreen else os.environ
+    launched = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', CHILD], cwd=ROOT, env=environment, capture_output=True, text=True, check=True).stdout
+    finished = time.perf_counter()
+    timings = json.loads(output.strip().splitlines()[-1])
+    # interpreter start and teardown are part of what a user waits for, the child reports the rest
+    timings['process'] = finished - launched
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--offscreen', action='store_true', help='use the offscreen Qt platform, for machines without a display')
+    args = parser.parse_args()
+
+    # the first run warms the bytecode and file caches
+    measure(args.offscreen)
+    runs = [measure(args.offscreen) for _ in range(args.runs)]
+    print(json.dumps({name: round(statistics.median(run[name] for run in runs), 3) for name in runs[0]}))
+
+
+if __name__ == '__main__':
+    main()
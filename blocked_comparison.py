@@ -0,0 +1,247 @@
+from ImageHash.kernels import tile_matches
+from ImageHash import (
+    paired_distances,
+    hex_to_packed,
+)
+from multiprocessing import shared_memory
+import numpy as np
+import heapq
+import math
+import os
+
+EDGE_DTYPE = np.dtype([('image1', '<i4'), ('image2', '<i4'), ('distance', '<f4')])
+
+_attached_memory = {}
+
+
+def max_distance_bits(threshold, hash_bits):
+    distances = np.arange(hash_bits + 1)
+    allowed = distances[(1 - distances / hash_bits) >= round(threshold / 100, 2)]
+    return int(allowed.max()) if len(allowed) else -1
+
+
+class HashBuckets:
+    # images with identical hashes share every distance, so only the first image of a bucket is compared
+    # and its matches are handed on to the rest of the bucket
+    def __init__(self, members=None, offsets=None) -> None:
+        self.members = members if members is not None else np.empty(0, dtype=np.int64)
+        self.offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    @property
+    def representatives(self) -> np.ndarray:
+        return np.asarray(self.members[self.offsets[:-1]])
+
+    @property
+    def sizes(self) -> np.ndarray:
+        return np.diff(self.offsets)
+
+    @classmethod
+    def from_hashes(cls, ids, keys):
+        ids = np.asarray(ids, dtype=np.int64)
+        if not len(ids):
+            return cls()
+        _, inverse = np.unique(np.asarray(keys, dtype=object).astype(str), return_inverse=True)
+        order = np.lexsort((ids, inverse))
+        members, inverse = ids[order], inverse[order]
+        starts = np.flatnonzero(np.r_[True, inverse[1:] != inverse[:-1]])
+        sizes = np.diff(np.append(starts, len(members)))
+
+        # buckets in the order of their first image, so representatives come out sorted like the ids
+        bucket_order = np.argsort(members[starts], kind='stable')
+        sizes = sizes[bucket_order]
+        offsets = np.zeros(len(sizes) + 1, dtype=np.int64)
+        np.cumsum(sizes, out=offsets[1:])
+        positions = np.repeat(starts[bucket_order] - offsets[:-1], sizes) + np.arange(len(members))
+        return cls(members[positions], offsets)
+
+    def representatives_of(self, ids) -> np.ndarray:
+        order = np.argsort(self.members, kind='stable')
+        positions = order[np.searchsorted(self.members, ids, sorter=order)]
+        return self.representatives[np.searchsorted(self.offsets, positions, side='right') - 1]
+
+    def expand(self, image1, image2, distance):
+        # every member of one bucket matches every member of the other at the distance of their representatives
+        representatives = self.representatives
+        buckets1 = np.searchsorted(representatives, image1)
+        buckets2 = np.searchsorted(representatives, image2)
+        sizes2 = self.sizes[buckets2]
+        counts = self.sizes[buckets1] * sizes2
+        edge = np.repeat(np.arange(len(counts)), counts)
+        pair = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        members1 = np.asarray(self.members[self.offsets[buckets1][edge] + pair // sizes2[edge]])
+        members2 = np.asarray(self.members[self.offsets[buckets2][edge] + pair % sizes2[edge]])
+        return np.minimum(members1, members2), np.maximum(members1, members2), np.asarray(distance)[edge]
+
+    def internal(self):
+        # the members of a bucket match each other at distance 0
+        image1, image2 = [], []
+        sizes = self.sizes
+        for size in np.unique(sizes[sizes > 1]):
+            rows, cols = np.triu_indices(size, 1)
+            starts = self.offsets[:-1][sizes == size][:, None]
+            image1.append(np.asarray(self.members[(starts + rows).ravel()]))
+            image2.append(np.asarray(self.members[(starts + cols).ravel()]))
+        if not image1:
+            return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32)
+        image1, image2 = np.concatenate(image1), np.concatenate(image2)
+        return image1, image2, np.zeros(len(image1), dtype=np.float32)
+
+    def save(self, directory):
+        np.save(os.path.join(directory, 'bucket_members.npy'), self.members)
+        np.save(os.path.join(directory, 'bucket_offsets.npy'), self.offsets)
+        return directory
+
+    @classmethod
+    def load(cls, directory):
+        return cls(np.load(os.path.join(directory, 'bucket_members.npy'), mmap_mode='r'), np.load(os.path.join(directory, 'bucket_offsets.npy')))
+
+
+def export_hashes(rows, count, directory, name='hashes'):
+    hashes, ids, hash_bits = None, None, 0
+    for idx, (image_id, image_hash) in enumerate(rows):
+        packed = hex_to_packed(image_hash)
+        if hashes is None:
+            hash_bits = len(image_hash) * 4
+            hashes = np.lib.format.open_memmap(os.path.join(directory, f'{name}.npy'), mode='w+', dtype=np.uint8, shape=(count, len(packed)))
+            # every export keeps its own ids, another one into the same directory must not replace them
+            ids = np.lib.format.open_memmap(os.path.join(directory, f'{name}_ids.npy'), mode='w+', dtype=np.int32, shape=(count,))
+        hashes[idx] = packed
+        ids[idx] = image_id
+
+    if hashes is not None:
+        hashes.flush()
+        ids.flush()
+        del hashes, ids
+
+    return os.path.join(directory, f'{name}.npy'), os.path.join(directory, f'{name}_ids.npy'), hash_bits
+
+
+def publish_hashes(rows, count):
+    memory, shape, hash_bits = None, (0, 0), 0
+    ids = np.empty(count, dtype=np.int32)
+    for idx, (image_id, image_hash) in enumerate(rows):
+        packed = hex_to_packed(image_hash)
+        if memory is None:
+            hash_bits = len(image_hash) * 4
+            shape = (count, len(packed))
+            memory = shared_memory.SharedMemory(create=True, size=max(1, count * len(packed)))
+            hashes = np.ndarray(shape, dtype=np.uint8, buffer=memory.buf)
+        hashes[idx] = packed
+        ids[idx] = image_id
+
+    if memory is not None:
+        del hashes
+
+    return memory, shape, ids, hash_bits
+
+
+def _attach_hashes(name, shape):
+    if name not in _attached_memory:
+        # a worker kept for another comparison unmaps the hashes of the previous one
+        for memory in _attached_memory.values():
+            memory.close()
+        _attached_memory.clear()
+        _attached_memory[name] = shared_memory.SharedMemory(name=name)
+    return np.ndarray(shape, dtype=np.uint8, buffer=_attached_memory[name].buf)
+
+
+def tile_size(count, hash_bytes, memory_budget, workers, chunk_size: int = 8):
+    per_worker = memory_budget * 1048576 / (workers + 1)
+    # xor chunk + distance accumulator + worst case of every pair in the tile matching
+    per_pair = min(hash_bytes, chunk_size) + 4 + EDGE_DTYPE.itemsize
+    size = int((math.sqrt(hash_bytes ** 2 + per_pair * per_worker) - hash_bytes) / per_pair)
+    return max(1, min(count, size))
+
+
+def tile_pairs(count, size, start: int = 0):
+    starts = range(start, count, size)
+    for row_start in starts:
+        for col_start in starts:
+            if col_start >= row_start:
+                yield (row_start, min(row_start + size, count)), (col_start, min(col_start + size, count))
+
+
+def cross_tile_pairs(boundaries, size):
+    # tiles pairing every part with all later parts, pairs inside one part are already compared
+    count = boundaries[-1]
+    for start, end in zip(boundaries[:-1], boundaries[1:]):
+        for row_start in range(start, end, size):
+            for col_start in range(end, count, size):
+                yield (row_start, min(row_start + size, end)), (col_start, min(col_start + size, count))
+
+
+def _tile_matches(hashes, rows, cols, max_bits):
+    row_idx, col_idx, distances = tile_matches(np.asarray(hashes[rows[0]: rows[1]]), np.asarray(hashes[cols[0]: cols[1]]), max_bits, rows == cols)
+    return row_idx + rows[0], col_idx + cols[0], distances
+
+
+def compare_shared_tile(name, shape, rows, cols, max_bits):
+    return _tile_matches(_attach_hashes(name, shape), rows, cols, max_bits)
+
+
+def write_run(image1, image2, distance, run_path):
+    if not len(image1):
+        return None
+
+    edges = np.empty(len(image1), dtype=EDGE_DTYPE)
+    edges['image1'] = image1
+    edges['image2'] = image2
+    edges['distance'] = distance
+    # runs are merged in order, so every run is sorted
+    edges.sort(order=['image1', 'image2'], kind='stable')
+    np.save(run_path, edges)
+
+    return run_path
+
+
+def compare_tile(hashes_path, ids_path, rows, cols, max_bits, hash_bits, run_path, buckets_path=None, verify=None):
+    hashes = np.load(hashes_path, mmap_mode='r')
+    ids = np.load(ids_path, mmap_mode='r')
+
+    row_idx, col_idx, distances = _tile_matches(hashes, rows, cols, max_bits)
+    if verify is not None and len(row_idx):
+        # matches of the coarse hashes are kept when the full hashes, read from their own file, match as well
+        verify_path, max_bits, hash_bits = verify
+        verify_hashes = np.load(verify_path, mmap_mode='r')
+        distances = paired_distances(verify_hashes[row_idx], verify_hashes[col_idx])
+        matches = distances <= max_bits
+        row_idx, col_idx, distances = row_idx[matches], col_idx[matches], distances[matches]
+    image1, image2, distances = ids[row_idx], ids[col_idx], distances / hash_bits
+    if buckets_path is not None and len(image1):
+        image1, image2, distances = HashBuckets.load(buckets_path).expand(image1, image2, distances)
+
+    return write_run(image1, image2, distances, run_path)
+
+
+def _read_run(run_path, chunk_size):
+    run = np.load(run_path, mmap_mode='r')
+    for start in range(0, len(run), chunk_size):
+        yield from np.asarray(run[start: start + chunk_size]).tolist()
+
+
+def merge_runs(run_paths, output_path, chunk_size: int = 65536):
+    count = sum(len(np.load(run_path, mmap_mode='r')) for run_path in run_paths)
+    if not count:
+        return np.empty(0, dtype=EDGE_DTYPE)
+
+    output = np.lib.format.open_memmap(output_path, mode='w+', dtype=EDGE_DTYPE, shape=(count,))
+
+    buffer = []
+    position = 0
+    for edge in heapq.merge(*[_read_run(run_path, chunk_size) for run_path in run_paths]):
+        buffer.append(edge)
+        if len(buffer) == chunk_size:
+            output[position: position + len(buffer)] = buffer
+            position += len(buffer)
+            buffer = []
+
+    if buffer:
+        output[position: position + len(buffer)] = buffer
+    output.flush()
+    del output
+
+    # the runs are kept until the scan is done, a comparison resumed before that reads them again
+    return np.load(output_path, mmap_mode='r')
@@ -0,0 +1,120 @@
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
+import random
+import time
+import math
+
+
+def sample_files(filepaths, count, seed: int = 0):
+    # reservoir sample, every file of the walk has the same chance whatever the folder layout
+    rng = random.Random(seed)
+    sample = []
+    idx = -1
+    for idx, filepath in enumerate(filepaths):
+        if idx < count:
+            sample.append(filepath)
+        else:
+            position = rng.randint(0, idx)
+            if position < count:
+                sample[position] = filepath
+    return sample, idx + 1
+
+
+def _noop():
+    return None
+
+
+def _read(filepath):
+    started = time.perf_counter()
+    with open(filepath, 'rb') as file:
+        data = file.read(1)
+        latency = time.perf_counter() - started
+        data += file.read()
+    return latency, time.perf_counter() - started, data
+
+
+def _hash_all(fn, filepaths, args):
+    for filepath in filepaths:
+        try:
+            fn(filepath, *args)
+        except Exception:
+            pass
+
+
+def _throughput(executor_class, workers, fn, filepaths, args):
+    with executor_class(max_workers=workers) as executor:
+        # started workers are not part of the measurement, a scan starts them once
+        wait([executor.submit(_noop) for _ in range(workers)])
+        started = time.perf_counter()
+        wait([executor.submit(_hash_all, fn, [filepath], args) for filepath in filepaths])
+        return len(filepaths) / (time.perf_counter() - started)
+
+
+def _task_overhead(executor_class, workers, tasks: int = 64):
+    with executor_class(max_workers=workers) as executor:
+        wait([executor.submit(_noop) for _ in range(workers)])
+        started = time.perf_counter()
+        wait([executor.submit(_noop) for _ in range(tasks)])
+        return (time.perf_counter() - started) / tasks
+
+
+def calibrate(filepaths, fn, args, max_workers, compare=None):
+    # a short run of the real hashing on a sample of the folder, the tuning follows from what is measured
+    reads = [_read(filepath) for filepath in filepaths]
+    latency = sorted(read[0] for read in reads)[len(reads) // 2] if reads else 0.0
+    read_seconds = sum(read[1] for read in reads) / max(1, len(reads))
+
+    results = []
+    started = time.perf_counter()
+    for filepath, (_, _, data) in zip(filepaths, reads):
+        try:
+            results.append(fn(filepath, *args, data=data))
+        except Exception:
+            pass
+    hash_seconds = (time.perf_counter() - started) / max(1, len(reads))
+
+    engines = {'process': ProcessPoolExecutor, 'thread': ThreadPoolExecutor}
+    speeds = {engine: _throughput(executor_class, max_workers, fn, filepaths, args) for engine, executor_class in engines.items()}
+    engine = max(speeds, key=speeds.get)
+
+    # fewer workers while they keep up, slow storage or a busy machine gain nothing from the rest
+    workers, best = max_workers, speeds[engine]
+    while workers > 1:
+        speed = _throughput(engines[engine], workers // 2, fn, filepaths, args)
+        if speed < 0.9 * best:
+            break
+        workers, best = workers // 2, max(best, speed)
+
+    overhead = _task_overhead(engines[engine], workers)
+    # a task runs long enough that handing it out costs at most a twentieth of it
+    target_seconds = min(2.0, max(0.05, 20 * overhead))
+
+    # reads run ahead when waiting on the storage would leave the workers idle
+    read_ahead = 0
+    if read_seconds > 0.1 * hash_seconds / workers:
+        read_ahead = min(256, workers + math.ceil(workers * read_seconds / max(hash_seconds, 1e-6)))
+
+    pair_chunk = 1
+    if compare is not None and len(results) > 1:
+        pairs = [(results[idx], results[(idx + 1) % len(results)]) for idx in range(len(results))]
+        started = time.perf_counter()
+        for result1, result2 in pairs:
+            compare(result1, result2)
+        pair_seconds = (time.perf_counter() - started) / len(pairs)
+        pair_chunk = max(1, int(target_seconds / max(pair_seconds, 1e-9)))
+
+    return {
+        'workers': workers,
+        'engine': engine,
+        'target_seconds': target_seconds,
+        'read_ahead': read_ahead,
+        'pair_chunk': pair_chunk,
+        'latency': latency,
+        'read_seconds': read_seconds,
+        'hash_seconds': hash_seconds,
+        'task_overhead': overhead,
+        'files_per_second': best,
+    }
@@ -0,0 +1,227 @@
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    wait,
+)
+from image_decoder import (
+    DecodeError,
+    read_header,
+)
+from read_ahead import ReadAhead
+from collections import Counter
+import itertools
+import time
+
+# bytes per pixel of the decoded image, Pillow keeps every multi band mode in 4 bytes
+_MODE_BYTES = {
+    '1': 1,
+    'L': 1,
+    'P': 1,
+    'I;16': 2,
+    'I;16B': 2,
+    'I;16L': 2,
+    'I': 4,
+    'F': 4,
+}
+
+# YCbCr copy, extracted luma and the median filtered luma made while preprocessing
+_PREPROCESSING_BYTES = 6
+
+# pixels charged for every file on top of its own, opening and hashing a file is never free
+_FILE_OVERHEAD_PIXELS = 65536
+
+# files whose headers are read before their hashing starts
+_HEADER_BATCH = 256
+
+
+def estimate_memory(size, mode) -> int:
+    width, height = size
+    return width * height * (_MODE_BYTES.get(mode, 4) + _PREPROCESSING_BYTES)
+
+
+def _run_chunk(fn, filepaths, args, buffers=None):
+    started = time.perf_counter()
+    results = []
+    for filepath, data in zip(filepaths, buffers or [None] * len(filepaths)):
+        try:
+            results.append(fn(filepath, *args) if data is None else fn(filepath, *args, data=data))
+        except Exception:
+            results.append(None)
+    return results, time.perf_counter() - started
+
+
+class MemoryScheduler:
+    def __init__(self, executor, memory_budget, workers, target_seconds: float = 0.25, read_ahead: int = 0) -> None:
+        self._executor = executor
+        self._budget = memory_budget * 1048576
+        self._workers = workers
+        self._target_seconds = target_seconds
+        self._read_ahead = read_ahead
+        self._seconds_per_pixel = None
+        self._pending = {}
+        self._stopped = False
+
+        self.rejected = Counter()
+        self.failed = 0
+
+    def _tasks(self, filepaths, count):
+        # headers are read a batch at a time, so hashing starts before the whole folder is opened and a stop does not wait for it
+        tasks, rejected = [], []
+        for filepath in itertools.islice(filepaths, count):
+            if self._stopped:
+                break
+            try:
+                _, (width, height), mode = read_header(filepath)
+            except DecodeError as error:
+                self.rejected[error.reason] += 1
+                rejected.append(filepath)
+                continue
+            tasks.append((estimate_memory((width, height), mode), width * height + _FILE_OVERHEAD_PIXELS, filepath))
+
+        # largest first, so the slowest images of a batch do not end up alone at its end
+        return sorted(tasks, key=lambda task: task[0], reverse=True), rejected
+
+    def _chunk_size(self, tasks, position) -> int:
+        if self._seconds_per_pixel is None:
+            return 1
+
+        # leave enough chunks for every worker until the end to keep the tail short
+        limit = max(1, (len(tasks) - position) // (self._workers * 4))
+        size, seconds = 0, 0.0
+        while position + size < len(tasks) and size < limit:
+            seconds += tasks[position + size][1] * self._seconds_per_pixel
+            if size and seconds > self._target_seconds:
+                break
+            size += 1
+        return size
+
+    def _update_speed(self, chunk, seconds) -> None:
+        seconds_per_pixel = seconds / sum(task[1] for task in chunk)
+        if self._seconds_per_pixel is None:
+            self._seconds_per_pixel = seconds_per_pixel
+        else:
+            self._seconds_per_pixel = 0.8 * self._seconds_per_pixel + 0.2 * seconds_per_pixel
+
+    def _submit(self, *args):
+        # stop() may shut the executor down from another thread between the check and the submit
+        if self._stopped:
+            return None
+        try:
+            return self._executor.submit(*args)
+        except RuntimeError:
+            if self._stopped:
+                return None
+            raise
+
+    def map(self, fn, filepaths, *args):
+        if self._read_ahead:
+            yield from self._map_buffered(fn, filepaths, args)
+            return
+
+        filepaths = iter(filepaths)
+        tasks, position, read_all = [], 0, False
+        in_use = 0
+
+        while not self._stopped:
+            # the next batch of headers is read once the current one is handed out
+            if position == len(tasks) and not read_all:
+                tasks, rejected = self._tasks(filepaths, _HEADER_BATCH)
+                position, read_all = 0, len(tasks) + len(rejected) < _HEADER_BATCH
+                if rejected:
+                    yield rejected, [None] * len(rejected)
+            if position == len(tasks) and read_all and not self._pending:
+                break
+
+            while position < len(tasks) and len(self._pending) < self._workers * 2:
+                size = self._chunk_size(tasks, position)
+                chunk = tasks[position: position + size]
+                # tasks of a chunk run one after another, so the chunk needs as much memory as its largest task
+                memory = chunk[0][0]
+                if self._pending and in_use + memory > self._budget:
+                    break
+
+                future = self._submit(_run_chunk, fn, [filepath for _, _, filepath in chunk], args)
+                if future is None:
+                    break
+                self._pending[future] = (chunk, memory)
+                in_use += memory
+                position += size
+
+            if not self._pending:
+                continue
+            done, _ = wait(self._pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                chunk, memory = self._pending.pop(future)
+                in_use -= memory
+                if future.cancelled() or future.exception() is not None:
+                    self.failed += len(chunk)
+                    continue
+
+                results, seconds = future.result()
+                self.failed += results.count(None)
+                self._update_speed(chunk, seconds)
+
+                yield [filepath for _, _, filepath in chunk], results
+
+    def _map_buffered(self, fn, filepaths, args):
+        # files stream in directory order from the read ahead buffers, a quarter of the budget holds the buffers
+        reader = ReadAhead(filepaths, self._read_ahead, self._budget // 4)
+        budget = self._budget - self._budget // 4
+        tasks = []
+        in_use = 0
+
+        try:
+            while not self._stopped:
+                # only wait on the storage when the workers have nothing else to do
+                while len(tasks) < self._read_ahead and ((not self._pending and not tasks) or reader.ready()) and not self._stopped:
+                    filepath, data = next(reader, (None, None))
+                    if filepath is None:
+                        break
+                    try:
+                        if data is None:
+                            raise DecodeError('unreadable', filepath)
+                        _, (width, height), mode = read_header(filepath, data)
+                    except DecodeError as error:
+                        self.rejected[error.reason] += 1
+                        yield [filepath], [None]
+                        continue
+                    tasks.append((estimate_memory((width, height), mode), width * height + _FILE_OVERHEAD_PIXELS, filepath, data))
+
+                if not tasks and not self._pending:
+                    break
+
+                while tasks and len(self._pending) < self._workers * 2:
+                    chunk = tasks[:self._chunk_size(tasks, 0)]
+                    memory = max(task[0] for task in chunk)
+                    if self._pending and in_use + memory > budget:
+                        break
+
+                    future = self._submit(_run_chunk, fn, [task[2] for task in chunk], args, [task[3] for task in chunk])
+                    if future is None:
+                        break
+                    self._pending[future] = ([task[:3] for task in chunk], memory)
+                    in_use += memory
+                    del tasks[:len(chunk)]
+
+                if not self._pending:
+                    continue
+                # with nothing left to submit, the next buffer arriving is as good a reason to wake up as a finished chunk
+                done, _ = wait(set(self._pending) | (set() if tasks else reader.waiting()), return_when=FIRST_COMPLETED)
+                for future in done & self._pending.keys():
+                    chunk, memory = self._pending.pop(future)
+                    in_use -= memory
+                    if future.cancelled() or future.exception() is not None:
+                        self.failed += len(chunk)
+                        continue
+
+                    results, seconds = future.result()
+                    self.failed += results.count(None)
+                    self._update_speed(chunk, seconds)
+
+                    yield [filepath for _, _, filepath in chunk], results
+        finally:
+            reader.close()
+
+    def stop(self) -> None:
+        self._stopped = True
+        for future in list(self._pending):
+            future.cancel()
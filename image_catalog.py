@@ -0,0 +1,262 @@
+from ImageHash import hex_to_packed
+import numpy as np
+import json
+import os
+
+CATALOG_DTYPE = np.dtype([('id', '<i8'), ('image_width', '<i4'), ('image_height', '<i4'), ('image_dpi', '<i4'), ('image_size', '<f4'), ('reference', '?')])
+
+
+ARROW_EXTENSIONS = ('.arrow', '.feather', '.parquet')
+
+
+class StringColumn:
+    # utf-8 strings laid out back to back with offsets, the way arrow stores them, so a column can be memory mapped
+    def __init__(self, data, offsets) -> None:
+        self.data = data
+        self.offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return bytes(self.data[self.offsets[idx]: self.offsets[idx + 1]]).decode()
+        positions = np.arange(len(self))[idx] if isinstance(idx, slice) else np.asarray(idx)
+        strings = np.empty(len(positions), dtype=object)
+        strings[:] = [self[int(position)] for position in positions]
+        return strings
+
+    @classmethod
+    def from_strings(cls, strings):
+        encoded = [string.encode() for string in strings]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(string) for string in encoded], out=offsets[1:])
+        return cls(np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets)
+
+
+class HexColumn:
+    # hex hashes of a packed hash matrix, decoded when they are read
+    def __init__(self, packed, hex_length) -> None:
+        self.packed = packed
+        self.hex_length = hex_length
+
+    def __len__(self) -> int:
+        return len(self.packed)
+
+    def __iter__(self):
+        return (self[idx] for idx in range(len(self)))
+
+    def __getitem__(self, idx):
+        if isinstance(idx, (int, np.integer)):
+            return self.packed[idx].tobytes().hex()[:self.hex_length]
+        hashes = np.empty(len(self.packed[idx]), dtype=object)
+        hashes[:] = [packed.tobytes().hex()[:self.hex_length] for packed in self.packed[idx]]
+        return hashes
+
+
+class ImageCatalog:
+    def __init__(self, records=None, paths=None, hashes=None, packed=None) -> None:
+        self.records = records if records is not None else np.empty(0, dtype=CATALOG_DTYPE)
+        self.paths = paths if paths is not None else np.empty(0, dtype=object)
+        self.hashes = hashes if hashes is not None else np.empty(0, dtype=object)
+        self._packed = packed
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def __contains__(self, image_id) -> bool:
+        idx = np.searchsorted(self.records['id'], image_id)
+        return idx < len(self.records) and self.records['id'][idx] == image_id
+
+    @property
+    def ids(self) -> np.ndarray:
+        return self.records['id']
+
+    @property
+    def packed(self):
+        # packed hash bits in id order, None when the hashes are multi hashes or differ in length
+        if self._packed is None and len(self.hashes) and ',' not in self.hashes[0] and len({len(image_hash) for image_hash in self.hashes}) == 1:
+            self._packed = np.stack([hex_to_packed(image_hash) for image_hash in self.hashes])
+        return self._packed
+
+    def positions(self, ids) -> np.ndarray:
+        ids = np.asarray(ids, dtype=np.int64)
+        positions = np.searchsorted(self.records['id'], ids).clip(max=max(len(self.records) - 1, 0))
+        if not len(self.records) or not np.array_equal(self.records['id'][positions], ids):
+            raise KeyError('image ids are not in the catalog')
+        return positions
+
+    def select(self, ids):
+        positions = self.positions(ids)
+        return ImageCatalog(self.records[positions], self.paths[positions], self.hashes[positions], self._packed[positions] if self._packed is not None else None)
+
+    def merge(self, other):
+        # rows of both catalogs in id order, the other catalog wins for ids in both
+        records = np.concatenate((other.records, self.records))
+        ids, positions = np.unique(records['id'], return_index=True)
+        paths = np.concatenate((np.asarray(other.paths[:], dtype=object), np.asarray(self.paths[:], dtype=object)))
+        hashes = np.concatenate((np.asarray(other.hashes[:], dtype=object), np.asarray(self.hashes[:], dtype=object)))
+        return ImageCatalog(records[positions], paths[positions], hashes[positions])
+
+    def image_hash(self, image_id) -> str:
+        return self.hashes[self.positions([image_id])[0]]
+
+    def get(self, image_id) -> dict:
+        return self._row(self.positions([image_id])[0])
+
+    def dicts(self):
+        return (self._row(idx) for idx in range(len(self)))
+
+    def _row(self, idx) -> dict:
+        record = self.records[idx]
+        return {
+            'id': int(record['id']),
+            'image_path': self.paths[idx],
+            'image_hash': self.hashes[idx],
+            'image_width': int(record['image_width']),
+            'image_height': int(record['image_height']),
+            'image_dpi': int(record['image_dpi']),
+            'image_size': float(record['image_size']),
+            'image_role': 'reference' if record['reference'] else 'incoming',
+        }
+
+    @classmethod
+    def load(cls, model, ids=None, batch_size: int = 999):
+        # one bulk query per batch of ids instead of one query per image
+        fields = [model.id, model.image_path, model.image_hash, model.image_width, model.image_height, model.image_dpi, model.image_size]
+        fields.append(model.image_role if hasattr(model, 'image_role') else model.id)
+        if ids is None:
+            rows = list(model.select(*fields).order_by(model.id).tuples())
+        else:
+            ids = sorted(set(ids))
+            rows = [row for start in range(0, len(ids), batch_size)
+                    for row in model.select(*fields).where(model.id.in_(ids[start: start + batch_size])).order_by(model.id).tuples()]
+
+        records = np.empty(len(rows), dtype=CATALOG_DTYPE)
+        paths = np.empty(len(rows), dtype=object)
+        hashes = np.empty(len(rows), dtype=object)
+        if rows:
+            image_ids, image_paths, image_hashes, widths, heights, dpis, sizes, roles = zip(*rows)
+            records['id'], records['image_width'], records['image_height'] = image_ids, widths, heights
+            records['image_dpi'], records['image_size'] = dpis, sizes
+            records['reference'] = [role == 'reference' for role in roles]
+            paths[:], hashes[:] = image_paths, image_hashes
+
+        return cls(records, paths, hashes)
+
+
+def _hash_bits(catalog):
+    return len(catalog.hashes[0]) * 4 if len(catalog) and catalog.packed is not None else 0
+
+
+def export_catalog(catalog, path, hash_parameters):
+    # a directory of npy files, or an arrow/parquet file, picked by the extension
+    if os.path.splitext(path)[1].lower() in ARROW_EXTENSIONS:
+        _export_arrow(catalog, path, hash_parameters)
+    else:
+        _export_npy(catalog, path, hash_parameters)
+
+
+def import_catalog(path):
+    if os.path.splitext(path)[1].lower() in ARROW_EXTENSIONS:
+        return _import_arrow(path)
+    return _import_npy(path)
+
+
+def is_catalog_file(path):
+    return os.path.splitext(path)[1].lower() in ARROW_EXTENSIONS or os.path.isfile(os.path.join(path, 'catalog.json'))
+
+
+def _export_npy(catalog, directory, hash_parameters):
+    os.makedirs(directory, exist_ok=True)
+    hash_bits = _hash_bits(catalog)
+
+    np.save(os.path.join(directory, 'records.npy'), catalog.records)
+    paths = StringColumn.from_strings(catalog.paths)
+    np.save(os.path.join(directory, 'paths.npy'), paths.data)
+    np.save(os.path.join(directory, 'path_offsets.npy'), paths.offsets)
+    if hash_bits:
+        np.save(os.path.join(directory, 'hashes.npy'), np.asarray(catalog.packed))
+    else:
+        # multi hashes of crop resistant hashing have no fixed width, they are kept as hex strings
+        hashes = StringColumn.from_strings(catalog.hashes)
+        np.save(os.path.join(directory, 'hash_strings.npy'), hashes.data)
+        np.save(os.path.join(directory, 'hash_offsets.npy'), hashes.offsets)
+
+    # written last, a bundle without it is incomplete
+    with open(os.path.join(directory, 'catalog.json'), 'w') as file:
+        json.dump({'count': len(catalog), 'hash_parameters': hash_parameters, 'hash_bits': hash_bits}, file)
+
+
+def _import_npy(directory):
+    with open(os.path.join(directory, 'catalog.json')) as file:
+        meta = json.load(file)
+
+    def load(name):
+        return np.load(os.path.join(directory, name), mmap_mode='r')
+
+    paths = StringColumn(load('paths.npy'), load('path_offsets.npy'))
+    if meta['hash_bits']:
+        packed = load('hashes.npy')
+        catalog = ImageCatalog(load('records.npy'), paths, HexColumn(packed, meta['hash_bits'] // 4), packed)
+    else:
+        catalog = ImageCatalog(load('records.npy'), paths, StringColumn(load('hash_strings.npy'), load('hash_offsets.npy')))
+    return catalog, meta['hash_parameters']
+
+
+def _export_arrow(catalog, path, hash_parameters):
+    import pyarrow
+    hash_bits = _hash_bits(catalog)
+
+    columns = {name: pyarrow.array(catalog.records[name]) for name in CATALOG_DTYPE.names}
+    columns['image_path'] = pyarrow.array(list(catalog.paths), pyarrow.large_string())
+    columns['image_hash'] = pyarrow.array(list(catalog.hashes), pyarrow.large_string())
+    if hash_bits:
+        packed = np.ascontiguousarray(catalog.packed)
+        columns['packed_hash'] = pyarrow.FixedSizeBinaryArray.from_buffers(pyarrow.binary(packed.shape[1]), len(packed), [None, pyarrow.py_buffer(packed)])
+    metadata = {'hash_parameters': hash_parameters, 'hash_bits': str(hash_bits)}
+    table = pyarrow.table(columns).replace_schema_metadata(metadata)
+
+    if path.lower().endswith('.parquet'):
+        import pyarrow.parquet
+        pyarrow.parquet.write_table(table, path)
+    else:
+        with pyarrow.OSFile(path, 'wb') as file, pyarrow.ipc.new_file(file, table.schema) as writer:
+            writer.write_table(table)
+
+
+def _string_column(array):
+    # the offsets and data buffers of an arrow string array are used as they are
+    _, offsets, data = array.buffers()
+    offsets = np.frombuffer(offsets, dtype=np.int64 if array.type == 'large_string' else np.int32)[array.offset: array.offset + len(array) + 1]
+    return StringColumn(np.frombuffer(data, dtype=np.uint8) if data is not None else np.empty(0, dtype=np.uint8), offsets)
+
+
+def _import_arrow(path):
+    import pyarrow
+    if path.lower().endswith('.parquet'):
+        import pyarrow.parquet
+        table = pyarrow.parquet.read_table(path)
+    else:
+        # arrow files are memory mapped, so columns are read without copying
+        table = pyarrow.ipc.open_file(pyarrow.memory_map(path)).read_all()
+    table = table.combine_chunks()
+    metadata = {key.decode(): value.decode() for key, value in (table.schema.metadata or {}).items()}
+    hash_bits = int(metadata['hash_bits'])
+
+    records = np.empty(table.num_rows, dtype=CATALOG_DTYPE)
+    for name in CATALOG_DTYPE.names:
+        records[name] = table.column(name).to_numpy()
+
+    paths = _string_column(table.column('image_path').chunk(0)) if table.num_rows else StringColumn.from_strings([])
+    if hash_bits and table.num_rows:
+        array = table.column('packed_hash').chunk(0)
+        width = array.type.byte_width
+        packed = np.frombuffer(array.buffers()[1], dtype=np.uint8)[array.offset * width: (array.offset + len(array)) * width].reshape(len(array), width)
+        return ImageCatalog(records, paths, HexColumn(packed, hash_bits // 4), packed), metadata['hash_parameters']
+
+    hashes = _string_column(table.column('image_hash').chunk(0)) if table.num_rows else StringColumn.from_strings([])
+    return ImageCatalog(records, paths, hashes), metadata['hash_parameters']
@@ -0,0 +1,151 @@
+try:
+    import pyvips
+    # the hashing pool already runs one task per core
+    pyvips.concurrency_set(1)
+    pyvips.cache_set_max(0)
+except (ImportError, OSError):
+    pyvips = None
+
+from PIL import Image
+import importlib.util
+import io
+
+# cairosvg loads cairo through cffi, which takes longer than the rest of the application to import,
+# so it is only imported once a drawing is rasterized
+_has_cairosvg = importlib.util.find_spec('cairosvg') is not None
+
+_SIGNATURES = (
+    (b'\xff\xd8\xff', 'JPEG'),
+    (b'\x89PNG\r\n\x1a\n', 'PNG'),
+    (b'GIF87a', 'GIF'),
+    (b'GIF89a', 'GIF'),
+    (b'BM', 'BMP'),
+    (b'II*\x00', 'TIFF'),
+    (b'MM\x00*', 'TIFF'),
+)
+
+# extensions of every format sniff_format recognizes, files are picked by name before they are read
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.jpe', '.jfif', '.png', '.gif', '.bmp', '.tif', '.tiff', '.webp', '.svg')
+
+_VIPS_MODES = {
+    1: 'L',
+    2: 'LA',
+    3: 'RGB',
+    4: 'RGBA',
+}
+
+
+class DecodeError(Exception):
+    def __init__(self, reason, filepath) -> None:
+        Exception.__init__(self, f'{reason}: {filepath}')
+        self.reason = reason
+
+
+def sniff_format(filepath, data=None):
+    if data is not None:
+        head = data[:1024]
+    else:
+        with open(filepath, 'rb') as file:
+            head = file.read(1024)
+
+    for signature, image_format in _SIGNATURES:
+        if head.startswith(signature):
+            return image_format
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'WEBP'
+    if head.lstrip(b'\xef\xbb\xbf \t\r\n').startswith(b'<') and b'<svg' in head:
+        return 'SVG'
+    return None
+
+
+def _vips_decode(image):
+    if image.filename:
+        vips_image = pyvips.Image.new_from_file(image.filename, access='sequential', fail=True)
+    else:
+        # opened from a read ahead buffer
+        image.fp.seek(0)
+        vips_image = pyvips.Image.new_from_buffer(image.fp.read(), '', access='sequential', fail=True)
+    if vips_image.format != 'uchar' or vips_image.interpretation not in ('srgb', 'b-w') or vips_image.bands not in _VIPS_MODES:
+        return None
+
+    mode = _VIPS_MODES[vips_image.bands]
+    decoded = Image.frombuffer(mode, (vips_image.width, vips_image.height), vips_image.write_to_memory(), 'raw', mode, 0, 1)
+    decoded.info = dict(image.info)
+    return decoded
+
+
+def _cairosvg_rasterize(filepath, size):
+    import cairosvg
+    return Image.open(io.BytesIO(cairosvg.svg2png(url=filepath, output_width=size)))
+
+
+def _vips_rasterize(filepath, size):
+    vips_image = pyvips.Image.thumbnail(filepath, size, height=size)
+    return Image.frombuffer(_VIPS_MODES[vips_image.bands], (vips_image.width, vips_image.height), vips_image.write_to_memory(), 'raw', _VIPS_MODES[vips_image.bands], 0, 1)
+
+
+_decoders = {}
+_rasterizers = []
+
+if pyvips is not None:
+    # Pillow with libjpeg-turbo decodes JPEG faster than a single threaded libvips, everything else is faster in libvips
+    for image_format in ('PNG', 'TIFF', 'WEBP'):
+        _decoders.setdefault(image_format, []).append(_vips_decode)
+    _rasterizers.append(_vips_rasterize)
+if _has_cairosvg:
+    _rasterizers.insert(0, _cairosvg_rasterize)
+
+
+def register_decoder(image_format, decoder) -> None:
+    _decoders.setdefault(image_format, []).insert(0, decoder)
+
+
+def register_rasterizer(rasterizer) -> None:
+    _rasterizers.insert(0, rasterizer)
+
+
+def read_header(filepath, data=None):
+    try:
+        image_format = sniff_format(filepath, data)
+    except OSError:
+        raise DecodeError('unreadable', filepath)
+
+    if image_format is None:
+        raise DecodeError('unrecognized', filepath)
+    if image_format == 'SVG':
+        if not _rasterizers:
+            raise DecodeError('unsupported', filepath)
+        # rasterized at the hash resolution only, the size of the drawing does not matter
+        return image_format, (0, 0), 'RGBA'
+
+    try:
+        with Image.open(filepath if data is None else io.BytesIO(data)) as image:
+            return image_format, image.size, image.mode
+    except Exception:
+        raise DecodeError('corrupt', filepath)
+
+
+def open_image(filepath, size, data=None):
+    if sniff_format(filepath, data) != 'SVG':
+        return Image.open(filepath if data is None else io.BytesIO(data))
+
+    # rasterizers read the drawing from its path, drawings are small enough to read twice
+    for rasterizer in _rasterizers:
+        try:
+            image = rasterizer(filepath, size).convert('RGBA')
+        except Exception:
+            continue
+        background = Image.new('RGBA', image.size, 'white')
+        return Image.alpha_composite(background, image).convert('RGB')
+    raise DecodeError('corrupt' if _rasterizers else 'unsupported', filepath)
+
+
+def load_image(image):
+    for decoder in _decoders.get(image.format, []):
+        try:
+            decoded = decoder(image)
+        except Exception:
+            continue
+        if decoded is not None:
+            return decoded
+    return image
@@ -0,0 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+
+def _read(filepath):
+    try:
+        with open(filepath, 'rb') as file:
+            return file.read()
+    except OSError:
+        return None
+
+
+class ReadAhead:
+    def __init__(self, filepaths, depth, max_bytes) -> None:
+        self._filepaths = iter(filepaths)
+        self._depth = depth
+        self._max_bytes = max_bytes
+        self._queue = deque()
+        self._exhausted = False
+
+        # reading is waiting on storage, so there can be more readers than cores
+        self._executor = ThreadPoolExecutor(max_workers=depth)
+
+    def _buffered(self) -> int:
+        return sum(len(future.result() or b'') for _, future in self._queue if future.done())
+
+    def _fill(self) -> None:
+        # files are read in directory order, which keeps the reads sequential on spinning disks
+        while not self._exhausted and len(self._queue) < self._depth and (not self._queue or self._buffered() < self._max_bytes):
+            filepath = next(self._filepaths, None)
+            if filepath is None:
+                self._exhausted = True
+                break
+            self._queue.append((filepath, self._executor.submit(_read, filepath)))
+
+    def ready(self) -> bool:
+        self._fill()
+        return bool(self._queue) and self._queue[0][1].done()
+
+    def waiting(self) -> set:
+        self._fill()
+        return {self._queue[0][1]} if self._queue else set()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        self._fill()
+        if not self._queue:
+            self.close()
+            raise StopIteration
+
+        filepath, future = self._queue.popleft()
+        data = future.result()
+        self._fill()
+        return filepath, data
+
+    def close(self) -> None:
+        self._exhausted = True
+        self._queue.clear()
+        self._executor.shutdown(wait=False, cancel_futures=True)
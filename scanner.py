@@ -0,0 +1,1488 @@
+from ImageHash import (
+    hex_to_multihash,
+    paired_distances,
+    hex_to_packed,
+    hex_to_hash,
+    preprocess,
+
+    crop_resistant_hash,
+    colorhash,
+    ahash,
+    dhash,
+    phash,
+    rhash,
+)
+from PySide6 import QtCore
+from concurrent.futures import (
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed
+)
+from blocked_comparison import (
+    compare_shared_tile,
+    HashBuckets,
+    cross_tile_pairs,
+    max_distance_bits,
+    publish_hashes,
+    export_hashes,
+    compare_tile,
+    merge_runs,
+    write_run,
+    tile_pairs,
+    tile_size,
+)
+from ImageHash.kernels import tile_matches
+from similarity_graph import SimilarityGraph
+from image_catalog import (
+    is_catalog_file,
+    export_catalog,
+    import_catalog,
+    ImageCatalog,
+)
+from similarity_index import HashIndex
+from hashing_scheduler import MemoryScheduler
+from calibration import (
+    sample_files,
+    calibrate,
+)
+from image_decoder import (
+    IMAGE_EXTENSIONS,
+    open_image,
+    load_image,
+)
+from watch_mode import FolderWatcher
+from application_path import application_path
+from app_settings import settings
+from PIL import (
+    ExifTags,
+    Image,
+)
+import itertools
+import argparse
+import datetime
+import platform
+import hashlib
+import shutil
+import json
+import time
+import zlib
+import io
+import numpy as np
+import peewee
+import math
+import sys
+import os
+
+database = peewee.SqliteDatabase(os.path.join(application_path(), 'processing.sqlite3'))
+scratch_path = os.path.join(application_path(), 'processing')
+library_path = os.path.join(QtCore.QStandardPaths.writableLocation(QtCore.QStandardPaths.StandardLocation.GenericDataLocation), 'DropDup')
+library_database = peewee.SqliteDatabase(os.path.join(library_path, 'library.sqlite3'))
+
+algorithms = {
+    'rhash': rhash,
+    'phash': phash,
+    'ahash': ahash,
+    'dhash': dhash,
+    'colorhash': colorhash,
+}
+
+
+def get_dublicates(group, catalog=None):
+    images = (catalog if catalog is not None else ImageCatalog.load(ProcessedImage, group)).select(group)
+    records = images.records
+    centrality = {image_id: rank for rank, image_id in enumerate(SimilarityGraph.load(ImageSimilarity, group).rank(list(group)))}
+    original_image = max(range(len(images)), key=lambda idx: (records['reference'][idx], int(records['image_width'][idx]) * int(records['image_height'][idx]),
+                                                              records['image_dpi'][idx], -centrality.get(int(records['id'][idx]), len(group))))
+
+    # a file that is also in a reference library is kept whichever row of the group it is
+    reference_paths = {os.path.abspath(images.paths[idx]) for idx in range(len(images)) if records['reference'][idx]}
+    return [images.paths[idx] for idx in range(len(images)) if idx != original_image and not records['reference'][idx] and
+            os.path.abspath(images.paths[idx]) not in reference_paths]
+
+
+def _group_catalog(groups, catalog):
+    return catalog if catalog is not None else ImageCatalog.load(ProcessedImage, [image_id for group in groups for image_id in group])
+
+
+def remove_groups(groups, catalog=None):
+    catalog = _group_catalog(groups, catalog)
+    for group in groups:
+        dublicates = get_dublicates(group, catalog)
+        for image_path in dublicates:
+            os.remove(image_path)
+
+
+def move_groups(groups, path_to_duplicates, catalog=None):
+    catalog = _group_catalog(groups, catalog)
+    for group in groups:
+        dublicates = get_dublicates(group, catalog)
+        for image_path in dublicates:
+            shutil.move(image_path, os.path.join(path_to_duplicates, os.path.split(image_path)[1]))
+
+
+def remove_files(ids):
+    images = ProcessedImage.select().where(ProcessedImage.id.in_(ids) & (ProcessedImage.image_role != 'reference'))
+    for image in images:
+        os.remove(image.image_path)
+
+
+def move_files(ids, path_to_duplicates):
+    images = ProcessedImage.select().where(ProcessedImage.id.in_(ids) & (ProcessedImage.image_role != 'reference'))
+    for image in images:
+        image_path = image.image_path
+        shutil.move(image_path, os.path.join(path_to_duplicates, os.path.split(image_path)[1]))
+
+
+def update_groups(groups, processed_images):
+    new_groups = []
+
+    for group in groups:
+        new_groups.append([image_id for image_id in group if image_id not in processed_images])
+
+    return new_groups
+
+
+def group_size_distribution(groups):
+    # group counts by size, in power of two buckets
+    buckets = {}
+    for size in sorted(len(group) for group in groups):
+        upper = 1 << (size - 1).bit_length()
+        label = str(size) if size <= 2 else f'{upper // 2 + 1}-{upper}'
+        buckets[label] = buckets.get(label, 0) + 1
+    return buckets
+
+
+def unfinished_scan():
+    try:
+        return ScanCheckpoint.select().where(ScanCheckpoint.phase != 'done').exists()
+    except peewee.DatabaseError:
+        return False
+
+
+def library_roots():
+    return [tuple(root.split(':', 1)) for root in settings.value('library_roots', [], list)]
+
+
+def _is_under(path, root):
+    path, root = os.path.abspath(path), os.path.abspath(root)
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def _is_image(filename):
+    _, ext = os.path.splitext(filename)
+    if ext.lower() in IMAGE_EXTENSIONS:
+        return True
+    return False
+
+
+def count_files(path, check_subdirectories=False):
+    if check_subdirectories:
+        return sum(1 for root, dirs, files in os.walk(path) for name in files if _is_image(os.path.join(root, name)))
+    else:
+        return sum(1 for name in os.listdir(path) if _is_image(os.path.join(path, name)))
+
+
+def file_generator(path, check_subdirectories=False):
+    if check_subdirectories:
+        for root, dirs, files in os.walk(path):
+            for name in files:
+                if _is_image(os.path.join(root, name)):
+                    yield os.path.join(root, name)
+    else:
+        for name in os.listdir(path):
+            if _is_image(os.path.join(path, name)):
+                yield os.path.join(path, name)
+
+
+def in_shard(relative_path, shard_index, shard_count):
+    # nodes may mount the folder in different places, so the path relative to the scanned folder decides the shard
+    return zlib.crc32(relative_path.replace(os.sep, '/').encode()) % shard_count == shard_index
+
+
+def ID_generator(ids):
+    for idx, id1 in enumerate(ids):
+        for id2 in ids[idx + 1:]:
+            yield (id1, id2)
+
+
+def _hash_kwargs(algorithm_str, hash_size, preprocessing='filter-resize'):
+    kwargs = {
+        'hash_size': hash_size,
+        'preprocessing': preprocessing,
+    }
+    if algorithm_str == 'rhash':
+        kwargs['block_size'] = hash_size * 2
+    elif algorithm_str == 'phash':
+        kwargs['highfreq_factor'] = hash_size * 2
+    elif algorithm_str == 'colorhash':
+        kwargs = {
+            'binbits': int(math.log2(hash_size)) + 1,
+            'image_size': 128,
+            'preprocessing': preprocessing,
+        }
+
+    return kwargs
+
+
+def _hash_resolution(kwargs):
+    if 'block_size' in kwargs:
+        return kwargs['hash_size'] * kwargs['block_size']
+    elif 'highfreq_factor' in kwargs:
+        return kwargs['hash_size'] * kwargs['highfreq_factor']
+    elif 'image_size' in kwargs:
+        return kwargs['image_size']
+    return kwargs['hash_size'] + 1
+
+
+def _exif_thumbnail(image, resolution, max_bar_deviation: float = 8.0):
+    try:
+        ifd1 = image.getexif().get_ifd(ExifTags.IFD.IFD1)
+        offset, length = ifd1[0x0201], ifd1[0x0202]
+        exif = image.info['exif']
+        if exif.startswith(b'Exif\x00\x00'):
+            exif = exif[6:]
+        thumbnail = Image.open(io.BytesIO(exif[offset: offset + length]))
+        thumbnail.load()
+    except Exception:
+        return None
+
+    width, height = image.size
+    thumbnail_width, thumbnail_height = thumbnail.size
+    aspect, thumbnail_aspect = width / height, thumbnail_width / thumbnail_height
+    if (aspect - 1) * (thumbnail_aspect - 1) < 0:
+        return None
+
+    if abs(thumbnail_aspect / aspect - 1) > 0.02:
+        if thumbnail_aspect < aspect:
+            content_height = round(thumbnail_width / aspect)
+            top = (thumbnail_height - content_height) // 2
+            box = (0, top, thumbnail_width, top + content_height)
+        else:
+            content_width = round(thumbnail_height * aspect)
+            left = (thumbnail_width - content_width) // 2
+            box = (left, 0, left + content_width, thumbnail_height)
+
+        pixels = np.asarray(thumbnail.convert('L'), dtype=np.float32)
+        mask = np.ones(pixels.shape, dtype=bool)
+        mask[box[1]: box[3], box[0]: box[2]] = False
+        if pixels[mask].std() > max_bar_deviation:
+            return None
+        thumbnail = thumbnail.crop(box)
+
+    if max(thumbnail.size) < resolution:
+        return None
+
+    return thumbnail
+
+
+def _hash_image(filepath, algorithm, algorithm_str, hash_size, use_crop_resistant_hash, coarse_hash_size=None, preprocessing='filter-resize', use_thumbnail=False, use_color_prefilter=False, data=None):
+    image_hash = ''
+    coarse_hash = None
+
+    kwargs = _hash_kwargs(algorithm_str, hash_size, preprocessing)
+    image = open_image(filepath, 600 if use_crop_resistant_hash else _hash_resolution(kwargs), data)
+
+    source = None
+    if use_thumbnail and not use_crop_resistant_hash:
+        source = _exif_thumbnail(image, _hash_resolution(kwargs))
+    if source is None:
+        source = load_image(image)
+
+    if use_crop_resistant_hash:
+        image_hash = crop_resistant_hash(source, algorithm, **kwargs)
+    elif coarse_hash_size:
+        luma = preprocess(source, _hash_resolution(kwargs), preprocessing)
+        image_hash = algorithm(luma, preprocessed=True, **kwargs)
+        coarse_hash = algorithm(luma, preprocessed=True, **_hash_kwargs(algorithm_str, coarse_hash_size))
+    else:
+        image_hash = algorithm(source, **kwargs)
+        if use_color_prefilter:
+            coarse_hash = colorhash(source)
+
+    image_width, image_height = image.size
+    image_dpi = 72
+    if 'dpi' in image.info:
+        image_dpi = int(max(image.info['dpi']))
+    image_size = (os.path.getsize(filepath) if data is None else len(data)) / 1048576
+
+    processed_image_data = {
+        'image_hash': str(image_hash),
+        'image_path': filepath,
+        'image_width': image_width,
+        'image_height': image_height,
+        'image_dpi': image_dpi,
+        'image_size': image_size,
+    }
+    if coarse_hash is not None:
+        processed_image_data['image_coarse_hash'] = str(coarse_hash)
+
+    return processed_image_data
+
+
+def _calibration_key(paths, check_subdirectories):
+    # a calibration holds for this machine, these folders and the hashing it measured
+    key = '|'.join([platform.node(), str(os.cpu_count()), current_hash_parameters(), str(check_subdirectories)] + sorted(os.path.abspath(path) for path in paths))
+    return 'calibration/' + hashlib.sha1(key.encode()).hexdigest()
+
+
+def _files_key(filepaths):
+    return hashlib.sha1('\n'.join(sorted(os.path.abspath(filepath) for filepath in filepaths)).encode()).hexdigest()
+
+
+def hashing_tuning(paths=(), check_subdirectories=False, max_age: float = 30 * 24 * 3600, sample_size: int = 32):
+    tuning = {
+        'workers': settings.value('max_cores', os.cpu_count() or 1, int),
+        'engine': settings.value('hashing_engine', 'process', str),
+        'read_ahead': settings.value('read_ahead_depth', 0, int),
+        'target_seconds': 0.25,
+        'pair_chunk': 1,
+    }
+    if not paths or not settings.value('auto_tune', False, bool):
+        return tuning
+
+    key = _calibration_key(paths, check_subdirectories)
+    calibration = json.loads(settings.value(key, '{}', str))
+    if time.time() - calibration.get('calibrated', 0) > max_age:
+        sample, _ = sample_files((filepath for path in paths for filepath in file_generator(path, check_subdirectories)), sample_size)
+        if len(sample) < 2:
+            return tuning
+
+        algorithm_str = settings.value('algorithm', 'rhash', str)
+        args = (algorithms[algorithm_str], algorithm_str, settings.value('hash_size', 8, int), settings.value('use_crop_resistant_hash', False, bool), None,
+                settings.value('preprocessing_mode', 'filter-resize', str), settings.value('use_thumbnail_hashing', False, bool))
+        calibration = calibrate(sample, _hash_image, args, os.cpu_count() or 1,
+                                lambda image1, image2: _get_hash(image1['image_hash']) - _get_hash(image2['image_hash']))
+        calibration['calibrated'] = time.time()
+        settings.setValue(key, json.dumps(calibration))
+
+    tuning.update((name, calibration[name]) for name in tuning)
+    return tuning
+
+
+def create_hashing_executor(tuning=None):
+    tuning = tuning or hashing_tuning()
+    if tuning['engine'] == 'thread':
+        return ThreadPoolExecutor(max_workers=tuning['workers'])
+    return ProcessPoolExecutor(max_workers=tuning['workers'])
+
+
+def create_hashing_scheduler(executor, tuning=None):
+    tuning = tuning or hashing_tuning()
+    return MemoryScheduler(executor, settings.value('memory_budget', 1024, int), tuning['workers'],
+                           target_seconds=tuning['target_seconds'], read_ahead=tuning['read_ahead'])
+
+
+def _hash_parameters(algorithm_str, hash_size, use_crop_resistant_hash, preprocessing='filter-resize', use_thumbnail=False):
+    return (f'{algorithm_str}-{hash_size}{"-crop" if use_crop_resistant_hash else ""}'
+            f'{"-" + preprocessing if preprocessing != "filter-resize" else ""}{"-thumbnail" if use_thumbnail and not use_crop_resistant_hash else ""}')
+
+
+def current_hash_parameters():
+    return _hash_parameters(settings.value('algorithm', 'rhash', str), settings.value('hash_size', 8, int), settings.value('use_crop_resistant_hash', False, bool),
+                            settings.value('preprocessing_mode', 'filter-resize', str), settings.value('use_thumbnail_hashing', False, bool))
+
+
+def _get_hash(hex_hash):
+    return hex_to_hash(hex_hash) if ',' not in hex_hash else hex_to_multihash(hex_hash)
+
+
+_catalog = None
+
+
+def _init_comparison_worker(database_path):
+    global _catalog
+    database.init(database_path)
+    _catalog = None
+
+
+def _compare_images(id1, id2, threshold):
+    # every worker loads the hashes once, instead of two queries for every pair
+    global _catalog
+    if _catalog is None:
+        _catalog = ImageCatalog.load(ProcessedImage)
+
+    difference = _get_hash(_catalog.image_hash(id1)) - _get_hash(_catalog.image_hash(id2))
+
+    if (1 - difference) >= round(threshold / 100, 2):
+        return [id1, id2, difference]
+    return None
+
+
+def _compare_pairs(pairs, threshold):
+    return [result for result in (_compare_images(id1, id2, threshold) for id1, id2 in pairs) if result is not None]
+
+
+class ProcessedImage(peewee.Model):
+    class Meta:
+        database = database
+
+    id = peewee.IntegerField(primary_key=True)
+    image_path = peewee.TextField()
+    image_hash = peewee.TextField()
+    image_width = peewee.IntegerField()
+    image_height = peewee.IntegerField()
+    image_dpi = peewee.IntegerField()
+    image_size = peewee.FloatField()
+    image_role = peewee.TextField(default='incoming')
+    image_coarse_hash = peewee.TextField(null=True)
+
+
+class ImageSimilarity(peewee.Model):
+    class Meta:
+        database = database
+
+    image1 = peewee.IntegerField(index=True)
+    image2 = peewee.IntegerField(index=True)
+    distance = peewee.FloatField()
+
+
+class ScanCheckpoint(peewee.Model):
+    class Meta:
+        database = database
+
+    scan_key = peewee.TextField()
+    comparison_key = peewee.TextField(null=True)
+    phase = peewee.TextField(default='hashing')
+    tile_size = peewee.IntegerField(null=True)
+    files_key = peewee.TextField(null=True)
+
+
+class CompletedTile(peewee.Model):
+    class Meta:
+        database = database
+
+    id = peewee.IntegerField(primary_key=True)
+
+
+class ShardInfo(peewee.Model):
+    class Meta:
+        database = database
+
+    root = peewee.TextField()
+    hash_parameters = peewee.TextField()
+    duplicate_threshold = peewee.FloatField()
+
+
+class IndexedImage(peewee.Model):
+    class Meta:
+        database = library_database
+
+    id = peewee.IntegerField(primary_key=True)
+    image_path = peewee.TextField(unique=True)
+    image_hash = peewee.TextField()
+    image_width = peewee.IntegerField()
+    image_height = peewee.IntegerField()
+    image_dpi = peewee.IntegerField()
+    image_size = peewee.FloatField()
+    image_mtime = peewee.FloatField()
+    hash_parameters = peewee.TextField(index=True)
+
+
+class LibraryIndexer:
+    def __init__(self):
+        self._algorithm_str = settings.value('algorithm', 'rhash', str)
+        self._hash_size = settings.value('hash_size', 8, int)
+        self._use_crop_resistant_hash = settings.value('use_crop_resistant_hash', False, bool)
+        self._preprocessing = settings.value('preprocessing_mode', 'filter-resize', str)
+        self._use_thumbnail = settings.value('use_thumbnail_hashing', False, bool)
+        self._hash_parameters = _hash_parameters(self._algorithm_str, self._hash_size, self._use_crop_resistant_hash, self._preprocessing, self._use_thumbnail)
+
+        self.executor = None
+        self.scheduler = None
+        self.allow_work = True
+
+    def update(self, path, check_subdirectories=False, file_filter=_is_image):
+        os.makedirs(library_path, exist_ok=True)
+        with library_database:
+            library_database.create_tables([IndexedImage])
+
+        path = os.path.abspath(path)
+        indexed = {image.image_path: image for image in (IndexedImage
+                                                         .select()
+                                                         .where((IndexedImage.hash_parameters == self._hash_parameters) &
+                                                                IndexedImage.image_path.startswith(path + os.sep)))}
+        images = []
+        to_hash = []
+        for filepath in file_generator(path, check_subdirectories):
+            if not file_filter(filepath):
+                continue
+            image = indexed.pop(filepath, None)
+            if image is not None and image.image_mtime == os.path.getmtime(filepath):
+                images.append(image)
+            else:
+                to_hash.append(filepath)
+
+        IndexedImage.delete().where(IndexedImage.id.in_([image.id for image in indexed.values()])).execute()
+
+        if to_hash and self.allow_work:
+            tuning = hashing_tuning([path], check_subdirectories)
+            self.executor = create_hashing_executor(tuning)
+            self.scheduler = create_hashing_scheduler(self.executor, tuning)
+            algorithm = algorithms[self._algorithm_str]
+            for _, results in self.scheduler.map(_hash_image, to_hash, algorithm, self._algorithm_str, self._hash_size, self._use_crop_resistant_hash, None, self._preprocessing, self._use_thumbnail):
+                images.extend(self.store(result) for result in results if result is not None)
+            self.executor.shutdown()
+
+        return images
+
+    def hash(self, filepath):
+        return self.store(_hash_image(filepath, algorithms[self._algorithm_str], self._algorithm_str, self._hash_size, self._use_crop_resistant_hash, None, self._preprocessing, self._use_thumbnail))
+
+    def store(self, processed_image_data):
+        processed_image_data['image_mtime'] = os.path.getmtime(processed_image_data['image_path'])
+        processed_image_data['hash_parameters'] = self._hash_parameters
+        (IndexedImage
+         .insert(**processed_image_data)
+         .on_conflict(conflict_target=[IndexedImage.image_path], preserve=list(processed_image_data.keys()))
+         .execute())
+        return IndexedImage.get(IndexedImage.image_path == processed_image_data['image_path'])
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.allow_work = False
+
+
+class FindDuplicatesThread(QtCore.QThread):
+    process_signal = QtCore.Signal(float)
+    group_signal = QtCore.Signal(list, object)
+
+    def __init__(self, path, shard=None):
+        QtCore.QThread.__init__(self)
+        self._path = path
+        # files in reference libraries are matched against the index, they are never scanned as incoming images
+        self._references = [root for role, root in library_roots() if role == 'reference']
+        self._paths = [path]
+        for role, root in library_roots():
+            if role == 'incoming' and os.path.isdir(root) and not any(_is_under(root, reference) for reference in self._references) and \
+                    os.path.abspath(root) not in map(os.path.abspath, self._paths):
+                self._paths.append(root)
+        self._shard = shard
+        self._processed_images = 0
+        self._progress = 0
+
+        self.duplicates = []
+        self.full_duplicates = []
+        self.skipped = {}
+        self.graph = SimilarityGraph()
+        self.catalog = None
+        self._hashes = {}
+        self._streamed = set()
+        self._streamed_at = 0.0
+        self.buckets = HashBuckets()
+
+        self.tuning = hashing_tuning()
+
+        self.executor = None
+        self.scheduler = None
+        self.results = []
+        self.allow_work = True
+        self.indexer = LibraryIndexer()
+
+    def create_executor(self):
+        # workers read the hashes from whichever processing database this scan uses
+        self.executor = ProcessPoolExecutor(max_workers=self.tuning['workers'], initializer=_init_comparison_worker, initargs=(database.database,))
+        self.results = []
+
+    def run(self):
+        self.process_signal.emit(self._progress)
+
+        self.__open_checkpoint()
+        self.tuning = hashing_tuning(self._paths, settings.value('check_subdirectories', False, bool))
+        self.__create_images_hash()
+        if not self.allow_work:
+            return
+        self.__stream_full_duplicates()
+        self.__start_comparison()
+        self.duplicates = self.__find_duplicates()
+        if not self.allow_work:
+            return
+        if any(role == 'reference' for role, _ in library_roots()):
+            self.duplicates = self.__match_references()
+        if settings.value('grouping_mode', 'connected', str) == 'leader':
+            self.duplicates = self.graph.clusters(settings.value('max_group_size', 50, int))
+        self.catalog = ImageCatalog.load(ProcessedImage)
+        self.full_duplicates = self.__find_full_duplicates()
+        with database.atomic():
+            ImageSimilarity.delete().execute()
+            self.graph.save(ImageSimilarity)
+            self.checkpoint.phase = 'done'
+            self.checkpoint.save()
+        shutil.rmtree(scratch_path, ignore_errors=True)
+
+        # one matrix per group, from the stored edges of that group only, gives both its order and its average distance
+        ranked = []
+        for group in self.duplicates:
+            group_graph = SimilarityGraph.load(ImageSimilarity, group)
+            matrix = group_graph.group_matrix(group, self.__calculate_difference)
+            ranked.append((group_graph.rank(group, matrix=matrix), group_graph.average_distance(group, matrix=matrix)))
+        sorting_mode = settings.value('sorting_mode', 'h-l', str)
+
+        if sorting_mode == 'h-l':
+            ranked = sorted(ranked, key=lambda group: group[1])
+        elif sorting_mode == 'l-h':
+            ranked = sorted(ranked, key=lambda group: group[1], reverse=True)
+        self.duplicates = [group for group, _ in ranked]
+
+        self.process_signal.emit(100)
+
+    def __emit_groups(self, groups):
+        if groups:
+            self.group_signal.emit(groups, ImageCatalog.load(ProcessedImage, [image_id for group in groups for image_id in group]))
+
+    def __stream_full_duplicates(self):
+        # groups of identical hashes are duplicates whatever the comparison finds, they may still grow
+        if self.allow_work:
+            rows = (ProcessedImage
+                    .select(peewee.fn.GROUP_CONCAT(ProcessedImage.id))
+                    .group_by(ProcessedImage.image_hash)
+                    .having(peewee.fn.COUNT(ProcessedImage.id) > 1))
+            self.__emit_groups([sorted(int(image_id) for image_id in ids.split(',')) for ids, in rows.tuples()])
+
+    def __stream_groups(self, is_compared, force=False):
+        # a component whose images are compared with every other image can not change any more, it is sent once;
+        # reference images and leader clusters regroup images after the comparison, so only the final groups count there
+        if (not force and time.monotonic() - self._streamed_at < 1.0) or settings.value('grouping_mode', 'connected', str) != 'connected' or \
+                any(role == 'reference' for role, _ in library_roots()):
+            return
+        self._streamed_at = time.monotonic()
+        groups = [group for group in self.graph.components() if group[0] not in self._streamed and is_compared(group)]
+        self._streamed.update(group[0] for group in groups)
+        self.__emit_groups(groups)
+
+    def __calculate_difference(self, id1, id2):
+        for image_id in (id1, id2):
+            if image_id not in self._hashes:
+                self._hashes[image_id] = _get_hash(self.catalog.image_hash(image_id))
+
+        return self._hashes[id1] - self._hashes[id2]
+
+    def __scan_key(self):
+        hash_parameters = current_hash_parameters()
+        paths = '|'.join(os.path.abspath(path) for path in self._paths)
+        return (f'{paths}-{settings.value("check_subdirectories", False, bool)}-{hash_parameters}-{self.__coarse_hash_size()}-{self.__use_color_prefilter()}'
+                f'{"-shard-{}-{}".format(*self._shard) if self._shard is not None else ""}')
+
+    def __comparison_key(self):
+        return (f'{settings.value("comparison_mode", "pairwise", str)}-{settings.value("duplicate_threshold", 97.0, float)}-'
+                f'{settings.value("cascade_threshold", 85.0, float)}')
+
+    def __open_checkpoint(self):
+        # an unfinished scan of the same folders with the same hashing settings is resumed instead of started over
+        scan_key = self.__scan_key()
+        with database:
+            checkpoint = None
+            if database.table_exists(ScanCheckpoint._meta.table_name):
+                try:
+                    checkpoint = ScanCheckpoint.get_or_none(ScanCheckpoint.scan_key == scan_key)
+                except peewee.DatabaseError:
+                    pass
+
+            if checkpoint is None or checkpoint.phase == 'done':
+                database.drop_tables([ProcessedImage, ImageSimilarity, ScanCheckpoint, CompletedTile])
+                database.create_tables([ProcessedImage, ImageSimilarity, ScanCheckpoint, CompletedTile])
+                checkpoint = ScanCheckpoint.create(scan_key=scan_key)
+            else:
+                # reference images are matched again after the comparison
+                ProcessedImage.delete().where(ProcessedImage.image_role == 'reference').execute()
+                self.__update_files(checkpoint)
+
+        self.checkpoint = checkpoint
+        self._processed_images = ProcessedImage.select().count()
+
+    def __update_files(self, checkpoint):
+        # files may have changed while the scan was stopped: images of deleted files are dropped,
+        # and files added after the hashing send the scan back to hash them and compare again
+        filepaths = list(self.__files(settings.value('check_subdirectories', False, bool)))
+        existing = set(filepaths)
+        deleted = [image_id for image_id, image_path in ProcessedImage.select(ProcessedImage.id, ProcessedImage.image_path).tuples() if image_path not in existing]
+        with database.atomic():
+            for start in range(0, len(deleted), 999):
+                ProcessedImage.delete().where(ProcessedImage.id.in_(deleted[start: start + 999])).execute()
+            if checkpoint.phase != 'hashing' and checkpoint.files_key != _files_key(filepaths):
+                checkpoint.phase = 'hashing'
+                checkpoint.comparison_key = None
+                checkpoint.save()
+
+    def __start_comparison(self):
+        comparison_key = self.__comparison_key()
+        if self.checkpoint.comparison_key != comparison_key:
+            with database.atomic():
+                ImageSimilarity.delete().execute()
+                CompletedTile.delete().execute()
+                self.checkpoint.comparison_key = comparison_key
+                self.checkpoint.tile_size = None
+                self.checkpoint.save()
+
+        self.graph = SimilarityGraph.load(ImageSimilarity)
+
+    def __representatives(self, cascade=False):
+        # one image for every distinct hash is compared, the rest of its bucket takes over its matches
+        fields = [ProcessedImage.id, ProcessedImage.image_coarse_hash if cascade else ProcessedImage.image_hash, ProcessedImage.image_hash]
+        rows = list(ProcessedImage.select(*fields).order_by(ProcessedImage.id).tuples())
+        ids = np.array([row[0] for row in rows], dtype=np.int64)
+        self.buckets = HashBuckets.from_hashes(ids, [f'{row[1]}|{row[2]}' for row in rows])
+        return [rows[position] for position in np.searchsorted(ids, self.buckets.representatives)]
+
+    def __complete_buckets(self):
+        # matches inside the buckets are stored like a tile, so a resumed comparison does not add them twice
+        if not CompletedTile.select().where(CompletedTile.id == -1).exists():
+            self.__complete_tile(-1, *self.buckets.internal())
+
+    def __complete_tile(self, idx, image1, image2, distance):
+        with database.atomic():
+            if len(image1):
+                self.graph.add_edges(image1, image2, distance)
+                SimilarityGraph(image1, image2, distance).save(ImageSimilarity)
+            CompletedTile.create(id=idx)
+
+    def __tile_size(self, count, hash_bytes):
+        # tiles of a resumed comparison must match the ones already completed
+        if self.checkpoint.tile_size is None:
+            self.checkpoint.tile_size = tile_size(count, hash_bytes, settings.value('memory_budget', 1024, int), self.tuning['workers'])
+            self.checkpoint.save()
+        return self.checkpoint.tile_size
+
+    def __create_images_hash(self, max_progress: int = 60):
+        if self.checkpoint.phase != 'hashing':
+            self._progress += max_progress
+            self.process_signal.emit(self._progress)
+            return
+
+        self.executor = create_hashing_executor(self.tuning)
+        self.scheduler = create_hashing_scheduler(self.executor, self.tuning)
+
+        algorithm_str = settings.value('algorithm', 'rhash', str)
+        algorithm = algorithms[algorithm_str]
+        use_crop_resistant_hash = settings.value('use_crop_resistant_hash', False, bool)
+        hash_size = settings.value('hash_size', 8, int)
+        coarse_hash_size = self.__coarse_hash_size()
+        use_color_prefilter = self.__use_color_prefilter()
+        preprocessing = settings.value('preprocessing_mode', 'filter-resize', str)
+        use_thumbnail = settings.value('use_thumbnail_hashing', False, bool)
+
+        check_subdirectories = settings.value('check_subdirectories', False, bool)
+        if self._shard is None and not self._references:
+            iterations = sum(count_files(path, check_subdirectories) for path in self._paths)
+        else:
+            iterations = sum(1 for _ in self.__files(check_subdirectories))
+        hashed = set(ProcessedImage.select(ProcessedImage.image_path).scalars())
+        walked = []
+        files = (filepath for filepath in self.__files(check_subdirectories, walked) if filepath not in hashed)
+        if iterations > 1 and self.allow_work:
+            step = max_progress / iterations
+            self._progress += step * len(hashed)
+            processed_images = []
+            for filepaths, results in self.scheduler.map(_hash_image, files, algorithm, algorithm_str, hash_size, use_crop_resistant_hash, coarse_hash_size, preprocessing, use_thumbnail, use_color_prefilter):
+                processed_images.extend(result for result in results if result is not None)
+                if len(processed_images) >= 256:
+                    self.__store_images(processed_images)
+                    processed_images = []
+                self._progress += step * len(filepaths)
+                self.process_signal.emit(self._progress)
+            self.__store_images(processed_images)
+
+            self.skipped = dict(self.scheduler.rejected)
+            if self.scheduler.failed:
+                self.skipped['failed'] = self.scheduler.failed
+        else:
+            self._progress += max_progress
+            self.process_signal.emit(self._progress)
+
+        self.executor.shutdown()
+        if self.allow_work:
+            self.checkpoint.phase = 'comparison'
+            self.checkpoint.files_key = _files_key(walked or self.__files(check_subdirectories))
+            self.checkpoint.save()
+
+    def __files(self, check_subdirectories, walked=None):
+        for path in self._paths:
+            for filepath in file_generator(path, check_subdirectories):
+                if any(_is_under(filepath, reference) for reference in self._references):
+                    continue
+                if self._shard is None or in_shard(os.path.relpath(filepath, path), *self._shard):
+                    if walked is not None:
+                        walked.append(filepath)
+                    yield filepath
+
+    def __use_color_prefilter(self):
+        return (settings.value('use_hash_cascade', False, bool) and not settings.value('use_crop_resistant_hash', False, bool) and
+                settings.value('cascade_hash', 'structure', str) == 'color')
+
+    def __coarse_hash_size(self):
+        if (settings.value('use_hash_cascade', False, bool) and not settings.value('use_crop_resistant_hash', False, bool) and
+                settings.value('cascade_hash', 'structure', str) == 'structure' and settings.value('algorithm', 'rhash', str) != 'colorhash'):
+            coarse_hash_size = settings.value('cascade_hash_size', 8, int)
+            if coarse_hash_size < settings.value('hash_size', 8, int):
+                return coarse_hash_size
+        return None
+
+    def __store_images(self, processed_images):
+        if processed_images:
+            with database.atomic():
+                ProcessedImage.insert_many(processed_images).execute()
+            self._processed_images += len(processed_images)
+
+    def __find_duplicates_old(self, max_progress: int = 20):
+        if self._processed_images and self.allow_work:
+            step = max_progress / ((self._processed_images - 1) * self._processed_images // 2)
+            threshold = settings.value('duplicate_threshold', 97.0, float)
+            duplicates = {}
+
+            for current_image_idx in range(self._processed_images):
+                current_image = ProcessedImage.select().where(ProcessedImage.id == current_image_idx + 1).dicts().get()
+                current_hash = _get_hash(current_image['image_hash'])
+
+                for other_image_idx in range(current_image_idx + 1, self._processed_images):
+                    other_image = ProcessedImage.select().where(ProcessedImage.id == other_image_idx + 1).dicts().get()
+                    other_hash = _get_hash(other_image['image_hash'])
+                    difference = current_hash - other_hash
+
+                    if (1 - difference) >= round(threshold / 100, 2):
+                        duplicates[current_image_idx] = duplicates.get(current_image_idx, []) + [current_image, other_image]
+
+                    self._progress += step
+                    self.process_signal.emit(self._progress)
+
+            return self.__group_duplicates(list(duplicates.values()))
+
+        self._progress += max_progress
+        self.process_signal.emit(self._progress)
+
+        return self.__group_duplicates([])
+
+    def __find_duplicates(self, max_progress: int = 20):
+        if self._processed_images and self.allow_work:
+            comparison_mode = settings.value('comparison_mode', 'pairwise', str)
+            if self.__coarse_hash_size() is not None or self.__use_color_prefilter():
+                # the cascade compares tiles, out-of-core keeps both hashes on disk and any other mode shares them in memory
+                if comparison_mode == 'out-of-core':
+                    return self.__find_duplicates_blocked(max_progress, cascade=True)
+                return self.__find_duplicates_shared(max_progress, cascade=True)
+
+            if comparison_mode != 'pairwise' and not settings.value('use_crop_resistant_hash', False, bool):
+                if comparison_mode == 'shared-memory':
+                    return self.__find_duplicates_shared(max_progress)
+                elif comparison_mode == 'out-of-core':
+                    return self.__find_duplicates_blocked(max_progress)
+
+            self.create_executor()
+
+            representatives = [row[0] for row in self.__representatives()]
+            step = max_progress / max((len(representatives) - 1) * len(representatives) // 2, 1)
+            threshold = settings.value('duplicate_threshold', 97.0, float)
+            image1, image2, distance = self.buckets.internal()
+            self.graph.add_edges(image1, image2, distance)
+            duplicates = [[id1, id2] for id1, id2 in zip(image1.tolist(), image2.tolist())]
+
+            # pairs go out in chunks sized by the calibration, one pair per task when it is off
+            ids = ID_generator(representatives)
+            chunks = iter(lambda: list(itertools.islice(ids, self.tuning['pair_chunk'])), [])
+            self.results = {self.executor.submit(_compare_pairs, pairs, threshold): (len(pairs), pairs[0][0]) for pairs in chunks}
+            # pairs are submitted by their first image, every image before the first pair still running is compared with all others
+            pending = list(self.results)
+            compared = 0
+            for future in as_completed(self.results):
+                if not self.allow_work:
+                    break
+                matches = future.result()
+                if matches:
+                    image1, image2, distance = self.buckets.expand(*(np.array(column) for column in zip(*matches)))
+                    self.graph.add_edges(image1, image2, distance)
+                    duplicates.extend([id1, id2] for id1, id2 in zip(image1.tolist(), image2.tolist()))
+                self._progress += step * self.results[future][0]
+                self.process_signal.emit(self._progress)
+
+                while compared < len(pending) and pending[compared].done():
+                    compared += 1
+                bound = self.results[pending[compared]][1] if compared < len(pending) else math.inf
+                self.__stream_groups(lambda group: self.buckets.representatives_of(group).max() < bound, compared == len(pending))
+
+            self.executor.shutdown()
+            return self.__group_duplicates(duplicates)
+
+        self._progress += max_progress
+        self.process_signal.emit(self._progress)
+
+        return self.__group_duplicates([])
+
+    def __find_duplicates_shared(self, max_progress: int = 20, cascade: bool = False):
+        self.create_executor()
+
+        threshold = settings.value('duplicate_threshold', 97.0, float)
+        representatives = self.__representatives(cascade)
+        memory, shape, ids, hash_bits = publish_hashes(((image_id, image_hash) for image_id, image_hash, _ in representatives), len(representatives))
+
+        if cascade:
+            verify_hashes = np.stack([hex_to_packed(image_hash) for _, _, image_hash in representatives])
+            verify_bits = len(representatives[0][2]) * 4
+            verify_max_bits = max_distance_bits(threshold, verify_bits)
+            threshold = settings.value('cascade_threshold', 85.0, float)
+
+        if hash_bits:
+            max_bits = max_distance_bits(threshold, hash_bits)
+            tiles = list(tile_pairs(shape[0], self.__tile_size(shape[0], shape[1])))
+            self.__complete_buckets()
+            completed = set(CompletedTile.select(CompletedTile.id).where(CompletedTile.id >= 0).scalars())
+            step = max_progress / len(tiles)
+            self._progress += step * len(completed)
+
+            # an image is compared with all others once every tile of its block is done
+            size = self.__tile_size(shape[0], shape[1])
+            remaining = np.zeros(math.ceil(shape[0] / size), dtype=np.int64)
+            for idx, (rows, cols) in enumerate(tiles):
+                if idx not in completed:
+                    remaining[rows[0] // size] += 1
+                    remaining[cols[0] // size] += rows != cols
+
+            try:
+                self.results = {self.executor.submit(compare_shared_tile, memory.name, shape, rows, cols, max_bits): idx
+                                for idx, (rows, cols) in enumerate(tiles) if idx not in completed}
+                for future in as_completed(self.results):
+                    if not self.allow_work:
+                        break
+                    row_idx, col_idx, distances = future.result()
+                    if cascade and len(row_idx):
+                        distances = paired_distances(verify_hashes[row_idx], verify_hashes[col_idx])
+                        matches = distances <= verify_max_bits
+                        row_idx, col_idx, distances = row_idx[matches], col_idx[matches], distances[matches]
+                    self.__complete_tile(self.results[future], *self.buckets.expand(ids[row_idx], ids[col_idx], distances / (verify_bits if cascade else hash_bits)))
+                    self._progress += step
+                    self.process_signal.emit(self._progress)
+
+                    rows, cols = tiles[self.results[future]]
+                    remaining[rows[0] // size] -= 1
+                    remaining[cols[0] // size] -= rows != cols
+                    self.__stream_groups(lambda group: not remaining[np.searchsorted(ids, self.buckets.representatives_of(group)) // size].any(), not remaining.any())
+            finally:
+                self.executor.shutdown()
+                memory.close()
+                memory.unlink()
+        else:
+            self.executor.shutdown()
+            self._progress += max_progress
+            self.process_signal.emit(self._progress)
+
+        groups = self.graph.components()
+
+        self._progress += 5
+        self.process_signal.emit(self._progress)
+
+        return groups
+
+    def __find_duplicates_blocked(self, max_progress: int = 20, cascade: bool = False):
+        self.create_executor()
+        # runs of completed tiles are kept for a resumed comparison
+        if not CompletedTile.select().exists():
+            shutil.rmtree(scratch_path, ignore_errors=True)
+        os.makedirs(scratch_path, exist_ok=True)
+
+        threshold = settings.value('duplicate_threshold', 97.0, float)
+        representatives = self.__representatives(cascade)
+        hashes_path, ids_path, hash_bits = export_hashes(((image_id, image_hash) for image_id, image_hash, _ in representatives), len(representatives), scratch_path)
+        buckets_path = self.buckets.save(scratch_path)
+        verify = None
+        if cascade:
+            verify_path, _, verify_bits = export_hashes(((image_id, image_hash) for image_id, _, image_hash in representatives), len(representatives), scratch_path, 'verify_hashes')
+            verify = (verify_path, max_distance_bits(threshold, verify_bits), verify_bits)
+            threshold = settings.value('cascade_threshold', 85.0, float)
+        run_paths = []
+
+        if hash_bits:
+            count, hash_bytes = np.load(hashes_path, mmap_mode='r').shape
+            max_bits = max_distance_bits(threshold, hash_bits)
+            tiles = list(tile_pairs(count, self.__tile_size(count, hash_bytes)))
+            completed = set(CompletedTile.select(CompletedTile.id).scalars())
+            run_paths = [os.path.join(scratch_path, f'run_{idx}.npy') for idx in sorted(completed)]
+            run_paths = [run_path for run_path in run_paths if os.path.exists(run_path)]
+            # the matches inside the buckets are written again, they follow from the hashes alone
+            run_paths.append(write_run(*self.buckets.internal(), os.path.join(scratch_path, 'run_buckets.npy')))
+            run_paths = [run_path for run_path in run_paths if run_path is not None]
+            step = max_progress / len(tiles)
+            self._progress += step * len(completed)
+
+            self.results = {self.executor.submit(compare_tile, hashes_path, ids_path, rows, cols, max_bits, hash_bits, os.path.join(scratch_path, f'run_{idx}.npy'), buckets_path, verify): idx
+                            for idx, (rows, cols) in enumerate(tiles) if idx not in completed}
+            for future in as_completed(self.results):
+                if not self.allow_work:
+                    break
+                run_path = future.result()
+                if run_path is not None:
+                    run_paths.append(run_path)
+                CompletedTile.create(id=self.results[future])
+                self._progress += step
+                self.process_signal.emit(self._progress)
+        else:
+            self._progress += max_progress
+            self.process_signal.emit(self._progress)
+
+        self.executor.shutdown()
+        if not self.allow_work:
+            return []
+
+        self.graph = SimilarityGraph.from_edges(merge_runs(sorted(run_paths), os.path.join(scratch_path, 'edges.npy')))
+        groups = self.graph.components()
+
+        self._progress += 5
+        self.process_signal.emit(self._progress)
+
+        return groups
+
+    def __match_references(self):
+        index = HashIndex()
+        references = {}
+        for role, path in library_roots():
+            if role == 'reference' and os.path.isdir(path) and self.allow_work:
+                images = self.indexer.update(path, settings.value('check_subdirectories', False, bool))
+                index.add_many([image.id for image in images], [image.image_hash for image in images])
+                references.update({image.id: image for image in images})
+
+        max_distance = 1 - round(settings.value('duplicate_threshold', 97.0, float) / 100, 2)
+        processed_references = {}
+        processed_images = list(ProcessedImage.select(ProcessedImage.id, ProcessedImage.image_path, ProcessedImage.image_hash).tuples())
+        # a scanned file that is also indexed would match its own row
+        scanned = {os.path.abspath(image_path) for _, image_path, _ in processed_images}
+        for image_id, _, image_hash in processed_images:
+            if not self.allow_work:
+                break
+            for indexed_id, distance in index.query(image_hash, max_distance=max_distance):
+                if references[indexed_id].image_path in scanned:
+                    continue
+                if indexed_id not in processed_references:
+                    reference = references[indexed_id]
+                    processed_references[indexed_id] = ProcessedImage.create(image_path=reference.image_path,
+                                                                             image_hash=reference.image_hash,
+                                                                             image_width=reference.image_width,
+                                                                             image_height=reference.image_height,
+                                                                             image_dpi=reference.image_dpi,
+                                                                             image_size=reference.image_size,
+                                                                             image_role='reference').id
+                self.graph.add_edge(image_id, processed_references[indexed_id], distance)
+
+        return self.graph.components()
+
+    def __find_full_duplicates(self, max_progress: int = 10):
+        if self.allow_work:
+            full_duplicates = {}
+            subquery_hash = (ProcessedImage
+                             .select(ProcessedImage.image_hash)
+                             .group_by(ProcessedImage.image_hash)
+                             .having(peewee.fn.COUNT(ProcessedImage.image_hash) > 1))
+
+            duplicates = list(ProcessedImage.select().where(ProcessedImage.image_hash.in_(subquery_hash)).dicts())
+            if len(duplicates):
+                step = max_progress / len(duplicates)
+
+                for image in duplicates:
+                    full_duplicates[image['image_hash']] = full_duplicates.get(image['image_hash'], []) + [image['id']]
+
+                    self._progress += step
+                    self.process_signal.emit(self._progress)
+
+                return self.__group_duplicates(list(full_duplicates.values()))
+
+        self._progress += max_progress
+        self.process_signal.emit(self._progress)
+
+        return self.__group_duplicates([])
+
+    def __group_duplicates(self, duplicates, max_progress: int = 5):
+        if len(duplicates):
+            step = max_progress / len(duplicates)
+            groups = {}
+
+            for duplicate_group in duplicates:
+                duplicate_group_key = set([image_id for image_id in duplicate_group])
+                to_union = []
+                for key in groups.keys():
+                    if not duplicate_group_key.isdisjoint(set(key)):
+                        to_union.append(key)
+
+                if len(to_union):
+                    new_key = duplicate_group_key
+                    group = duplicate_group
+
+                    for key in to_union:
+                        new_key = new_key.union(key)
+                        old_group = groups.pop(key)
+                        for duplicate in old_group:
+                            if duplicate not in group:
+                                group.append(duplicate)
+
+                    groups[tuple(new_key)] = group
+
+                else:
+                    groups[tuple(duplicate_group_key)] = duplicate_group
+
+                self._progress += step
+                self.process_signal.emit(self._progress)
+
+            return list(groups.values())
+
+        self._progress += max_progress
+        self.process_signal.emit(self._progress)
+
+        return []
+
+    def stop(self):
+        if self.scheduler is not None:
+            self.scheduler.stop()
+        for future in self.results:
+            future.cancel()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        self.indexer.stop()
+        self.allow_work = False
+
+
+class WatchDuplicatesThread(QtCore.QThread):
+    group_signal = QtCore.Signal(list)
+
+    def __init__(self, path):
+        QtCore.QThread.__init__(self)
+        self._path = os.path.abspath(path)
+        self._max_distance = 1 - round(settings.value('duplicate_threshold', 97.0, float) / 100, 2)
+        self._check_subdirectories = settings.value('check_subdirectories', False, bool)
+        self._path_to_duplicates = os.path.join(self._path, settings.value('duplicate_folder_name', 'Duplicates', str))
+
+        self.index = HashIndex()
+        self.queued = []
+        self.watcher = FolderWatcher(self._path, self._check_subdirectories, self._is_watched)
+        self.indexer = LibraryIndexer()
+        self.allow_work = True
+
+    def _is_watched(self, path):
+        return _is_image(path) and not path.startswith(self._path_to_duplicates + os.sep)
+
+    def run(self):
+        # watch mode reuses the tables of a scan, so an unfinished scan can not be resumed after it
+        with database:
+            database.drop_tables([ProcessedImage, ImageSimilarity, ScanCheckpoint, CompletedTile])
+            database.create_tables([ProcessedImage, ImageSimilarity])
+
+        self.watcher.start()
+        for image in self.indexer.update(self._path, self._check_subdirectories, self._is_watched):
+            self.index.add(image.id, image.image_hash)
+
+        while self.allow_work:
+            for kind, path in self.watcher.get_events():
+                if not self.allow_work:
+                    break
+                if kind == 'deleted' or not os.path.isfile(path):
+                    self.__forget(path)
+                else:
+                    self.__process_file(path)
+
+        self.watcher.stop()
+
+    def __forget(self, filepath):
+        image = IndexedImage.get_or_none(IndexedImage.image_path == filepath)
+        if image is not None:
+            self.index.remove(image.id)
+            image.delete_instance()
+
+    def __process_file(self, filepath):
+        try:
+            image = self.indexer.hash(filepath)
+        except Exception:
+            return
+
+        self.index.remove(image.id)
+        matches = self.index.query(image.image_hash, max_distance=self._max_distance)
+        self.index.add(image.id, image.image_hash)
+
+        if matches:
+            self.__process_group(image, matches)
+
+    def __process_group(self, image, matches):
+        images = {indexed_image.id: indexed_image for indexed_image in IndexedImage.select().where(IndexedImage.id.in_([image_id for image_id, _ in matches]))}
+        group = []
+        for indexed_image in [image] + [images[image_id] for image_id, _ in matches if image_id in images]:
+            group.append(ProcessedImage.create(image_path=indexed_image.image_path,
+                                               image_hash=indexed_image.image_hash,
+                                               image_width=indexed_image.image_width,
+                                               image_height=indexed_image.image_height,
+                                               image_dpi=indexed_image.image_dpi,
+                                               image_size=indexed_image.image_size).id)
+        SimilarityGraph([group[0]] * (len(group) - 1), group[1:], [distance for image_id, distance in matches if image_id in images]).save(ImageSimilarity)
+
+        action_mode = settings.value('action_mode', 'manual', str)
+        full_duplicates = all(distance == 0 for _, distance in matches)
+        if action_mode == 'auto' or (action_mode == 'semi-auto' and full_duplicates):
+            catalog = ImageCatalog.load(ProcessedImage, group)
+            dublicates = get_dublicates(group, catalog)
+            if settings.value('duplicates_action', 'move', str) == 'move':
+                os.makedirs(self._path_to_duplicates, exist_ok=True)
+                move_groups([group], self._path_to_duplicates, catalog)
+            else:
+                remove_groups([group], catalog)
+            for filepath in dublicates:
+                self.__forget(filepath)
+        else:
+            self.queued.append(group)
+            self.group_signal.emit(group)
+
+    def stop(self):
+        self.indexer.stop()
+        self.allow_work = False
+
+
+def scan_shard(path, shard_path, shard_index=0, shard_count=1):
+    global scratch_path
+    database.init(shard_path)
+    scratch_path = shard_path + '.scratch'
+    root = os.path.abspath(path)
+
+    find_duplicates_thread = FindDuplicatesThread(root, (shard_index, shard_count))
+    find_duplicates_thread.run()
+    shutil.rmtree(scratch_path, ignore_errors=True)
+
+    with database:
+        database.drop_tables([ShardInfo])
+        database.create_tables([ShardInfo])
+        ShardInfo.create(root=root, hash_parameters=current_hash_parameters(), duplicate_threshold=settings.value('duplicate_threshold', 97.0, float))
+        # paths are kept relative to the scanned folder, like the shard partition, since nodes may mount it in different places
+        prefix = os.path.join(root, '')
+        (ProcessedImage
+         .update(image_path=peewee.fn.REPLACE(peewee.fn.SUBSTR(ProcessedImage.image_path, len(prefix) + 1), os.sep, '/'))
+         .where(peewee.fn.SUBSTR(ProcessedImage.image_path, 1, len(prefix)) == prefix)
+         .execute())
+
+    return find_duplicates_thread.duplicates
+
+
+def _read_shard(shard_path):
+    if is_catalog_file(shard_path):
+        # exported hashes come without their matches, so they are compared with each other as well
+        catalog, hash_parameters = import_catalog(shard_path)
+        info = ShardInfo(root=os.path.abspath(shard_path), hash_parameters=hash_parameters, duplicate_threshold=settings.value('duplicate_threshold', 97.0, float))
+        return info, [dict(image, image_coarse_hash=None) for image in catalog.dicts()], None
+
+    shard_database = peewee.SqliteDatabase(shard_path)
+    with shard_database.bind_ctx([ProcessedImage, ImageSimilarity, ShardInfo]):
+        shard = (ShardInfo.get(),
+                 list(ProcessedImage.select().order_by(ProcessedImage.id).dicts()),
+                 list(ImageSimilarity.select(ImageSimilarity.image1, ImageSimilarity.image2, ImageSimilarity.distance).tuples()))
+    shard_database.close()
+    return shard
+
+
+def _shard_path(root, image_path):
+    # relative paths of a shard are mapped under its root, absolute ones are kept
+    return os.path.normpath(os.path.join(root, image_path))
+
+
+def merge_shards(shard_paths, output_path):
+    shards = [_read_shard(shard_path) for shard_path in shard_paths]
+
+    if len({(info.hash_parameters, info.duplicate_threshold) for info, _, _ in shards}) > 1:
+        raise ValueError('shards were scanned with different hash settings or thresholds')
+    info = shards[0][0]
+
+    # images are renumbered shard after shard, an image found by several shards keeps its first id;
+    # shards may scan different folders, so a file is told by its path under the root of its shard
+    ids = {}
+    images = []
+    boundaries = [0]
+    uncompared = []
+    edges = []
+    for shard_info, shard_images, shard_edges in shards:
+        remap = {}
+        for image in shard_images:
+            image_id = image.pop('id')
+            image['image_path'] = _shard_path(shard_info.root, image['image_path'])
+            if image['image_path'] not in ids:
+                ids[image['image_path']] = len(ids) + 1
+                images.append(image)
+            remap[image_id] = ids[image['image_path']]
+        if shard_edges is None:
+            uncompared.append((boundaries[-1], len(images)))
+        else:
+            edges.extend((remap[id1], remap[id2], distance) for id1, id2, distance in shard_edges if remap[id1] != remap[id2])
+        boundaries.append(len(images))
+
+    graph = SimilarityGraph(*zip(*edges)) if edges else SimilarityGraph()
+
+    if any(',' in image['image_hash'] for image in images):
+        raise ValueError('shards with crop resistant hashes can not be merged')
+
+    memory, shape, image_ids, hash_bits = publish_hashes(((idx + 1, image['image_hash']) for idx, image in enumerate(images)), len(images))
+    if hash_bits:
+        max_cores = settings.value('max_cores', os.cpu_count() or 1, int)
+        max_bits = max_distance_bits(info.duplicate_threshold, hash_bits)
+        size = tile_size(shape[0], shape[1], settings.value('memory_budget', 1024, int), max_cores)
+        try:
+            with ProcessPoolExecutor(max_workers=max_cores) as executor:
+                tiles = list(cross_tile_pairs(boundaries, size)) + [tile for start, end in uncompared for tile in tile_pairs(end, size, start)]
+                results = [executor.submit(compare_shared_tile, memory.name, shape, rows, cols, max_bits) for rows, cols in tiles]
+                for future in as_completed(results):
+                    row_idx, col_idx, distances = future.result()
+                    if len(row_idx):
+                        graph.add_edges(image_ids[row_idx], image_ids[col_idx], distances / hash_bits)
+        finally:
+            memory.close()
+            memory.unlink()
+
+    # the merged database is a shard itself, so merges can be merged again; its images keep their absolute paths
+    database.init(output_path)
+    with database:
+        database.drop_tables([ProcessedImage, ImageSimilarity, ShardInfo, ScanCheckpoint, CompletedTile])
+        database.create_tables([ProcessedImage, ImageSimilarity, ShardInfo])
+        with database.atomic():
+            for batch in peewee.chunked(images, 256):
+                ProcessedImage.insert_many(batch).execute()
+            ShardInfo.create(root=';'.join(dict.fromkeys(shard_info.root for shard_info, _, _ in shards)), hash_parameters=info.hash_parameters, duplicate_threshold=info.duplicate_threshold)
+        graph.save(ImageSimilarity)
+
+    if settings.value('grouping_mode', 'connected', str) == 'leader':
+        groups = graph.clusters(settings.value('max_group_size', 50, int))
+    else:
+        groups = graph.components()
+    return [[images[image_id - 1]['image_path'] for image_id in group] for group in groups]
+
+
+def export_shard(shard_path, output_path):
+    database.init(shard_path)
+    with database:
+        catalog = ImageCatalog.load(ProcessedImage)
+        if database.table_exists(ShardInfo._meta.table_name):
+            shard_info = ShardInfo.get()
+            hash_parameters = shard_info.hash_parameters
+            # exported hashes carry no root, so their paths are absolute again
+            catalog.paths[:] = [_shard_path(shard_info.root, image_path) for image_path in catalog.paths]
+        else:
+            hash_parameters = current_hash_parameters()
+        export_catalog(catalog, output_path, hash_parameters)
+
+
+def _sample_size(count, margin: float = 0.05, z: float = 1.96):
+    # enough files for a per file rate within the margin at 95% confidence, fewer for small folders
+    size = math.ceil(z ** 2 * 0.25 / margin ** 2)
+    return min(count, math.ceil(size / (1 + (size - 1) / max(count, 1))))
+
+
+def estimate_scan(paths, configurations, check_subdirectories=False, sample_size=None, seed: int = 0):
+    # a dry run, a random sample is hashed with every configuration and the full scan is extrapolated from it
+    count = sum(count_files(path, check_subdirectories) for path in paths)
+    sample, _ = sample_files((filepath for path in paths for filepath in file_generator(path, check_subdirectories)),
+                             sample_size or _sample_size(count), seed)
+    workers = hashing_tuning(paths, check_subdirectories)['workers']
+    threshold = settings.value('duplicate_threshold', 97.0, float)
+
+    estimates = []
+    for algorithm_str, hash_size, use_crop_resistant_hash in configurations:
+        seconds = []
+        hashes = []
+        for filepath in sample:
+            started = time.perf_counter()
+            try:
+                hashes.append(_hash_image(filepath, algorithms[algorithm_str], algorithm_str, hash_size, use_crop_resistant_hash)['image_hash'])
+            except Exception:
+                pass
+            seconds.append(time.perf_counter() - started)
+
+        hashed = len(hashes)
+        sample_pairs = hashed * (hashed - 1) // 2
+        started = time.perf_counter()
+        if use_crop_resistant_hash or settings.value('comparison_mode', 'pairwise', str) == 'pairwise' or not hashed:
+            image_hashes = [_get_hash(image_hash) for image_hash in hashes]
+            matches = sum(1 for idx1 in range(hashed) for idx2 in range(idx1 + 1, hashed)
+                          if (1 - (image_hashes[idx1] - image_hashes[idx2])) >= round(threshold / 100, 2))
+        else:
+            packed = np.stack([hex_to_packed(image_hash) for image_hash in hashes])
+            matches = len(tile_matches(packed, packed, max_distance_bits(threshold, packed.shape[1] * 8), True)[0])
+        pair_seconds = (time.perf_counter() - started) / max(sample_pairs, 1)
+
+        # unreadable files of the sample are left out of the comparison as they would be in the scan
+        hashable = count * hashed / max(len(sample), 1)
+        pairs = hashable * (hashable - 1) / 2
+
+        # every pair of the folder is in the sample with the same chance, so the matched share scales to all pairs,
+        # the errors shrink to nothing as the sample grows to the whole folder
+        rate = matches / max(sample_pairs, 1)
+        spread = 1.96 * math.sqrt(max(matches, 1) * max(pairs - sample_pairs, 0) / max(pairs - 1, 1)) / max(sample_pairs, 1)
+        mean = sum(seconds) / max(len(seconds), 1)
+        deviation = math.sqrt(sum((second - mean) ** 2 for second in seconds) / max(len(seconds) - 1, 1))
+        deviation *= math.sqrt(max(count - len(sample), 0) / max(count - 1, 1))
+        estimates.append({
+            'hash_parameters': _hash_parameters(algorithm_str, hash_size, use_crop_resistant_hash),
+            'files': count,
+            'sample': len(sample),
+            'failed': len(sample) - hashed,
+            'hash_seconds': count * mean / workers,
+            'hash_seconds_error': 1.96 * count * deviation / math.sqrt(max(len(seconds), 1)) / workers,
+            'pairs': int(max(pairs, 0)),
+            'compare_seconds': max(pairs, 0) * pair_seconds / workers,
+            'duplicate_rate': rate,
+            'duplicate_pairs': (max(rate - spread, 0) * pairs, rate * pairs, (rate + spread) * pairs),
+        })
+    return estimates
+
+
+class EstimateScanThread(QtCore.QThread):
+    def __init__(self, paths, configurations):
+        QtCore.QThread.__init__(self)
+        self._paths = paths
+        self._configurations = configurations
+        self.estimates = []
+
+    def run(self):
+        self.estimates = estimate_scan(self._paths, self._configurations, settings.value('check_subdirectories', False, bool))
+
+
+def format_estimates(estimates):
+    lines = []
+    for estimate in estimates:
+        low, expected, high = estimate['duplicate_pairs']
+        lines.append(f"{estimate['hash_parameters']}: hashing {datetime.timedelta(seconds=round(estimate['hash_seconds']))} "
+                     f"± {datetime.timedelta(seconds=round(estimate['hash_seconds_error']))}, "
+                     f"{estimate['pairs']} pairs compared in {datetime.timedelta(seconds=round(estimate['compare_seconds']))}, "
+                     f"~{expected:.0f} duplicate pairs ({low:.0f}-{high:.0f}), "
+                     f"{estimate['failed']} of {estimate['sample']} sampled files unreadable")
+    return '\n'.join(lines)
+
+
+def command_line(argv):
+    parser = argparse.ArgumentParser(prog='DropDup')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    shard_parser = subparsers.add_parser('shard', help='hash and compare one shard of a folder into a shard file')
+    shard_parser.add_argument('path')
+    shard_parser.add_argument('output')
+    shard_parser.add_argument('--index', type=int, default=0, help='shard of this node, when the folder is split by path hash')
+    shard_parser.add_argument('--count', type=int, default=1, help='number of nodes the folder is split between')
+    merge_parser = subparsers.add_parser('merge', help='compare shard files or exported hashes with each other and print the groups of duplicates')
+    merge_parser.add_argument('output')
+    merge_parser.add_argument('shards', nargs='+')
+    export_parser = subparsers.add_parser('export', help='export the hashes of a shard file to a directory of npy files, or an .arrow or .parquet file')
+    export_parser.add_argument('shard')
+    export_parser.add_argument('output')
+    estimate_parser = subparsers.add_parser('estimate', help='hash a sample of a folder and estimate the time and duplicates of a full scan')
+    estimate_parser.add_argument('paths', nargs='+')
+    estimate_parser.add_argument('--algorithm', nargs='+', choices=list(algorithms), default=[settings.value('algorithm', 'rhash', str)])
+    estimate_parser.add_argument('--hash-size', nargs='+', type=int, default=[settings.value('hash_size', 8, int)])
+    estimate_parser.add_argument('--crop', choices=['off', 'on', 'both'], default='both', help='crop resistant hashing')
+    estimate_parser.add_argument('--sample', type=int, help='number of files hashed, chosen from the folder size by default')
+    args = parser.parse_args(argv)
+
+    if args.command == 'estimate':
+        crop = {'off': [False], 'on': [True], 'both': [False, True]}[args.crop]
+        configurations = [(algorithm, hash_size, use_crop) for algorithm in args.algorithm for hash_size in args.hash_size for use_crop in crop]
+        print(format_estimates(estimate_scan(args.paths, configurations, settings.value('check_subdirectories', False, bool), args.sample)))
+        return 0
+    elif args.command == 'export':
+        export_shard(args.shard, args.output)
+        return 0
+    elif args.command == 'shard':
+        groups = scan_shard(args.path, args.output, args.index, args.count)
+    else:
+        groups = merge_shards(args.shards, args.output)
+        for group in groups:
+            print('\t'.join(group))
+
+    distribution = group_size_distribution(groups)
+    print(f'{len(groups)} groups by size: ' + ', '.join(f'{count} of {size}' for size, count in distribution.items()), file=sys.stderr)
+    return 0
@@ -0,0 +1,186 @@
+from ImageHash.kernels import component_labels
+import numpy as np
+import itertools
+
+
+def _edge_chunks(rows, chunk_size: int = 65536):
+    rows = iter(rows)
+    while chunk := list(itertools.islice(rows, chunk_size)):
+        image1, image2, distance = zip(*chunk)
+        yield np.array(image1, dtype=np.int64), np.array(image2, dtype=np.int64), np.array(distance, dtype=np.float32)
+
+
+class SimilarityGraph:
+    def __init__(self, image1=None, image2=None, distance=None) -> None:
+        self._image1 = image1 if isinstance(image1, np.ndarray) else np.asarray(image1 if image1 is not None else [], dtype=np.int64)
+        self._image2 = image2 if isinstance(image2, np.ndarray) else np.asarray(image2 if image2 is not None else [], dtype=np.int64)
+        self._distance = distance if isinstance(distance, np.ndarray) else np.asarray(distance if distance is not None else [], dtype=np.float32)
+        self._pending = []
+        self._adjacency = None
+
+    def __len__(self) -> int:
+        return len(self.image1)
+
+    @property
+    def image1(self) -> np.ndarray:
+        self._flush()
+        return self._image1
+
+    @property
+    def image2(self) -> np.ndarray:
+        self._flush()
+        return self._image2
+
+    @property
+    def distance(self) -> np.ndarray:
+        self._flush()
+        return self._distance
+
+    def add_edge(self, id1, id2, distance) -> None:
+        self._pending.append((id1, id2, distance))
+        self._adjacency = None
+
+    def add_edges(self, image1, image2, distance) -> None:
+        self._flush()
+        self._image1 = np.concatenate((self._image1, np.asarray(image1, dtype=np.int64)))
+        self._image2 = np.concatenate((self._image2, np.asarray(image2, dtype=np.int64)))
+        self._distance = np.concatenate((self._distance, np.asarray(distance, dtype=np.float32)))
+        self._adjacency = None
+
+    def _flush(self) -> None:
+        if self._pending:
+            image1, image2, distance = zip(*self._pending)
+            self._pending = []
+            self.add_edges(image1, image2, distance)
+
+    def _get_adjacency(self):
+        if self._adjacency is None:
+            source = np.concatenate((self.image1, self.image2))
+            target = np.concatenate((self.image2, self.image1))
+            weight = np.concatenate((self.distance, self.distance))
+
+            order = np.argsort(source, kind='stable')
+            source, target, weight = source[order], target[order], weight[order]
+            nodes, starts = np.unique(source, return_index=True)
+            ends = np.append(starts[1:], len(source))
+            self._adjacency = (nodes, starts, ends, target, weight)
+
+        return self._adjacency
+
+    def neighbours(self, image_id):
+        nodes, starts, ends, target, weight = self._get_adjacency()
+        idx = np.searchsorted(nodes, image_id)
+        if idx == len(nodes) or nodes[idx] != image_id:
+            return target[:0], weight[:0]
+        return target[starts[idx]: ends[idx]], weight[starts[idx]: ends[idx]]
+
+    def group_matrix(self, group, missing=None) -> np.ndarray:
+        group = np.asarray(group, dtype=np.int64)
+        size = len(group)
+        order = np.argsort(group)
+        sorted_group = group[order]
+
+        matrix = np.full((size, size), np.nan, dtype=np.float64)
+        np.fill_diagonal(matrix, 0)
+
+        for row, image_id in enumerate(group):
+            neighbours, weights = self.neighbours(image_id)
+            if not len(neighbours):
+                continue
+            positions = np.searchsorted(sorted_group, neighbours).clip(max=size - 1)
+            in_group = sorted_group[positions] == neighbours
+            matrix[row, order[positions[in_group]]] = weights[in_group]
+
+        if missing is not None:
+            rows, cols = np.triu_indices(size, 1)
+            unknown = np.isnan(matrix[rows, cols])
+            for i, j in zip(rows[unknown], cols[unknown]):
+                matrix[i, j] = matrix[j, i] = missing(int(group[i]), int(group[j]))
+
+        return matrix
+
+    def average_distance(self, group, missing=None, matrix=None) -> float:
+        # a matrix already built for the group is used as it is
+        if len(group) < 2:
+            return 0.0
+        matrix = self.group_matrix(group, missing) if matrix is None else matrix
+        return float(np.nanmean(matrix[np.triu_indices(len(group), 1)]))
+
+    def rank(self, group, missing=None, matrix=None) -> list:
+        if len(group) < 3:
+            return list(group)
+        matrix = self.group_matrix(group, missing) if matrix is None else matrix
+        matrix = np.where(np.eye(len(group), dtype=bool), np.nan, matrix)
+        known = (~np.isnan(matrix)).sum(axis=1)
+        centrality = np.where(known > 0, np.nansum(matrix, axis=1) / np.maximum(known, 1), np.inf)
+        return [group[idx] for idx in np.argsort(centrality, kind='stable')]
+
+    def chunks(self, chunk_size: int = 65536):
+        for start in range(0, len(self), chunk_size):
+            yield (np.asarray(self.image1[start: start + chunk_size]),
+                   np.asarray(self.image2[start: start + chunk_size]),
+                   np.asarray(self.distance[start: start + chunk_size]))
+
+    def components(self, chunk_size: int = 65536) -> list:
+        if not len(self):
+            return []
+
+        nodes = np.unique(np.concatenate([np.unique(image_ids) for chunk in self.chunks(chunk_size) for image_ids in chunk[:2]]))
+        labels = component_labels(len(nodes), lambda: ((np.searchsorted(nodes, image1), np.searchsorted(nodes, image2))
+                                                       for image1, image2, _ in self.chunks(chunk_size)))
+
+        order = np.argsort(labels, kind='stable')
+        boundaries = np.flatnonzero(np.diff(labels[order])) + 1
+        return [nodes[group].tolist() for group in np.split(order, boundaries)]
+
+    def clusters(self, max_size: int = 0) -> list:
+        if not len(self):
+            return []
+
+        # leader clustering: the best connected image leads a group of its nearest unassigned matches,
+        # so every member is within the threshold of its leader and a chain of matches can not grow a group
+        nodes, starts, ends, target, weight = self._get_adjacency()
+        degrees = ends - starts
+        assigned = np.zeros(len(nodes), dtype=bool)
+        groups = []
+        for leader in np.lexsort((nodes, -degrees)):
+            if assigned[leader]:
+                continue
+            assigned[leader] = True
+
+            neighbours = np.searchsorted(nodes, target[starts[leader]: ends[leader]])
+            distances = weight[starts[leader]: ends[leader]]
+            free = ~assigned[neighbours]
+            neighbours, distances = neighbours[free], distances[free]
+            members = np.unique(neighbours[np.lexsort((nodes[neighbours], distances))][:max_size - 1 if max_size else None])
+            if len(members):
+                assigned[members] = True
+                groups.append([int(nodes[leader])] + nodes[members].tolist())
+
+        return groups
+
+    def save(self, model, batch_size: int = 1000) -> None:
+        with model._meta.database.atomic():
+            for image1, image2, distance in self.chunks(batch_size):
+                model.insert_many(zip(image1.tolist(), image2.tolist(), distance.tolist()), fields=[model.image1, model.image2, model.distance]).execute()
+
+    @classmethod
+    def from_edges(cls, edges):
+        return cls(edges['image1'], edges['image2'], edges['distance'])
+
+    @classmethod
+    def load(cls, model, group=None, batch_size: int = 999):
+        # rows go into arrays chunk by chunk, the edges of a graph are never all held as python tuples
+        fields = (model.image1, model.image2, model.distance)
+        if group is None:
+            chunks = list(_edge_chunks(model.select(*fields).tuples().iterator()))
+        else:
+            # large groups are read in batches of ids, the other end of an edge is checked here
+            group = np.unique(np.asarray(group, dtype=np.int64))
+            chunks = [(image1[inside], image2[inside], distance[inside])
+                      for start in range(0, len(group), batch_size)
+                      for image1, image2, distance in _edge_chunks(model.select(*fields).where(model.image1.in_(group[start: start + batch_size].tolist())).tuples().iterator())
+                      for inside in [np.isin(image2, group)]]
+        if not chunks:
+            return cls()
+        return cls(*(np.concatenate(column) for column in zip(*chunks)))
@@ -0,0 +1,210 @@
+from ImageHash import (
+    hex_to_multihash,
+    packed_distances,
+    hex_to_packed,
+)
+import numpy as np
+
+
+def _substring_masks(bits: int = 16, max_radius: int = 2) -> list:
+    masks = [np.zeros(1, dtype=np.int64)]
+    for _ in range(max_radius):
+        previous = masks[-1]
+        flipped = previous[:, None] ^ (1 << np.arange(bits, dtype=np.int64))[None, :]
+        masks.append(np.setdiff1d(np.unique(flipped), np.concatenate(masks)))
+    return masks
+
+
+_MASKS = _substring_masks()
+
+
+class HashIndex:
+    def __init__(self, capacity: int = 1024, hash_function=None) -> None:
+        self._capacity = capacity
+        self._hash_function = hash_function
+        self._ids = np.empty(0, dtype=np.int64)
+        self._alive = np.empty(0, dtype=bool)
+        self._hashes = None
+        self._hash_bits = 0
+        self._size = 0
+        self._removed = 0
+        self._positions = {}
+        self._multihashes = {}
+
+        # multi-index hashing tables over 16 bit substrings, covering slots below self._indexed
+        self._tables = []
+        self._indexed = 0
+
+    def __len__(self) -> int:
+        return len(self._positions) + len(self._multihashes)
+
+    def __contains__(self, image_id) -> bool:
+        return image_id in self._positions or image_id in self._multihashes
+
+    def _reserve(self, hash_bytes, size) -> None:
+        if self._hashes is None:
+            capacity = max(self._capacity, size)
+            self._ids = np.empty(capacity, dtype=np.int64)
+            self._alive = np.zeros(capacity, dtype=bool)
+            self._hashes = np.zeros((capacity, hash_bytes + hash_bytes % 2), dtype=np.uint8)
+        elif size > len(self._ids):
+            capacity = max(size, len(self._ids) * 2)
+            self._ids = np.resize(self._ids, capacity)
+            self._alive = np.resize(self._alive, capacity)
+            hashes = np.zeros((capacity, self._hashes.shape[1]), dtype=np.uint8)
+            hashes[:self._size] = self._hashes[:self._size]
+            self._hashes = hashes
+
+    def add(self, image_id, image_hash) -> None:
+        self.add_many([image_id], [image_hash])
+
+    def add_many(self, image_ids, image_hashes) -> None:
+        for image_id in image_ids:
+            if image_id in self:
+                self.remove(image_id)
+
+        packed_ids, packed_hashes = [], []
+        for image_id, image_hash in zip(image_ids, image_hashes):
+            if ',' in image_hash:
+                self._multihashes[image_id] = hex_to_multihash(image_hash)
+            else:
+                packed_ids.append(image_id)
+                packed_hashes.append(image_hash)
+
+        if packed_ids:
+            self._hash_bits = len(packed_hashes[0]) * 4
+            if len(set(map(len, packed_hashes))) == 1 and not self._hash_bits % 8:
+                packed = np.frombuffer(bytes.fromhex(''.join(packed_hashes)), dtype=np.uint8).reshape(len(packed_hashes), -1)
+            else:
+                packed = np.array([hex_to_packed(image_hash) for image_hash in packed_hashes])
+
+            self._reserve(packed.shape[1], self._size + len(packed_ids))
+            self._ids[self._size: self._size + len(packed_ids)] = packed_ids
+            self._alive[self._size: self._size + len(packed_ids)] = True
+            self._hashes[self._size: self._size + len(packed_ids), :packed.shape[1]] = packed
+            self._positions.update(zip(packed_ids, range(self._size, self._size + len(packed_ids))))
+            self._size += len(packed_ids)
+
+    def remove(self, image_id) -> None:
+        if image_id in self._multihashes:
+            del self._multihashes[image_id]
+        elif image_id in self._positions:
+            self._alive[self._positions.pop(image_id)] = False
+            self._removed += 1
+            if self._removed > max(1024, self._size // 2):
+                self._compact()
+
+    def _compact(self) -> None:
+        slots = np.flatnonzero(self._alive[:self._size])
+        self._size = len(slots)
+        self._ids[:self._size] = self._ids[slots]
+        self._hashes[:self._size] = self._hashes[slots]
+        self._alive[:self._size] = True
+        self._alive[self._size:] = False
+        self._positions = dict(zip(self._ids[:self._size].tolist(), range(self._size)))
+        self._removed = 0
+        self._tables = []
+        self._indexed = 0
+
+    def _build_tables(self) -> None:
+        keys = self._hashes[:self._size].view('>u2')
+        self._tables = []
+        for column in range(keys.shape[1]):
+            order = np.argsort(keys[:, column], kind='stable').astype(np.int32)
+            offsets = np.zeros(65537, dtype=np.int64)
+            np.cumsum(np.bincount(keys[:, column], minlength=65536), out=offsets[1:])
+            self._tables.append((order, offsets))
+        self._indexed = self._size
+
+    def _probe(self, query, radius) -> np.ndarray:
+        keys = query.view('>u2')
+        candidates = []
+        for column, (order, offsets) in enumerate(self._tables):
+            probes = int(keys[column]) ^ np.concatenate(_MASKS[:radius + 1])
+            starts, ends = offsets[probes], offsets[probes + 1]
+            lengths = ends - starts
+            if lengths.sum():
+                runs = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+                candidates.append(order[runs])
+        # slots added since the tables were built are always candidates
+        return np.concatenate((np.unique(np.concatenate(candidates or [order[:0]])), np.arange(self._indexed, self._size)))
+
+    def _scan(self, query, block_size: int = 32768) -> np.ndarray:
+        distances = np.empty(self._size, dtype=np.uint32)
+        for start in range(0, self._size, block_size):
+            end = min(start + block_size, self._size)
+            distances[start: end] = packed_distances(query[None, :], self._hashes[start: end])[0]
+        return distances
+
+    def _hash_of(self, image_or_hash) -> str:
+        if isinstance(image_or_hash, str):
+            return image_or_hash
+        if self._hash_function is None:
+            raise ValueError('HashIndex needs a hash_function to query by image')
+        return str(self._hash_function(image_or_hash))
+
+    def query(self, image_or_hash, k=None, max_distance=1.0) -> list:
+        image_hash = self._hash_of(image_or_hash)
+
+        if ',' in image_hash:
+            multihash = hex_to_multihash(image_hash)
+            matches = [(image_id, float(multihash - other)) for image_id, other in self._multihashes.items()]
+            return sorted([match for match in matches if match[1] <= max_distance], key=lambda match: match[1])[:k]
+
+        if not len(self._positions) or k == 0:
+            return []
+
+        allowed = np.flatnonzero(np.arange(self._hash_bits + 1) / self._hash_bits <= max_distance)
+        if not len(allowed):
+            return []
+        radius = int(allowed.max())
+
+        query = np.zeros(self._hashes.shape[1], dtype=np.uint8)
+        packed = hex_to_packed(image_hash)
+        query[:len(packed)] = packed
+
+        if self._size - self._indexed > max(65536, self._indexed // 16):
+            self._build_tables()
+
+        # a hash within m * (s + 1) - 1 bits has at least one of its m substrings within s bits
+        slots, distances = None, None
+        for substring_radius in range(len(_MASKS) if self._tables else 0):
+            exact_radius = min(radius, len(self._tables) * (substring_radius + 1) - 1)
+            candidates = self._probe(query, substring_radius)
+            candidates = candidates[self._alive[candidates]]
+            candidate_distances = packed_distances(query[None, :], self._hashes[candidates])[0]
+            within = candidate_distances <= exact_radius
+            if exact_radius == radius or (k is not None and within.sum() >= k):
+                slots, distances = candidates[within], candidate_distances[within]
+                break
+
+        if slots is None:
+            distances = self._scan(query)
+            if self._removed:
+                distances[~self._alive[:self._size]] = self._hash_bits + 1
+            if k is not None:
+                # distances are small integers, so a histogram finds the k-th smallest faster than a partition
+                radius = min(radius, int(np.searchsorted(np.cumsum(np.bincount(distances)), k)))
+            slots = np.flatnonzero(distances <= radius)
+            distances = distances[slots]
+
+        order = np.lexsort((slots, distances))[:k]
+        return [(int(self._ids[slot]), float(distance / self._hash_bits)) for slot, distance in zip(slots[order], distances[order])]
+
+    @classmethod
+    def load(cls, model, hash_parameters=None, hash_function=None, batch_size: int = 65536):
+        query = model.select(model.id, model.image_hash)
+        if hash_parameters is not None:
+            query = query.where(model.hash_parameters == hash_parameters)
+
+        index = cls(capacity=max(1024, query.count()), hash_function=hash_function)
+        batch = []
+        for row in query.tuples().iterator():
+            batch.append(row)
+            if len(batch) == batch_size:
+                index.add_many(*zip(*batch))
+                batch = []
+        if batch:
+            index.add_many(*zip(*batch))
+
+        return index
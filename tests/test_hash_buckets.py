@@ -0,0 +1,84 @@
+from blocked_comparison import HashBuckets, compare_shared_tile, compare_tile, export_hashes, publish_hashes, write_run
+from ImageHash.kernels import numpy_tile_matches
+import blocked_comparison
+import numpy as np
+import pytest
+
+
+def _edges(image1, image2, distance):
+    return sorted(zip(np.asarray(image1).tolist(), np.asarray(image2).tolist(), np.asarray(distance).tolist()))
+
+
+@pytest.mark.parametrize('seed', range(10))
+def test_matches_of_representatives(seed):
+    rng = np.random.default_rng(seed)
+    distinct = rng.integers(0, 256, (rng.integers(1, 40), 8), dtype=np.uint8)
+    hashes = distinct[rng.integers(0, len(distinct), rng.integers(1, 200))]
+    ids = rng.permutation(len(hashes) * 3)[:len(hashes)] + 1
+    order = np.argsort(ids)
+    ids, hashes = ids[order], hashes[order]
+
+    row_idx, col_idx, distances = numpy_tile_matches(hashes, hashes, 20, upper=True)
+    expected = _edges(np.minimum(ids[row_idx], ids[col_idx]), np.maximum(ids[row_idx], ids[col_idx]), distances)
+
+    buckets = HashBuckets.from_hashes(ids, [image_hash.tobytes().hex() for image_hash in hashes])
+    representatives = buckets.representatives
+    assert np.array_equal(representatives, np.sort(representatives))
+    assert len(representatives) == len(np.unique(hashes, axis=0))
+
+    positions = np.searchsorted(ids, representatives)
+    row_idx, col_idx, distances = numpy_tile_matches(hashes[positions], hashes[positions], 20, upper=True)
+    edges = _edges(*buckets.expand(representatives[row_idx], representatives[col_idx], distances)) + _edges(*buckets.internal())
+    assert sorted(edges) == expected
+
+    representative_hashes = hashes[np.searchsorted(ids, buckets.representatives_of(ids))]
+    assert np.array_equal(representative_hashes, hashes)
+
+
+def test_saved_buckets(tmp_path):
+    buckets = HashBuckets.from_hashes([3, 1, 2, 5], ['b', 'a', 'b', 'a'])
+    loaded = HashBuckets.load(buckets.save(str(tmp_path)))
+    assert np.array_equal(loaded.members, [1, 5, 2, 3])
+    assert np.array_equal(loaded.offsets, [0, 2, 4])
+
+    run = np.load(write_run(*loaded.expand([2], [1], [0.25]), str(tmp_path / 'run.npy')))
+    assert run.tolist() == [(1, 2, 0.25), (1, 3, 0.25), (2, 5, 0.25), (3, 5, 0.25)]
+
+
+def test_verified_tile(tmp_path):
+    rng = np.random.default_rng(0)
+    coarse = rng.integers(0, 4, (60, 2), dtype=np.uint8)
+    full = rng.integers(0, 2, (60, 8), dtype=np.uint8)
+    ids = np.arange(1, 61)
+    hashes_path, ids_path, _ = export_hashes(zip(ids, [image_hash.tobytes().hex() for image_hash in coarse]), 60, str(tmp_path))
+    verify_path, _, _ = export_hashes(zip(ids, [image_hash.tobytes().hex() for image_hash in full]), 60, str(tmp_path), 'verify_hashes')
+
+    run = np.load(compare_tile(hashes_path, ids_path, (0, 60), (0, 60), 2, 16, str(tmp_path / 'run.npy'), verify=(verify_path, 3, 64)))
+    row_idx, col_idx, _ = numpy_tile_matches(coarse, coarse, 2, upper=True)
+    distances = np.unpackbits(full[row_idx] ^ full[col_idx], axis=1).sum(axis=1)
+    matches = distances <= 3
+    assert run.tolist() == _edges(ids[row_idx][matches], ids[col_idx][matches], distances[matches] / 64)
+
+
+def test_exports_into_one_directory(tmp_path):
+    hashes_path, ids_path, _ = export_hashes([(1, '0f'), (2, 'f0')], 2, str(tmp_path))
+    verify_path, verify_ids_path, _ = export_hashes([(7, '00ff'), (9, 'ff00')], 2, str(tmp_path), 'verify_hashes')
+    assert np.load(ids_path).tolist() == [1, 2] and np.load(verify_ids_path).tolist() == [7, 9]
+    assert np.load(hashes_path).tolist() == [[15], [240]] and np.load(verify_path).tolist() == [[0, 255], [255, 0]]
+
+def test_attached_hashes_are_closed():
+    hashes = [(1, '0f0f0f0f0f0f0f0f'), (2, '0f0f0f0f0f0f0f0e')]
+    memories = [publish_hashes(hashes, 2)[0] for _ in range(2)]
+    try:
+        for memory in memories:
+            row_idx, col_idx, distances = compare_shared_tile(memory.name, (2, 8), (0, 2), (0, 2), 1)
+            assert (row_idx.tolist(), col_idx.tolist(), distances.tolist()) == ([0], [1], [1])
+            if memory is memories[0]:
+                previous = blocked_comparison._attached_memory[memory.name]
+        # a worker attaching the hashes of another comparison unmaps the previous ones
+        assert previous.buf is None
+        assert list(blocked_comparison._attached_memory) == [memories[1].name]
+    finally:
+        for memory in memories:
+            memory.close()
+            memory.unlink()
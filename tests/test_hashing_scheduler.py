@@ -0,0 +1,73 @@
+from concurrent.futures import ThreadPoolExecutor
+from image_decoder import DecodeError
+import hashing_scheduler
+import pytest
+
+
+class RecordingExecutor(ThreadPoolExecutor):
+    def __init__(self, events) -> None:
+        ThreadPoolExecutor.__init__(self, max_workers=2)
+        self.events = events
+
+    def submit(self, fn, *args, **kwargs):
+        self.events.append(('submit', len(args[1])))
+        return ThreadPoolExecutor.submit(self, fn, *args, **kwargs)
+
+
+@pytest.fixture
+def events(monkeypatch):
+    events = []
+
+    def read_header(filepath, data=None):
+        events.append(('header', filepath))
+        if filepath % 7 == 0:
+            raise DecodeError('corrupt', filepath)
+        return 'PNG', (100 + filepath % 50, 100), 'RGB'
+
+    monkeypatch.setattr(hashing_scheduler, 'read_header', read_header)
+    return events
+
+
+def test_every_file_once(events):
+    with RecordingExecutor(events) as executor:
+        scheduler = hashing_scheduler.MemoryScheduler(executor, 1024, 2)
+        mapped = [(filepath, result) for filepaths, results in scheduler.map(lambda filepath: filepath * 2, range(1000)) for filepath, result in zip(filepaths, results)]
+
+    assert sorted(filepath for filepath, _ in mapped) == list(range(1000))
+    assert all(result == (None if filepath % 7 == 0 else filepath * 2) for filepath, result in mapped)
+    assert scheduler.rejected['corrupt'] == len(range(0, 1000, 7))
+    # hashing starts after the first batch of headers, not after the whole folder
+    assert events.index(('header', hashing_scheduler._HEADER_BATCH)) > next(idx for idx, event in enumerate(events) if event[0] == 'submit')
+
+
+def test_stop_while_reading_headers(events, monkeypatch):
+    with RecordingExecutor(events) as executor:
+        scheduler = hashing_scheduler.MemoryScheduler(executor, 1024, 2)
+        read_header = hashing_scheduler.read_header
+
+        def stopping_read_header(filepath, data=None):
+            if filepath == 100:
+                scheduler.stop()
+            return read_header(filepath, data)
+
+        monkeypatch.setattr(hashing_scheduler, 'read_header', stopping_read_header)
+        list(scheduler.map(lambda filepath: filepath, range(100000)))
+
+    assert sum(1 for event in events if event[0] == 'header') == 101
+    assert not any(event[0] == 'submit' for event in events)
+
+
+def test_stop_shuts_the_executor_down(events):
+    # the scan thread stops the scheduler and shuts its executor down while map is handing out chunks
+    class StoppingExecutor(RecordingExecutor):
+        def submit(self, fn, *args, **kwargs):
+            if sum(1 for event in self.events if event[0] == 'submit') == 3:
+                scheduler.stop()
+                self.shutdown(wait=False)
+            return RecordingExecutor.submit(self, fn, *args, **kwargs)
+
+    executor = StoppingExecutor(events)
+    scheduler = hashing_scheduler.MemoryScheduler(executor, 1024, 2)
+    mapped = [filepath for filepaths, _ in scheduler.map(lambda filepath: filepath, range(2000)) for filepath in filepaths]
+    executor.shutdown()
+    assert len(mapped) < 2000
@@ -0,0 +1,36 @@
+from image_catalog import CATALOG_DTYPE, ImageCatalog, export_catalog, import_catalog
+import numpy as np
+import pytest
+
+
+def _catalog(hashes):
+    records = np.zeros(len(hashes), dtype=CATALOG_DTYPE)
+    records['id'] = np.arange(1, len(hashes) + 1) * 2
+    records['image_width'], records['image_height'], records['image_dpi'] = 640, 480, 72
+    records['image_size'] = np.linspace(0.1, 2, len(hashes))
+    records['reference'][::3] = True
+    paths = np.empty(len(hashes), dtype=object)
+    paths[:] = [f'/photos/{idx}/IMG_{idx}é.jpg' for idx in range(len(hashes))]
+    return ImageCatalog(records, paths, np.array(hashes, dtype=object))
+
+
+@pytest.mark.parametrize('name', ['bundle', 'hashes.arrow', 'hashes.parquet'])
+@pytest.mark.parametrize('hashes', [['0f1e2d3c4b5a6978', 'ffffffffffffffff', '0000000000000001'], ['0f1', 'a2c'], ['0f1e,a2c3', '0000']])
+def test_round_trip(tmp_path, name, hashes):
+    if name != 'bundle':
+        pytest.importorskip('pyarrow')
+    catalog = _catalog(hashes)
+
+    export_catalog(catalog, str(tmp_path / name), 'rhash-8')
+    imported, hash_parameters = import_catalog(str(tmp_path / name))
+
+    assert hash_parameters == 'rhash-8'
+    assert [imported.get(image_id) for image_id in catalog.ids] == [catalog.get(image_id) for image_id in catalog.ids]
+    if catalog.packed is not None:
+        assert np.array_equal(imported.packed, catalog.packed)
+    assert list(imported.select(catalog.ids[::-1]).paths) == list(catalog.paths[::-1])
+
+
+def test_missing_ids():
+    with pytest.raises(KeyError):
+        _catalog(['00', '01']).positions([3])
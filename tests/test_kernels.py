@@ -0,0 +1,105 @@
+from ImageHash import hash_functions, kernels, ImageHash
+from PIL import Image
+import numpy as np
+import pytest
+
+requires_numba = pytest.mark.skipif(kernels.compiled() is None, reason='numba is not installed')
+
+
+@pytest.fixture(params=['numpy', pytest.param('numba', marks=requires_numba)])
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        monkeypatch.setattr(kernels, '_compiled', False)
+    return request.param
+
+
+def _brute_force_matches(hashes1, hashes2, max_bits, upper):
+    bits1, bits2 = np.unpackbits(hashes1, axis=1), np.unpackbits(hashes2, axis=1)
+    distances = (bits1[:, None, :] != bits2[None, :, :]).sum(axis=2)
+    matches = distances <= max_bits
+    if upper:
+        matches = np.triu(matches, 1)
+    row_idx, col_idx = np.nonzero(matches)
+    return row_idx, col_idx, distances[row_idx, col_idx]
+
+
+def _flood_fill_segments(monkeypatch, pixels, min_segment_size):
+    monkeypatch.setattr(hash_functions, 'compiled', lambda: None)
+    try:
+        return hash_functions._find_all_segments(pixels, 128, min_segment_size)
+    finally:
+        monkeypatch.undo()
+
+
+def _labelled_segments(pixels, min_segment_size):
+    return hash_functions._labelled_segments(pixels, 128, min_segment_size)
+
+
+@pytest.mark.parametrize('width', [1, 3, 8, 16, 32])
+@pytest.mark.parametrize('upper', [False, True])
+def test_tile_matches(backend, width, upper):
+    rng = np.random.default_rng(width)
+    hashes1 = rng.integers(0, 256, (120, width), dtype=np.uint8)
+    hashes2 = hashes1.copy() if upper else rng.integers(0, 256, (97, width), dtype=np.uint8)
+    # near copies, so every threshold has matches
+    hashes2[:30] = hashes1[:30] ^ (rng.random((30, width)) < 0.05).astype(np.uint8)
+
+    for max_bits in (-1, 0, 2, width * 2, width * 4, width * 8):
+        result = kernels.tile_matches(hashes1, hashes2, max_bits, upper)
+        for actual, expected in zip(result, _brute_force_matches(hashes1, hashes2, max_bits, upper)):
+            assert np.array_equal(actual, expected)
+
+
+@requires_numba
+@pytest.mark.parametrize('count', [1, 10, 1000, 20000])
+def test_component_labels(count):
+    rng = np.random.default_rng(count)
+    idx1, idx2 = rng.integers(0, count, count // 2), rng.integers(0, count, count // 2)
+
+    def edges():
+        return ((idx1[start: start + 100], idx2[start: start + 100]) for start in range(0, len(idx1), 100))
+
+    assert np.array_equal(kernels.numpy_component_labels(count, edges), kernels.component_labels(count, edges))
+
+
+@requires_numba
+@pytest.mark.parametrize('trial', range(40))
+def test_segments(monkeypatch, trial):
+    rng = np.random.default_rng(trial)
+    size = int(rng.integers(5, 60))
+    pixels = rng.random((size, size + int(rng.integers(0, 5)))) * 255
+    if trial % 2:
+        # blocky noise has regions large enough to be segments
+        pixels = np.kron(pixels[:size // 3 + 1, :size // 3 + 1], np.ones((3, 3)))[:size, :size]
+    pixels = pixels.astype(np.float32)
+    min_segment_size = int(rng.integers(0, 10))
+
+    assert _labelled_segments(pixels, min_segment_size) == _flood_fill_segments(monkeypatch, pixels, min_segment_size)
+
+
+@pytest.mark.parametrize('labelled', [False, pytest.param(True, marks=requires_numba)])
+def test_single_pixel_segments(monkeypatch, labelled):
+    # a checkerboard has only single pixel regions, which never add up to the image size
+    pixels = (np.indices((8, 9)).sum(axis=0) % 2 * 255).astype(np.float32)
+    for min_segment_size, expected in ((0, [[pixel] for pixel in np.ndindex(pixels.shape)]), (1, [])):
+        if labelled:
+            segments = _labelled_segments(pixels, min_segment_size)
+        else:
+            segments = _flood_fill_segments(monkeypatch, pixels, min_segment_size)
+        assert sorted(sorted(segment) for segment in segments) == expected
+
+
+@pytest.mark.parametrize('hash_size', [8, 16])
+def test_rhash_block_means(hash_size):
+    rng = np.random.default_rng(hash_size)
+    pixels = rng.integers(0, 256, (hash_size * 4, hash_size * 4), dtype=np.uint8)
+
+    # the block by block loop rhash used before
+    blocks = np.array([np.mean(pixels[i * 4: (i + 1) * 4, j * 4: (j + 1) * 4]) for i in range(hash_size) for j in range(hash_size)])
+    quarter = len(blocks) // 4
+    means = [np.mean(blocks[i * quarter: (i + 1) * quarter]) for i in range(4)]
+    bits = np.concatenate([blocks[i * quarter: (i + 1) * quarter] >= means[i] for i in range(4)]).reshape(hash_size, hash_size)
+    bits = [bits, np.fliplr(bits), np.flipud(bits), np.fliplr(np.flipud(bits))][means.index(min(means))]
+
+    image_hash = hash_functions.rhash(Image.fromarray(pixels, 'L'), hash_size, preprocessed=True)
+    assert image_hash == ImageHash(bits.astype(np.int8).flatten())
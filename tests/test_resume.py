@@ -0,0 +1,111 @@
+from PySide6 import QtCore
+from PIL import Image
+import numpy as np
+import pytest
+import scanner
+import os
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    settings = QtCore.QSettings(str(tmp_path / 'settings.ini'), QtCore.QSettings.IniFormat)
+    settings.setValue('duplicate_threshold', 90.0)
+    settings.setValue('max_cores', 1)
+    monkeypatch.setattr(scanner, 'settings', settings)
+    monkeypatch.setattr(scanner, 'scratch_path', str(tmp_path / 'processing'))
+    scanner.database.init(str(tmp_path / 'processing.sqlite3'))
+    yield settings
+    scanner.database.close()
+
+
+@pytest.fixture
+def folder(tmp_path):
+    # smooth random images, each with a smaller copy and some with a second copy, so groups have two and three images
+    rng = np.random.default_rng(0)
+    os.makedirs(tmp_path / 'images')
+    for idx in range(8):
+        image = Image.fromarray(rng.integers(0, 256, (8, 8, 3), dtype=np.uint8)).resize((128, 96), Image.BICUBIC)
+        image.save(tmp_path / 'images' / f'{idx}.png')
+        image.resize((64, 48)).save(tmp_path / 'images' / f'{idx}_small.png')
+        if idx % 3 == 0:
+            image.save(tmp_path / 'images' / f'{idx}_copy.jpg', quality=90)
+    return str(tmp_path / 'images')
+
+
+def _scan(path, stop_at=None):
+    thread = scanner.FindDuplicatesThread(path)
+    if stop_at is not None:
+        thread.process_signal.connect(lambda progress: thread.stop() if progress >= stop_at else None)
+    thread.run()
+    with scanner.database:
+        paths = dict(scanner.ProcessedImage.select(scanner.ProcessedImage.id, scanner.ProcessedImage.image_path).tuples())
+    return sorted(sorted(os.path.basename(paths[image_id]) for image_id in group) for group in thread.duplicates)
+
+
+@pytest.mark.parametrize('comparison_mode', ['shared-memory', 'out-of-core'])
+def test_resume_after_comparison(isolated, folder, comparison_mode):
+    # stopped once every tile is done and merged, before the scan is marked done
+    isolated.setValue('comparison_mode', comparison_mode)
+    expected = _scan(folder)
+    assert len(expected) == 8
+
+    with scanner.database:
+        scanner.ScanCheckpoint.delete().execute()
+    _scan(folder, stop_at=84)
+    with scanner.database:
+        assert scanner.ScanCheckpoint.get().phase == 'comparison'
+        assert scanner.CompletedTile.select().where(scanner.CompletedTile.id >= 0).exists()
+    assert _scan(folder) == expected
+    assert not os.path.exists(scanner.scratch_path)
+
+
+@pytest.mark.parametrize('comparison_mode', ['pairwise', 'shared-memory', 'out-of-core'])
+def test_resume_while_hashing(isolated, folder, comparison_mode):
+    isolated.setValue('comparison_mode', comparison_mode)
+    expected = _scan(folder)
+
+    with scanner.database:
+        scanner.ScanCheckpoint.delete().execute()
+    _scan(folder, stop_at=20)
+    with scanner.database:
+        assert scanner.ScanCheckpoint.get().phase == 'hashing'
+        assert 0 < scanner.ProcessedImage.select().count() < 19
+    assert _scan(folder) == expected
+
+
+@pytest.mark.parametrize('comparison_mode', ['shared-memory', 'out-of-core'])
+def test_resume_while_comparing(isolated, folder, comparison_mode, monkeypatch):
+    # small tiles, so the stop comes between them
+    monkeypatch.setattr(scanner, 'tile_size', lambda *args: 4)
+    isolated.setValue('comparison_mode', comparison_mode)
+    expected = _scan(folder)
+
+    with scanner.database:
+        scanner.ScanCheckpoint.delete().execute()
+    _scan(folder, stop_at=70)
+    with scanner.database:
+        assert scanner.ScanCheckpoint.get().phase == 'comparison'
+        completed = scanner.CompletedTile.select().where(scanner.CompletedTile.id >= 0).count()
+    assert 0 < completed < 15
+    assert _scan(folder) == expected
+
+
+@pytest.mark.parametrize('comparison_mode', ['shared-memory', 'out-of-core'])
+def test_resume_after_files_changed(isolated, folder, comparison_mode, monkeypatch):
+    # files added or deleted while the scan was stopped are hashed and compared again
+    monkeypatch.setattr(scanner, 'tile_size', lambda *args: 4)
+    isolated.setValue('comparison_mode', comparison_mode)
+    _scan(folder, stop_at=70)
+    with scanner.database:
+        assert scanner.ScanCheckpoint.get().phase == 'comparison'
+
+    os.remove(os.path.join(folder, '0_copy.jpg'))
+    os.remove(os.path.join(folder, '1_small.png'))
+    Image.open(os.path.join(folder, '2.png')).save(os.path.join(folder, '2_copy.jpg'), quality=90)
+    resumed = _scan(folder)
+
+    with scanner.database:
+        scanner.ScanCheckpoint.delete().execute()
+    expected = _scan(folder)
+    assert resumed == expected
+    assert ['2.png', '2_copy.jpg', '2_small.png'] in expected and not any('1.png' in group for group in expected)
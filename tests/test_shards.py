@@ -0,0 +1,53 @@
+from PySide6 import QtCore
+import peewee
+import pytest
+import scanner
+
+
+@pytest.fixture(autouse=True)
+def isolated(tmp_path, monkeypatch):
+    monkeypatch.setattr(scanner, 'settings', QtCore.QSettings(str(tmp_path / 'settings.ini'), QtCore.QSettings.IniFormat))
+    yield
+    scanner.database.close()
+
+
+def _shard(path, root, images, edges=()):
+    shard_database = peewee.SqliteDatabase(str(path))
+    with shard_database.bind_ctx([scanner.ProcessedImage, scanner.ImageSimilarity, scanner.ShardInfo]):
+        shard_database.create_tables([scanner.ProcessedImage, scanner.ImageSimilarity, scanner.ShardInfo])
+        scanner.ShardInfo.create(root=root, hash_parameters='rhash-8', duplicate_threshold=97.0)
+        for image_path, image_hash in images:
+            scanner.ProcessedImage.create(image_path=image_path, image_hash=image_hash, image_width=64, image_height=64, image_dpi=72, image_size=0.1)
+        for image1, image2, distance in edges:
+            scanner.ImageSimilarity.create(image1=image1, image2=image2, distance=distance)
+    shard_database.close()
+    return str(path)
+
+
+def test_shards_of_different_folders(tmp_path):
+    # the same relative path in two folders is two files, only the copy of x.png is a duplicate
+    shard_a = _shard(tmp_path / 'a.sqlite3', '/photos/A', [('x.png', '0f0f0f0f0f0f0f0f'), ('z.png', 'ffff0000ffff0000')])
+    shard_b = _shard(tmp_path / 'b.sqlite3', '/photos/B', [('x.png', 'f0f0f0f0f0f0f0f0'), ('y.png', '0f0f0f0f0f0f0f0f')])
+
+    groups = scanner.merge_shards([shard_a, shard_b], str(tmp_path / 'merged.sqlite3'))
+    assert [sorted(group) for group in groups] == [['/photos/A/x.png', '/photos/B/y.png']]
+    with scanner.database:
+        assert sorted(scanner.ProcessedImage.select(scanner.ProcessedImage.image_path).scalars()) == \
+            ['/photos/A/x.png', '/photos/A/z.png', '/photos/B/x.png', '/photos/B/y.png']
+
+    # merging again keeps every file once and where it is
+    groups = scanner.merge_shards([str(tmp_path / 'merged.sqlite3'), shard_b], str(tmp_path / 'remerged.sqlite3'))
+    assert [sorted(group) for group in groups] == [['/photos/A/x.png', '/photos/B/y.png']]
+    with scanner.database:
+        assert scanner.ProcessedImage.select().count() == 4
+
+    scanner.export_shard(str(tmp_path / 'merged.sqlite3'), str(tmp_path / 'catalog'))
+    catalog, _ = scanner.import_catalog(str(tmp_path / 'catalog'))
+    assert sorted(catalog.paths) == ['/photos/A/x.png', '/photos/A/z.png', '/photos/B/x.png', '/photos/B/y.png']
+
+
+def test_same_shard_twice(tmp_path):
+    # a shard already holds the matches between its own images
+    shard_a = _shard(tmp_path / 'a.sqlite3', '/photos/A', [('x.png', '0f0f0f0f0f0f0f0f'), ('sub/x.png', '0f0f0f0f0f0f0f0f')], [(1, 2, 0.0)])
+    groups = scanner.merge_shards([shard_a, shard_a], str(tmp_path / 'merged.sqlite3'))
+    assert [sorted(group) for group in groups] == [['/photos/A/sub/x.png', '/photos/A/x.png']]
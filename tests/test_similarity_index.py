@@ -0,0 +1,90 @@
+from similarity_index import HashIndex
+import numpy as np
+import pytest
+
+
+class BruteForce:
+    # ids in insertion order, adding an id again moves it to the end like the index does
+    def __init__(self) -> None:
+        self.hashes = {}
+
+    def add(self, image_id, image_hash) -> None:
+        self.hashes.pop(image_id, None)
+        self.hashes[image_id] = image_hash
+
+    def remove(self, image_id) -> None:
+        self.hashes.pop(image_id, None)
+
+    def query(self, image_hash, k=None, max_distance=1.0) -> list:
+        bits = len(image_hash) * 4
+        ids = np.array(list(self.hashes), dtype=np.int64)
+        others = np.unpackbits(np.frombuffer(bytes.fromhex(''.join(self.hashes.values())), dtype=np.uint8).reshape(len(ids), -1), axis=1)
+        distances = (others != np.unpackbits(np.frombuffer(bytes.fromhex(image_hash), dtype=np.uint8))).sum(axis=1)
+        positions = np.flatnonzero(distances / bits <= max_distance)
+        order = positions[np.lexsort((positions, distances[positions]))][:k]
+        return [(int(ids[position]), float(distances[position] / bits)) for position in order]
+
+
+def _hashes(rng, count, bits, clusters=20, noise=0.03):
+    centers = rng.integers(0, 2, (clusters, bits), dtype=np.uint8)
+    members = centers[rng.integers(0, clusters, count)] ^ (rng.random((count, bits)) < noise)
+    return [np.packbits(member).tobytes().hex() for member in members.astype(np.uint8)]
+
+
+def _check(index, brute_force, queries):
+    for query in queries:
+        for k in (None, 1, 5, 50):
+            for max_distance in (0.0, 0.03, 0.1, 0.3, 1.0):
+                assert index.query(query, k, max_distance) == brute_force.query(query, k, max_distance), (k, max_distance)
+
+
+@pytest.mark.parametrize('bits', [16, 64, 256])
+def test_query_matches_brute_force(bits):
+    rng = np.random.default_rng(bits)
+    index, brute_force = HashIndex(), BruteForce()
+    hashes = _hashes(rng, 3000, bits)
+    index.add_many(range(3000), hashes)
+    for image_id, image_hash in enumerate(hashes):
+        brute_force.add(image_id, image_hash)
+    # tables are built on their own only for large tails, the probes are checked here on a small index
+    index._build_tables()
+    queries = _hashes(rng, 4, bits) + hashes[:2]
+    _check(index, brute_force, queries)
+
+    # deletes leave tombstones in the tables, adds after the build go to the unindexed tail, an id added again moves
+    for image_id in rng.choice(3000, 600, replace=False).tolist():
+        index.remove(image_id)
+        brute_force.remove(image_id)
+    for image_id, image_hash in zip(list(range(3000, 3300)) + [5, 7, 11], _hashes(rng, 303, bits)):
+        index.add(image_id, image_hash)
+        brute_force.add(image_id, image_hash)
+    _check(index, brute_force, queries)
+
+    # removing more than half compacts the slots and drops the tables, queries scan until they are built again
+    for image_id in list(brute_force.hashes)[:1700]:
+        index.remove(image_id)
+        brute_force.remove(image_id)
+    assert not index._tables
+    _check(index, brute_force, queries)
+    index._build_tables()
+    _check(index, brute_force, queries)
+    assert len(index) == len(brute_force.hashes)
+
+
+def test_tail_rebuild():
+    rng = np.random.default_rng(0)
+    index, brute_force = HashIndex(), BruteForce()
+    hashes = _hashes(rng, 1000, 64)
+    index.add_many(range(1000), hashes)
+    brute_force.hashes.update(zip(range(1000), hashes))
+    index._build_tables()
+
+    # a tail longer than the rebuild limit is folded into new tables by the next query
+    tail = _hashes(rng, 70000, 64)
+    index.add_many(range(1000, 71000), tail)
+    brute_force.hashes.update(zip(range(1000, 71000), tail))
+    queries = [hashes[1], tail[-1]]
+    assert index.query(queries[0], 5, 0.1) == brute_force.query(queries[0], 5, 0.1)
+    assert index._indexed == 71000
+    assert index.query(queries[1], 5, 0.1) == brute_force.query(queries[1], 5, 0.1)
+    assert index.query(queries[1], 3) == brute_force.query(queries[1], 3)
@@ -0,0 +1,121 @@
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    FileSystemEventHandler = object
+    Observer = None
+
+import threading
+import queue
+import time
+import os
+
+
+class _EventHandler(FileSystemEventHandler):
+    def __init__(self, events: queue.Queue) -> None:
+        self._events = events
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._events.put(('changed', event.src_path))
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._events.put(('changed', event.src_path))
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self._events.put(('deleted', event.src_path))
+
+    def on_moved(self, event):
+        if not event.is_directory:
+            self._events.put(('deleted', event.src_path))
+            self._events.put(('changed', event.dest_path))
+
+
+def _snapshot(path, recursive):
+    snapshot = {}
+    directories = [path]
+    while directories:
+        try:
+            entries = list(os.scandir(directories.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        directories.append(entry.path)
+                elif entry.is_file():
+                    stat = entry.stat()
+                    snapshot[entry.path] = (stat.st_mtime, stat.st_size)
+            except OSError:
+                continue
+    return snapshot
+
+
+class FolderWatcher:
+    def __init__(self, path, recursive=False, file_filter=None, poll_interval: float = 2.0, settle_time: float = 0.5) -> None:
+        self._path = path
+        self._recursive = recursive
+        self._file_filter = file_filter or (lambda _: True)
+        self._poll_interval = poll_interval
+        self._settle_time = settle_time
+
+        self._events = queue.Queue()
+        self._pending = {}
+        self._observer = None
+        self._poller = None
+        self._stopped = threading.Event()
+
+    @property
+    def backend(self) -> str:
+        return 'watchdog' if Observer is not None else 'polling'
+
+    def start(self) -> None:
+        self._stopped.clear()
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self._events), self._path, recursive=self._recursive)
+            self._observer.start()
+        else:
+            self._poller = threading.Thread(target=self._poll, daemon=True)
+            self._poller.start()
+
+    def stop(self) -> None:
+        self._stopped.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._poller is not None:
+            self._poller.join()
+            self._poller = None
+
+    def _poll(self) -> None:
+        previous = _snapshot(self._path, self._recursive)
+        while not self._stopped.wait(self._poll_interval):
+            current = _snapshot(self._path, self._recursive)
+            for path, state in current.items():
+                if previous.get(path) != state:
+                    self._events.put(('changed', path))
+            for path in previous.keys() - current.keys():
+                self._events.put(('deleted', path))
+            previous = current
+
+    def get_events(self, timeout: float = 0.2) -> list:
+        try:
+            while True:
+                kind, path = self._events.get(timeout=timeout if not self._pending else min(timeout, self._settle_time))
+                if self._file_filter(path):
+                    self._pending[path] = (kind, time.monotonic())
+                timeout = 0
+        except queue.Empty:
+            pass
+
+        now = time.monotonic()
+        settled = [(kind, path) for path, (kind, changed_at) in self._pending.items() if now - changed_at >= self._settle_time]
+        for _, path in settled:
+            del self._pending[path]
+
+        return settled